@@ -0,0 +1,130 @@
+import numpy as np
+
+from NN.Errors import BuildNetworkError
+
+
+def _sigmoid(x):
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1
+    return np.reciprocal(x, out=x)
+
+
+def _softmax(x):
+    x -= np.max(x, axis=1, keepdims=True)
+    np.exp(x, out=x)
+    x /= np.sum(x, axis=1, keepdims=True)
+    return x
+
+
+class NNPredictor:
+    """
+        Inference-only NNDist
+        1) Normalize layers are folded into the weights of the following layer, Dropout is dropped
+        2) Bias & activation are applied in place on one of two ping-pong buffers, and inputs are
+           processed in chunks which keep both buffers within 'memory' (MB)
+        3) Buffers are shared between calls, so a predictor should not be used by several threads at once
+    """
+
+    activations = {
+        "ReLU": lambda x: np.maximum(x, 0, out=x),
+        "Tanh": lambda x: np.tanh(x, out=x),
+        "Sigmoid": _sigmoid,
+        "ELU": lambda x: np.expm1(x, out=x, where=x < 0),
+        "Softplus": lambda x: np.logaddexp(0, x, out=x),
+        "Identical": lambda x: x
+    }
+    transforms = {"Softmax": _softmax, "Sigmoid": _sigmoid}
+
+    def __init__(self, weights, biases, activations, transform=None, dtype=np.float32, memory=64):
+        self._weights = [np.ascontiguousarray(w, dtype=dtype) for w in weights]
+        self._biases = [np.asarray(b, dtype=dtype).reshape(1, -1) for b in biases]
+        self._activations = activations
+        self._transform = transform
+        self._dtype = np.dtype(dtype)
+        self._width = max([self._weights[0].shape[0]] + [w.shape[1] for w in self._weights])
+        self._chunk_size = max(1, int(memory * 2 ** 20 / (2 * self._width * self._dtype.itemsize)))
+        self._buffers = None
+
+    @property
+    def n_layers(self):
+        return len(self._weights)
+
+    @classmethod
+    def from_network(cls, nn, dtype=np.float32, memory=64):
+        weights, biases, activations = [], [], []
+        scale = shift = None
+        # noinspection PyProtectedMember
+        layers, cost = zip(nn._layers, nn._weights, nn._bias), nn._layers[-1]
+        for layer, w, b in layers:
+            name = type(layer).__name__
+            if layer.is_sub_layer:
+                if name == "Dropout":
+                    continue
+                if name != "Normalize":
+                    raise BuildNetworkError("SubLayer '{}' could not be compiled".format(name))
+                # noinspection PyProtectedMember
+                inv_std = 1 / np.sqrt(np.ravel(layer.running_var) + layer._eps)
+                layer_scale = layer.gamma * inv_std
+                layer_shift = layer.beta - np.ravel(layer.running_mean) * layer_scale
+                if scale is None:
+                    scale, shift = layer_scale, layer_shift
+                else:
+                    scale, shift = scale * layer_scale, shift * layer_scale + layer_shift
+                continue
+            if hasattr(layer, "n_filters"):
+                raise BuildNetworkError("Only fully connected networks could be compiled, '{}' found".format(name))
+            if layer is not cost and name not in cls.activations:
+                raise BuildNetworkError("Activation '{}' could not be compiled".format(name))
+            w, b = np.asarray(w, dtype=np.float64), np.asarray(b, dtype=np.float64).reshape(1, -1)
+            if scale is not None:
+                # (a * scale + shift).dot(w) + b == a.dot(scale[:, None] * w) + (shift.dot(w) + b)
+                b = shift.dot(w) + b
+                w = scale[..., None] * w
+                scale = shift = None
+            weights.append(w)
+            biases.append(b)
+            activations.append(None if layer is cost else name)
+        # noinspection PyProtectedMember
+        return cls(weights, biases, activations, cost._transform, dtype, memory)
+
+    def _get_buffers(self, n):
+        size = min(n, self._chunk_size) * self._width
+        if self._buffers is None or self._buffers[0].size < size:
+            self._buffers = [np.empty(size, self._dtype), np.empty(size, self._dtype)]
+        return self._buffers
+
+    def _activate(self, x, buffers):
+        n, (front, back) = len(x), buffers
+        if x.dtype != self._dtype or not x.flags.c_contiguous:
+            staged = back[:x.size].reshape(x.shape)
+            staged[...] = x
+            x = staged
+        for w, b, activation in zip(self._weights, self._biases, self._activations):
+            out = front[:n * w.shape[1]].reshape(n, w.shape[1])
+            np.dot(x, w, out=out)
+            out += b
+            if activation is not None:
+                self.activations[activation](out)
+            x, front, back = out, back, front
+        return x
+
+    def predict(self, x, get_raw_results=False):
+        x = np.asarray(x)
+        if len(x.shape) == 1:
+            x = x.reshape(1, -1)
+        x = x.reshape(len(x), -1)
+        buffers = self._get_buffers(len(x))
+        if get_raw_results:
+            rs = np.empty((len(x), self._weights[-1].shape[1]), self._dtype)
+        else:
+            rs = np.empty(len(x), np.int64)
+        for start in range(0, len(x), self._chunk_size):
+            out = self._activate(x[start:start + self._chunk_size], buffers)
+            if not get_raw_results:
+                rs[start:start + len(out)] = np.argmax(out, axis=1)
+                continue
+            if self._transform is not None:
+                self.transforms[self._transform](out)
+            rs[start:start + len(out)] = out
+        return rs
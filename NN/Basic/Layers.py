@@ -9,10 +9,10 @@ from NN.Basic.Optimizers import *
 @numba.jit([
     "void(int64, int64, int64, int64, float32[:,:,:,:],"
     "int64, int64, int64, float32[:,:,:,:], float32[:,:,:,:])"
-], nopython=True)
+], nopython=True, parallel=True)
 def conv_bp(n, n_filters, out_h, out_w, dx_padded,
             filter_height, filter_width, sd, inner_weight, delta):
-    for i in range(n):
+    for i in numba.prange(n):
         for f in range(n_filters):
             for j in range(out_h):
                 for k in range(out_w):
@@ -28,10 +28,10 @@ def conv_bp(n, n_filters, out_h, out_w, dx_padded,
 @numba.jit([
     "void(int64, int64, int64, int64, float32[:,:,:,:], float32[:,:,:,:],"
     "int64, int64, int64, int32[:,:,:,:,:])"
-], nopython=True)
+], nopython=True, parallel=True)
 def max_pool(n, n_channels, out_h, out_w, x, out,
              pool_height, pool_width, sd, pos_cache):
-    for i in range(n):
+    for i in numba.prange(n):
         for j in range(n_channels):
             for k in range(out_h):
                 for l in range(out_w):
@@ -49,15 +49,54 @@ def max_pool(n, n_channels, out_h, out_w, x, out,
 
 @numba.jit([
     "void(int64, int64, int64, int64, int64, float32[:,:,:,:], float32[:,:,:,:], int32[:,:,:,:,:])"
-], nopython=True)
+], nopython=True, parallel=True)
 def max_pool_bp(n, n_channels, out_h, out_w, sd, dx, delta, pos_cache):
-    for i in range(n):
+    for i in numba.prange(n):
         for j in range(n_channels):
             for k in range(out_h):
                 for l in range(out_w):
                     ksd, lsd = k * sd, l * sd
                     pos = pos_cache[i, j, k, l]
-                    dx[i, j, ksd+pos[0], lsd+pos[1]] = delta[i, j, k, l]
+                    dx[i, j, ksd+pos[0], lsd+pos[1]] += delta[i, j, k, l]
+
+
+# Vectorized engines, which trade memory for BLAS & whole-array passes
+
+def _strided_slice(offset, sd, size):
+    return slice(offset, offset + sd * (size - 1) + 1, sd)
+
+
+def conv_bp_col2im(dx_padded, inner_weight, delta, sd, batch_size):
+    n_filters, n_channels, filter_height, filter_width = inner_weight.shape
+    n, _, out_h, out_w = delta.shape
+    w_cols = inner_weight.reshape(n_filters, -1).T
+    for start in range(0, n, batch_size):
+        batch_delta = delta[start:start + batch_size]
+        cols = w_cols.dot(batch_delta.transpose(1, 0, 2, 3).reshape(n_filters, -1)).reshape(
+            n_channels, filter_height, filter_width, len(batch_delta), out_h, out_w)
+        target = dx_padded[start:start + batch_size].transpose(1, 0, 2, 3)
+        for p in range(filter_height):
+            for q in range(filter_width):
+                target[..., _strided_slice(p, sd, out_h), _strided_slice(q, sd, out_w)] += cols[:, p, q]
+
+
+def max_pool_window(x, pool_height, pool_width, sd, out_h, out_w):
+    n, n_channels = x.shape[:2]
+    s0, s1, s2, s3 = x.strides
+    windows = np.lib.stride_tricks.as_strided(
+        x, shape=(n, n_channels, out_h, out_w, pool_height, pool_width),
+        strides=(s0, s1, sd * s2, sd * s3, s2, s3)
+    ).reshape(n, n_channels, out_h, out_w, -1)
+    arg_max = np.argmax(windows, axis=4)
+    return np.take_along_axis(windows, arg_max[..., None], axis=4)[..., 0], arg_max
+
+
+def max_pool_window_bp(dx, delta, arg_max, pool_height, pool_width, sd):
+    *_, out_h, out_w = delta.shape
+    for p in range(pool_height):
+        for q in range(pool_width):
+            dx[..., _strided_slice(p, sd, out_h), _strided_slice(q, sd, out_w)] += np.where(
+                arg_max == p * pool_width + q, delta, 0)
 
 
 # Abstract Layers
@@ -65,6 +104,10 @@ def max_pool_bp(n, n_channels, out_h, out_w, sd, dx, delta, pos_cache):
 class Layer:
     LayerTiming = Timing()
 
+    # Arrays a layer keeps from 'activate' for 'bp'; state attributes must survive a recomputation
+    _cache_attrs = ()
+    _state_attrs = ()
+
     def __init__(self, shape):
         """
         :param shape: shape[0] = units of previous layer
@@ -77,6 +120,7 @@ class Layer:
         self.is_fc_base = False
         self.is_sub_layer = False
         self._last_sub_layer = None
+        self.replay = False
 
     def __str__(self):
         return self.__class__.__name__
@@ -129,19 +173,50 @@ class Layer:
     def last_sub_layer(self, value):
             self._last_sub_layer = value
 
+    def _cached(self, state=True):
+        attrs = set()
+        for cls in type(self).__mro__:
+            attrs.update(cls.__dict__.get("_cache_attrs", ()))
+            if state:
+                attrs.update(cls.__dict__.get("_state_attrs", ()))
+        return attrs
+
+    @property
+    def cached_arrays(self):
+        arrays = []
+        for attr in self._cached():
+            value = getattr(self, attr, None)
+            for arr in (value.values() if isinstance(value, dict) else (value,)):
+                if isinstance(arr, np.ndarray):
+                    arrays.append(arr)
+        return arrays
+
+    def release(self, keep_state=False):
+        for attr in self._cached(not keep_state):
+            value = getattr(self, attr, None)
+            if isinstance(value, dict):
+                value.clear()
+            elif value is not None:
+                setattr(self, attr, None)
+
     # Core
 
     def derivative(self, y, delta=None):
         return self._derivative(y, delta)
 
     @LayerTiming.timeit(level=1, prefix="[Core] ")
-    def activate(self, x, w, bias=None, predict=False):
+    def activate(self, x, w, bias=None, predict=False, out=None):
         if self.is_fc:
             x = x.reshape(x.shape[0], -1)
         if self.is_sub_layer:
             if bias is None:
                 return self._activate(x, predict)
             return self._activate(x + bias, predict)
+        if out is not None:
+            np.dot(x, w, out=out)
+            if bias is not None:
+                out += bias
+            return self._activate_inplace(out, predict)
         if bias is None:
             return self._activate(x.dot(w), predict)
         return self._activate(x.dot(w) + bias, predict)
@@ -159,6 +234,9 @@ class Layer:
     def _activate(self, x, predict):
         pass
 
+    def _activate_inplace(self, x, predict):
+        return self._activate(x, predict)
+
     def _derivative(self, y, delta=None):
         pass
 
@@ -204,7 +282,16 @@ class SubLayer(Layer):
 
 
 class ConvLayer(Layer):
+    """
+        engine: None picks 'vectorized' (col2im / window views) whenever its temporaries fit in
+                engine_memory (MB) & the parallel numba kernels otherwise;
+                col2im runs in batch chunks, so only the columns of a single sample have to fit
+    """
+
     LayerTiming = Timing()
+    _cache_attrs = ("x_cache", "x_col_cache")
+    engine = None
+    engine_memory = 64
 
     def __init__(self, shape, stride=1, padding=0, parent=None):
         """
@@ -254,6 +341,14 @@ class ConvLayer(Layer):
     def padding(self):
         return self._padding
 
+    def _get_engine(self, sample_nbytes):
+        engine = self.engine
+        if engine is None:
+            engine = "vectorized" if sample_nbytes <= self.engine_memory * 2 ** 20 else "numba"
+        elif engine not in ("vectorized", "numba"):
+            raise LayerError("Undefined engine '{}' found".format(engine))
+        return engine
+
     def _activate(self, x, predict):
         raise NotImplementedError("Please implement activation function for " + self.name)
 
@@ -263,6 +358,7 @@ class ConvLayer(Layer):
 
 class ConvPoolLayer(ConvLayer):
     LayerTiming = Timing()
+    _cache_attrs = ("x_cache", "_pool_cache")
 
     def __init__(self, shape, stride=1, padding=0):
         """
@@ -356,10 +452,17 @@ class ConvMeta(type):
             *_, out_h, out_w = delta.shape
 
             dx_padded = np.zeros((n, n_channels, height + 2 * p, width + 2 * p), dtype=np.float32)
-            conv_bp(
-                n, n_filters, out_h, out_w, dx_padded,
-                filter_height, filter_width, sd, self.inner_weight, delta
-            )
+            sample_nbytes = dx_padded.itemsize * n_channels * filter_height * filter_width * out_h * out_w
+            if self._get_engine(sample_nbytes) == "vectorized":
+                conv_bp_col2im(
+                    dx_padded, self.inner_weight, delta, sd,
+                    max(1, int(self.engine_memory * 2 ** 20 / sample_nbytes))
+                )
+            else:
+                conv_bp(
+                    n, n_filters, out_h, out_w, dx_padded,
+                    filter_height, filter_width, sd, self.inner_weight, delta
+                )
             dx = dx_padded[..., p:-p, p:-p] if p > 0 else dx_padded
             return dx, dw, db
 
@@ -434,6 +537,9 @@ class Tanh(Layer):
     def _activate(self, x, predict):
         return np.tanh(x)
 
+    def _activate_inplace(self, x, predict):
+        return np.tanh(x, out=x)
+
     def _derivative(self, y, delta=None):
         return 1 - y ** 2
 
@@ -442,6 +548,12 @@ class Sigmoid(Layer):
     def _activate(self, x, predict):
         return 1 / (1 + np.exp(-x))
 
+    def _activate_inplace(self, x, predict):
+        np.negative(x, out=x)
+        np.exp(x, out=x)
+        x += 1
+        return np.reciprocal(x, out=x)
+
     def _derivative(self, y, delta=None):
         return y * (1 - y)
 
@@ -462,6 +574,9 @@ class ReLU(Layer):
     def _activate(self, x, predict):
         return np.maximum(0, x)
 
+    def _activate_inplace(self, x, predict):
+        return np.maximum(x, 0, out=x)
+
     def _derivative(self, y, delta=None):
         return y > 0
 
@@ -519,12 +634,17 @@ class MaxPool(ConvPoolLayer):
         _, pool_height, pool_width = self._shape[1]
         same_size = pool_height == pool_width == sd
         tiles = height % pool_height == 0 and width % pool_width == 0
+        window_nbytes = x.itemsize * n * n_channels * self.out_h * self.out_w * pool_height * pool_width
         if same_size and tiles:
             x_reshaped = x.reshape(n, n_channels, int(height / pool_height), pool_height,
                                    int(width / pool_width), pool_width)
             self._pool_cache["x_reshaped"] = x_reshaped
             out = x_reshaped.max(axis=3).max(axis=4)
             self._pool_cache["method"] = "reshape"
+        elif self._get_engine(window_nbytes) == "vectorized":
+            out, self._pool_cache["arg_max"] = max_pool_window(
+                x, pool_height, pool_width, sd, self.out_h, self.out_w)
+            self._pool_cache["method"] = "window"
         else:
             out = np.zeros((n, n_channels, self.out_h, self.out_w), dtype=np.float32)
             pos_cache = np.zeros((n, n_channels, self.out_h, self.out_w, 2), dtype=np.int32)
@@ -555,6 +675,10 @@ class MaxPool(ConvPoolLayer):
             dx_reshaped[mask] = dout_broadcast[mask]
             dx_reshaped /= np.sum(mask, axis=(3, 5), keepdims=True)
             dx = dx_reshaped.reshape(self.x_cache.shape)
+        elif method == "window":
+            _, pool_height, pool_width = self._shape[1]
+            dx = np.zeros(self.x_cache.shape, dtype=np.float32)
+            max_pool_window_bp(dx, delta, self._pool_cache["arg_max"], pool_height, pool_width, self._stride)
         elif method == "original":
             sd = self._stride
             dx = np.zeros_like(self.x_cache)
@@ -570,6 +694,8 @@ class MaxPool(ConvPoolLayer):
 # Special Layer
 
 class Dropout(SubLayer):
+    _state_attrs = ("_mask",)
+
     def __init__(self, parent, shape, keep_prob=0.5):
         if keep_prob < 0 or keep_prob >= 1:
             raise BuildLayerError("Probability of Dropout should be a positive float smaller than 1")
@@ -584,6 +710,8 @@ class Dropout(SubLayer):
 
     def _activate(self, x, predict):
         if not predict:
+            if self.replay and self._mask is not None:
+                return x * self._mask
             # noinspection PyTypeChecker
             self._mask = np.random.binomial(
                 [np.ones(x.shape)], self._prob
@@ -596,6 +724,8 @@ class Dropout(SubLayer):
 
 
 class Normalize(SubLayer):
+    _cache_attrs = ("x_cache", "x_normalized_cache")
+
     def __init__(self, parent, shape, lr=0.001, eps=1e-8, momentum=0.9, optimizers=None):
         SubLayer.__init__(self, parent, shape)
         self.sample_mean, self.sample_var = None, None
@@ -649,6 +779,8 @@ class Normalize(SubLayer):
             x_normalized = (x - self.sample_mean) / np.sqrt(self.sample_var + self._eps)
             self.x_cache, self.x_normalized_cache = x, x_normalized
             out = self.gamma * x_normalized + self.beta
+            if self.replay:
+                return out
             self.running_mean = self._momentum * self.running_mean + (1 - self._momentum) * self.sample_mean
             self.running_var = self._momentum * self.running_var + (1 - self._momentum) * self.sample_var
         else:
@@ -7,9 +7,12 @@ from math import sqrt, ceil
 
 from NN.Basic.Layers import *
 from NN.Basic.Optimizers import OptFactory
+from NN.Basic.Inference import NNPredictor
 
 from Util.Util import VisUtil
 from Util.Bases import ClassifierBase
+from Util.Batches import BatchPipeline
+from Util.Events import Events
 from Util.ProgressBar import ProgressBar
 
 
@@ -52,6 +55,9 @@ class NNDist(ClassifierBase):
         self._x_min, self._x_max = 0, 0
         self._y_min, self._y_max = 0, 0
 
+        self._activation_buffers, self._buffer_ids = {}, set()
+        self._memory_log = {}
+
         self._layer_factory = LayerFactory()
         self._optimizer_factory = OptFactory()
 
@@ -285,6 +291,137 @@ class NNDist(ClassifierBase):
                 activations[-1], self._weights[i + 1], self._bias[i + 1], predict))
         return activations
 
+    # Memory saving
+
+    def _get_checkpoints(self, checkpoints):
+        n_layers = len(self._layers)
+        if checkpoints is None:
+            return set()
+        if checkpoints == "sqrt":
+            checkpoints = max(1, int(round(sqrt(n_layers))))
+        if isinstance(checkpoints, int):
+            checkpoints = range(checkpoints - 1, n_layers, checkpoints)
+        return {c % n_layers for c in checkpoints if c % n_layers < n_layers - 1}
+
+    def _take_buffer(self, shape, dtype):
+        free = self._activation_buffers.setdefault((shape, dtype), [])
+        if free:
+            return free.pop()
+        buffer = np.empty(shape, dtype)
+        self._buffer_ids.add(id(buffer))
+        return buffer
+
+    def _give_buffer(self, arr):
+        if id(arr) in self._buffer_ids:
+            self._activation_buffers[(arr.shape, arr.dtype)].append(arr)
+
+    def _activate_layer(self, i, x, replay=False):
+        layer, w, b = self._layers[i], self._weights[i], self._bias[i]
+        if layer.is_sub_layer or isinstance(layer, ConvLayer):
+            layer.replay = replay
+            rs = layer.activate(x, w, b)
+            layer.replay = False
+            return rs
+        buffer = self._take_buffer((len(x), w.shape[1]), np.result_type(x, w))
+        rs = layer.activate(x, w, b, out=buffer)
+        if rs is not buffer:
+            self._give_buffer(buffer)
+        return rs
+
+    @staticmethod
+    def _memory_roots(arrays, roots=None):
+        roots = {} if roots is None else roots
+        for arr in arrays:
+            if isinstance(arr, tuple):
+                NNDist._memory_roots(arr, roots)
+                continue
+            if not isinstance(arr, np.ndarray):
+                continue
+            while isinstance(arr.base, np.ndarray):
+                arr = arr.base
+            roots[id(arr)] = arr.nbytes
+        return roots
+
+    def _log_memory(self, i, activations, delta=None):
+        roots = self._memory_roots(list(activations.values()) + [delta])
+        output = self._memory_roots([activations.get(i)])
+        cache = self._memory_roots(self._layers[i].cached_arrays)
+        live = dict(roots)
+        for layer in self._layers:
+            self._memory_roots(layer.cached_arrays, live)
+        for free in self._activation_buffers.values():
+            self._memory_roots(free, live)
+        record = self._memory_log.setdefault(i, [0] * 4)
+        for j, nbytes in enumerate((
+            sum(output.values()), sum(v for k, v in cache.items() if k not in roots),
+            sum(self._memory_roots([delta]).values()), sum(live.values())
+        )):
+            if nbytes > record[j]:
+                record[j] = nbytes
+
+    @NNTiming.timeit(level=1)
+    def _memory_step(self, x, y, checkpoints, log=True):
+        last = len(self._layers) - 1
+        top = max(checkpoints, default=-1)
+        starts = {c: max([s for s in checkpoints if s < c], default=-1) + 1 for c in checkpoints}
+        activations, prev = {-1: x}, x
+        for i in range(last + 1):
+            rs = self._activate_layer(i, prev)
+            if i > top or i in checkpoints:
+                activations[i] = rs
+            if i - 1 not in activations:
+                self._give_buffer(prev)
+            if i <= top:
+                self._layers[i].release(keep_state=True)
+            if log:
+                self._log_memory(i, activations)
+            prev = rs
+
+        delta = self._layers[-1].bp_first(y, activations[last])
+        for i in range(last - 1, -1, -1):
+            if i in starts:
+                for j in range(starts[i], i + 1):
+                    rs = self._activate_layer(j, activations[j - 1], replay=True)
+                    if j in activations:
+                        self._give_buffer(activations[j])
+                    activations[j] = rs
+            next_delta = self._layers[i].bp(activations[i], self._weights[i + 1], delta)
+            if not isinstance(self._layers[i + 1], SubLayer):
+                self._opt(i + 1, activations[i], delta)
+            if log:
+                self._log_memory(i + 1, activations, delta)
+            self._layers[i + 1].release()
+            self._give_buffer(activations.pop(i + 1))
+            delta = next_delta
+        self._opt(0, x, delta)
+        if log:
+            self._log_memory(0, activations, delta)
+        self._layers[0].release()
+        self._give_buffer(activations.pop(0))
+
+    @property
+    def memory_log(self):
+        return {
+            "{}_{}".format(i, self._layers[i].name): dict(zip(("output", "cache", "delta", "live"), record))
+            for i, record in sorted(self._memory_log.items())
+        }
+
+    def show_memory_log(self):
+        if not self._memory_log:
+            print("No memory log found. Fit with 'memory_saving=True' to record one")
+            return
+        mb = 2 ** 20
+        print()
+        print("=" * 72)
+        print("{:<24s}{:>12s}{:>12s}{:>12s}{:>12s}".format("Layer (MB)", "Output", "Cache", "Delta", "Live"))
+        print("-" * 72)
+        for name, record in self.memory_log.items():
+            print("{:<24s}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}".format(
+                name, *(record[key] / mb for key in ("output", "cache", "delta", "live"))))
+        print("-" * 72)
+        print("Peak: {:.3f} MB".format(max(record[3] for record in self._memory_log.values()) / mb))
+        print("=" * 72)
+
     @NNTiming.timeit(level=3)
     def _append_log(self, x, y, name, get_loss=True):
         y_pred = self._get_prediction(x, name)
@@ -393,14 +530,27 @@ class NNDist(ClassifierBase):
 
     # Optimizing Process
 
+    @staticmethod
+    def _bind_flat(optimizer, variables):
+        # Variables may have been replaced (e.g. unpickled apart from the optimizer by 'load'),
+        # so they are copied back into the flat buffer & swapped for its views again
+        for view, var in zip(optimizer.variables, variables):
+            if view is not var:
+                view[...] = var
+        variables[:] = optimizer.variables
+
     @NNTiming.timeit(level=4)
-    def _init_optimizer(self):
+    def _init_optimizer(self, flatten=False):
         if not isinstance(self._w_optimizer, Optimizer):
             self._w_optimizer = self._optimizer_factory.get_optimizer_by_name(
-                self._w_optimizer, self._weights, self._lr, self._epoch)
+                self._w_optimizer, self._weights, self._lr, self._epoch, flatten)
+        if self._w_optimizer.flat is not None:
+            NNDist._bind_flat(self._w_optimizer, self._weights)
         if not isinstance(self._b_optimizer, Optimizer):
             self._b_optimizer = self._optimizer_factory.get_optimizer_by_name(
-                self._b_optimizer, self._bias, self._lr, self._epoch)
+                self._b_optimizer, self._bias, self._lr, self._epoch, flatten)
+        if self._b_optimizer.flat is not None:
+            NNDist._bind_flat(self._b_optimizer, self._bias)
         if self._w_optimizer.name != self._b_optimizer.name:
             self._optimizer_name = None
         else:
@@ -409,20 +559,29 @@ class NNDist(ClassifierBase):
     @NNTiming.timeit(level=1)
     def _opt(self, i, activation, delta):
         if not isinstance(self._layers[i], ConvLayer):
-            self._weights[i] *= self._regularization_param
-            self._weights[i] += self._w_optimizer.run(
-                i, activation.reshape(activation.shape[0], -1).T.dot(delta)
-            )
-            if self._apply_bias:
-                self._bias[i] += self._b_optimizer.run(
-                    i, np.sum(delta, axis=0, keepdims=True)
-                )
+            dw = activation.reshape(activation.shape[0], -1).T.dot(delta)
+            db = np.sum(delta, axis=0, keepdims=True) if self._apply_bias else None
+        else:
+            dw, db = delta[1], delta[2] if self._apply_bias else None
+        if self._w_optimizer.flat is not None:
+            if dw is not None:
+                self._w_optimizer.grads[i][...] = dw
         else:
             self._weights[i] *= self._regularization_param
-            if delta[1] is not None:
-                self._weights[i] += self._w_optimizer.run(i, delta[1])
-            if self._apply_bias and delta[2] is not None:
-                self._bias[i] += self._b_optimizer.run(i, delta[2])
+            if dw is not None:
+                self._w_optimizer.apply(i, self._weights[i], dw)
+        if db is not None:
+            if self._b_optimizer.flat is not None:
+                self._b_optimizer.grads[i][...] = db
+            else:
+                self._b_optimizer.apply(i, self._bias[i], db)
+
+    @NNTiming.timeit(level=1)
+    def _opt_all(self):
+        if self._w_optimizer.flat is not None:
+            self._w_optimizer.apply_all(decay=self._regularization_param)
+        if self._apply_bias and self._b_optimizer.flat is not None:
+            self._b_optimizer.apply_all()
 
     # API
 
@@ -523,7 +682,8 @@ class NNDist(ClassifierBase):
             lr=0.001, lb=0.001, epoch=20, weight_scale=1, apply_bias=True,
             show_loss=True, metrics=None, do_log=True, verbose=None,
             visualize=False, visualize_setting=None,
-            draw_weights=False, animation_params=None):
+            draw_weights=False, animation_params=None, flatten=False,
+            memory_saving=False, checkpoints=None):
         self._lr, self._epoch = lr, epoch
         for weight in self._weights:
             weight *= weight_scale
@@ -538,7 +698,7 @@ class NNDist(ClassifierBase):
                     self._w_optimizer = self._optimizer_name
                 if not self._b_optimizer:
                     self._b_optimizer = self._optimizer_name
-        self._init_optimizer()
+        self._init_optimizer(flatten)
         assert isinstance(self._w_optimizer, Optimizer) and isinstance(self._b_optimizer, Optimizer)
         print()
         print("=" * 30)
@@ -590,6 +750,9 @@ class NNDist(ClassifierBase):
 
         *animation_properties, animation_params = self._get_animation_params(animation_params)
         sub_bar = ProgressBar(max_value=train_repeat * record_period - 1, name="Iteration", start=False)
+        pipeline = BatchPipeline((x_train, y_train), batch_size) if do_random_batch else None
+        if memory_saving:
+            checkpoints, self._memory_log = self._get_checkpoints(checkpoints), {}
         for counter in range(epoch):
             self._w_optimizer.update()
             self._b_optimizer.update()
@@ -597,20 +760,27 @@ class NNDist(ClassifierBase):
                 sub_bar.start()
             for _ in range(train_repeat):
                 if do_random_batch:
-                    batch = np.random.choice(train_len, batch_size)
-                    x_batch, y_batch = x_train[batch], y_train[batch]
+                    x_batch, y_batch = next(pipeline)
                 else:
                     x_batch, y_batch = x_train, y_train
-                activations = self._get_activations(x_batch)
+                with Events.timer("train.step"):
+                    if memory_saving:
+                        # Batch shapes are fixed, so the first step of an epoch is enough to find the peaks
+                        self._memory_step(x_batch, y_batch, checkpoints, log=_ == 0)
+                    else:
+                        activations = self._get_activations(x_batch)
 
-                deltas = [self._layers[-1].bp_first(y_batch, activations[-1])]
-                for i in range(-1, -len(activations), -1):
-                    deltas.append(self._layers[i - 1].bp(activations[i - 1], self._weights[i], deltas[-1]))
+                        deltas = [self._layers[-1].bp_first(y_batch, activations[-1])]
+                        for i in range(-1, -len(activations), -1):
+                            deltas.append(self._layers[i - 1].bp(activations[i - 1], self._weights[i], deltas[-1]))
 
-                for i in range(layer_width - 1, 0, -1):
-                    if not isinstance(self._layers[i], SubLayer):
-                        self._opt(i, activations[i - 1], deltas[layer_width - i - 1])
-                self._opt(0, x_batch, deltas[-1])
+                        for i in range(layer_width - 1, 0, -1):
+                            if not isinstance(self._layers[i], SubLayer):
+                                self._opt(i, activations[i - 1], deltas[layer_width - i - 1])
+                        self._opt(0, x_batch, deltas[-1])
+                    if self._w_optimizer.flat is not None or self._b_optimizer.flat is not None:
+                        self._opt_all()
+                Events.count("train.samples", len(x_batch))
 
                 if draw_weights:
                     for i, weight in enumerate(self._weights):
@@ -647,6 +817,10 @@ class NNDist(ClassifierBase):
                     if self.verbose >= NNVerbose.ITER:
                         sub_bar = ProgressBar(max_value=train_repeat * record_period - 1, name="Iteration", start=False)
 
+        if pipeline is not None:
+            pipeline.close()
+        self._activation_buffers, self._buffer_ids = {}, set()
+        Events.flush()
         if do_log:
             self._append_log(x_test, y_test, "test", get_loss=show_loss)
         if img is not None:
@@ -737,6 +911,10 @@ class NNDist(ClassifierBase):
         y_pred = self._get_prediction(x)
         return y_pred if get_raw_results else np.argmax(y_pred, axis=1)
 
+    @NNTiming.timeit(level=4, prefix="[API] ")
+    def compile(self, dtype=np.float32, memory=64):
+        return NNPredictor.from_network(self, dtype, memory)
+
     def draw_results(self):
         metrics_log, loss_log = {}, {}
         for key, value in sorted(self._logs.items()):
@@ -4,11 +4,22 @@ from Util.Timing import Timing
 
 
 class Optimizer:
+    """
+        Optimizers keep their caches in the dtype of the variables they are fed with & write every step
+        into a preallocated buffer, so 'run' returns a reused array which should be consumed right away
+        1) 'apply' updates a parameter in place without going through the timing wrapper
+        2) With 'feed_variables(..., flatten=True)' all variables are copied into one contiguous buffer and
+           replaced by views of it; write gradients into 'grads' and call 'apply_all' to update them at once
+    """
+
     OptTiming = Timing()
 
     def __init__(self, lr=0.01, cache=None):
         self.lr = lr
         self._cache = cache
+        self._scratch = None
+        self.variables = self.grads = None
+        self._flat = self._flat_grad = self._flat_cache = self._flat_scratch = None
 
     def __str__(self):
         return self.__class__.__name__
@@ -20,17 +31,97 @@ class Optimizer:
     def name(self):
         return str(self)
 
-    def feed_variables(self, variables):
-        self._cache = [
-            np.zeros(var.shape) for var in variables
-        ]
+    @property
+    def flat(self):
+        return self._flat
+
+    @property
+    def n_slots(self):
+        return 1
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self._flat is not None:
+            # Views would be pickled as copies cut off from the flat buffers, so they are rebuilt on load
+            state["_shapes"] = [var.shape for var in self.variables]
+            state["variables"] = state["grads"] = state["_cache"] = state["_scratch"] = None
+        return state
+
+    def __setstate__(self, state):
+        shapes = state.pop("_shapes", None)
+        self.__dict__.update(state)
+        if shapes is not None:
+            self.variables = self._views(self._flat, shapes)
+            self.grads = self._views(self._flat_grad, shapes)
+            self._scratch = self._views(self._flat_scratch, shapes)
+            slots = [self._views(cache, shapes) for cache in self._flat_cache]
+            self._cache = slots[0] if self.n_slots == 1 else slots
+
+    @staticmethod
+    def _views(buffer, shapes):
+        views, cursor = [], 0
+        for shape in shapes:
+            size = int(np.prod(shape))
+            views.append(buffer[cursor:cursor + size].reshape(shape))
+            cursor += size
+        return views
+
+    def feed_variables(self, variables, flatten=False):
+        variables = list(variables)
+        if not flatten:
+            self._flat = None
+            self.variables = variables
+            slots = [[np.zeros(var.shape, var.dtype) for var in variables] for _ in range(self.n_slots)]
+            self._scratch = [np.empty(var.shape, var.dtype) for var in variables]
+        else:
+            dtype = max(variables, key=np.size).dtype if variables else np.float32
+            size, shapes = sum(var.size for var in variables), [var.shape for var in variables]
+            self._flat = np.empty(size, dtype)
+            self.variables = self._views(self._flat, shapes)
+            for view, var in zip(self.variables, variables):
+                view[...] = var
+            self._flat_grad = np.zeros(size, dtype)
+            self.grads = self._views(self._flat_grad, shapes)
+            self._flat_cache = [np.zeros(size, dtype) for _ in range(self.n_slots)]
+            slots = [self._views(cache, shapes) for cache in self._flat_cache]
+            self._flat_scratch = np.empty(size, dtype)
+            self._scratch = self._views(self._flat_scratch, shapes)
+        self._cache = slots[0] if self.n_slots == 1 else slots
+        return self.variables
+
+    def _slots(self, i):
+        if self.n_slots == 1:
+            return self._cache[i],
+        return tuple(cache[i] for cache in self._cache)
 
     @OptTiming.timeit(level=1, prefix="[API] ")
     def run(self, i, dw):
         return self._run(i, dw)
 
     def _run(self, i, dw):
-        raise NotImplementedError("Please implement a 'feed' method for your optimizer")
+        return self._step(dw, self._slots(i), self._scratch[i])
+
+    def _step(self, dw, slots, out):
+        raise NotImplementedError("Please implement a 'step' method for your optimizer")
+
+    def apply(self, i, param, dw, sign=1):
+        if sign > 0:
+            param += self._run(i, dw)
+        else:
+            param -= self._run(i, dw)
+        return param
+
+    def apply_all(self, sign=1, decay=None):
+        if self._flat is None:
+            raise ValueError("Variables should be fed with 'flatten=True' before calling 'apply_all'")
+        if decay is not None:
+            self._flat *= decay
+        step = self._step(self._flat_grad, tuple(self._flat_cache), self._flat_scratch)
+        if sign > 0:
+            self._flat += step
+        else:
+            self._flat -= step
+        return self._flat
 
     @OptTiming.timeit(level=4, prefix="[API] ")
     def update(self):
@@ -41,8 +132,8 @@ class Optimizer:
 
 
 class MBGD(Optimizer):
-    def _run(self, i, dw):
-        return self.lr * dw
+    def _step(self, dw, slots, out):
+        return np.multiply(dw, self.lr, out=out)
 
     def _update(self):
         pass
@@ -52,7 +143,7 @@ class Momentum(Optimizer):
     def __init__(self, lr=0.01, cache=None, epoch=100, floor=0.5, ceiling=0.999):
         Optimizer.__init__(self, lr, cache)
         self._epoch, self._floor, self._ceiling = epoch, floor, ceiling
-        self._step = (ceiling - floor) / epoch
+        self._step_size = (ceiling - floor) / epoch
         self._momentum = floor
         self._is_nesterov = False
 
@@ -68,8 +159,12 @@ class Momentum(Optimizer):
     def ceiling(self):
         return self._ceiling
 
+    @property
+    def n_slots(self):
+        return 2 if self._is_nesterov else 1
+
     def update_step(self):
-        self._step = (self._ceiling - self._floor) / self._epoch
+        self._step_size = (self._ceiling - self._floor) / self._epoch
 
     @epoch.setter
     def epoch(self, value):
@@ -86,18 +181,21 @@ class Momentum(Optimizer):
         self._ceiling = value
         self.update_step()
 
-    def _run(self, i, dw):
-        dw *= self.lr
-        velocity = self._cache
-        velocity[i] *= self._momentum
-        velocity[i] += dw
+    def _step(self, dw, slots, out):
+        velocity = slots[0]
+        np.multiply(dw, self.lr, out=out)
+        velocity *= self._momentum
+        velocity += out
         if not self._is_nesterov:
-            return velocity[i]
-        return self._momentum * velocity[i] + dw
+            return velocity
+        # The second slot is used as scratch space: momentum * velocity + lr * dw
+        np.multiply(velocity, self._momentum, out=slots[1])
+        out += slots[1]
+        return out
 
     def _update(self):
         if self._momentum < self._ceiling:
-            self._momentum += self._step
+            self._momentum += self._step_size
 
 
 class NAG(Momentum):
@@ -111,9 +209,17 @@ class RMSProp(Optimizer):
         Optimizer.__init__(self, lr, cache)
         self.decay_rate, self.eps = decay_rate, eps
 
-    def _run(self, i, dw):
-        self._cache[i] = self._cache[i] * self.decay_rate + (1 - self.decay_rate) * dw ** 2
-        return self.lr * dw / (np.sqrt(self._cache[i] + self.eps))
+    def _step(self, dw, slots, out):
+        cache = slots[0]
+        np.multiply(dw, dw, out=out)
+        out *= 1 - self.decay_rate
+        cache *= self.decay_rate
+        cache += out
+        np.add(cache, self.eps, out=out)
+        np.sqrt(out, out=out)
+        np.divide(dw, out, out=out)
+        out *= self.lr
+        return out
 
     def _update(self):
         pass
@@ -124,16 +230,24 @@ class Adam(Optimizer):
         Optimizer.__init__(self, lr, cache)
         self.beta1, self.beta2, self.eps = beta1, beta2, eps
 
-    def feed_variables(self, variables):
-        self._cache = [
-            [np.zeros(var.shape) for var in variables],
-            [np.zeros(var.shape) for var in variables],
-        ]
-
-    def _run(self, i, dw):
-        self._cache[0][i] = self._cache[0][i] * self.beta1 + (1 - self.beta1) * dw
-        self._cache[1][i] = self._cache[1][i] * self.beta2 + (1 - self.beta2) * (dw ** 2)
-        return self.lr * self._cache[0][i] / (np.sqrt(self._cache[1][i] + self.eps))
+    @property
+    def n_slots(self):
+        return 2
+
+    def _step(self, dw, slots, out):
+        m, v = slots
+        m *= self.beta1
+        np.multiply(dw, 1 - self.beta1, out=out)
+        m += out
+        v *= self.beta2
+        np.multiply(dw, dw, out=out)
+        out *= 1 - self.beta2
+        v += out
+        np.add(v, self.eps, out=out)
+        np.sqrt(out, out=out)
+        np.divide(m, out, out=out)
+        out *= self.lr
+        return out
 
     def _update(self):
         pass
@@ -146,11 +260,11 @@ class OptFactory:
         "MBGD": MBGD, "Momentum": Momentum, "NAG": NAG, "Adam": Adam, "RMSProp": RMSProp
     }
 
-    def get_optimizer_by_name(self, name, variables, lr, epoch):
+    def get_optimizer_by_name(self, name, variables, lr, epoch, flatten=False):
         try:
             optimizer = self.available_optimizers[name](lr)
             if variables is not None:
-                optimizer.feed_variables(variables)
+                optimizer.feed_variables(variables, flatten)
             if epoch is not None and isinstance(optimizer, Momentum):
                 optimizer.epoch = epoch
             return optimizer
@@ -13,6 +13,7 @@ from NN.TF.Layers import *
 
 from Util.Util import Util, VisUtil
 from Util.Bases import TFClassifierBase
+from Util.Batches import BatchPipeline
 from Util.ProgressBar import ProgressBar
 
 
@@ -823,6 +824,7 @@ class NNDist(NNBase):
                 train_writer, test_writer
             )
             ims = []
+            pipeline = BatchPipeline((x_train, y_train), batch_size) if train_repeat != 1 else None
             for counter in range(epoch):
                 if self.verbose >= NNVerbose.ITER and counter % record_period == 0:
                     sub_bar = ProgressBar(max_value=train_repeat * record_period - 1, name="Iteration")
@@ -830,7 +832,7 @@ class NNDist(NNBase):
                     sub_bar = None
                 self._batch_training(
                     x_train, y_train, batch_size, train_repeat,
-                    self._loss, self._train_step, sub_bar, counter, *args)
+                    self._loss, self._train_step, sub_bar, counter, *args, pipeline=pipeline)
                 self._handle_animation(
                     counter, x, y, ims, animation_params, *animation_properties,
                     img=self._draw_2d_network(**animation_params), name="Neural Network"
@@ -844,6 +846,8 @@ class NNDist(NNBase):
                             self._print_metric_logs("Test", show_loss)
                     if self.verbose >= NNVerbose.EPOCH:
                         bar.update(counter // record_period + 1)
+            if pipeline is not None:
+                pipeline.close()
         if img is not None:
             cv2.waitKey(0)
             cv2.destroyAllWindows()
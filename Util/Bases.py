@@ -2,18 +2,24 @@ import io
 import cv2
 import time
 import math
-import ctypes
+import queue
+import atexit
+import threading
 import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import tensorflow as tf
 import matplotlib.pyplot as plt
 from PIL import Image
-from multiprocessing import Pool
+from multiprocessing import Pool, shared_memory, resource_tracker
 from mpl_toolkits.mplot3d import Axes3D
 
 from NN.Basic.Optimizers import OptFactory
 
 from Util.Util import VisUtil
+from Util.Batches import BatchPipeline
+from Util.Events import Events, QueueSink
 from Util.Timing import Timing
 from Util.ProgressBar import ProgressBar
 
@@ -214,6 +220,141 @@ class ModelBase:
         pass
 
 
+class SharedPool:
+    """
+        Long-lived worker pool used by ClassifierBase._multi_clf & ClassifierBase._multi_data
+        1) One pool per (n_cores, models), the 'max_pools' most recently used ones are kept alive so
+           alternating between models does not respawn workers
+           (models & their attributes are compared by identity, so refitting a model in place also counts;
+            the pool keeps them alive so ids cannot be recycled)
+        2) Models are loaded into every worker once (pool initializer)
+        3) Input batches are written into one reusable shared memory block,
+           workers only receive (name, shape, dtype) & the slice they should handle
+        4) While Events is observed, workers record their events through a QueueSink, send them back
+           with their results & the parent re-emits them with Events.drain;
+           likewise, while Timing is enabled, workers send back a Timing.snapshot which is merged by the parent
+    """
+
+    pools = OrderedDict()
+    max_pools = 4
+    _models = None
+    _blocks = {}
+
+    def __init__(self, n_cores, models, key):
+        self.n_cores, self.key = n_cores, key
+        self.models = [list(getattr(model, "__dict__", {}).values()) for model in (
+            models if isinstance(models, (list, tuple)) else [models])], models
+        resource_tracker.ensure_running()
+        self.pool = Pool(processes=n_cores, initializer=SharedPool._init_worker, initargs=(models,))
+        self.shm = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(models):
+        if not isinstance(models, (list, tuple)):
+            models = [models]
+        return tuple((id(model),) + tuple(map(id, getattr(model, "__dict__", {}).values())) for model in models)
+
+    @staticmethod
+    def get(n_cores, models):
+        key = (n_cores, SharedPool.get_key(models))
+        pool = SharedPool.pools.get(key)
+        if pool is not None:
+            SharedPool.pools.move_to_end(key)
+            return pool
+        pool = SharedPool.pools[key] = SharedPool(n_cores, models, key)
+        while len(SharedPool.pools) > max(1, SharedPool.max_pools):
+            SharedPool.pools.popitem(last=False)[1].close()
+        return pool
+
+    @staticmethod
+    def close_all():
+        for pool in SharedPool.pools.values():
+            pool.close()
+        SharedPool.pools = OrderedDict()
+
+    @staticmethod
+    def _init_worker(models):
+        SharedPool._models, SharedPool._blocks = models, {}
+
+    @staticmethod
+    def _attach(name):
+        shm = SharedPool._blocks.get(name)
+        if shm is None:
+            for old in SharedPool._blocks.values():
+                old.close()
+            shm = shared_memory.SharedMemory(name=name)
+            SharedPool._blocks = {name: shm}
+        return shm
+
+    @staticmethod
+    def _task(task, x, start, end, by_rows, n_cores):
+        if by_rows:
+            return task((x[start:end], SharedPool._models, n_cores))
+        return task((x, SharedPool._models[start:end], n_cores))
+
+    @staticmethod
+    def _run(args):
+        task, (name, shape, dtype), (start, end), by_rows, n_cores, observed, timed = args
+        x = np.ndarray(shape, dtype, buffer=SharedPool._attach(name).buf)
+        if timed:
+            # Only the timings of this task are sent back, the parent merges them into its own
+            Timing.enabled = True
+            Timing.reset()
+        if not observed:
+            rs, events = SharedPool._task(task, x, start, end, by_rows, n_cores), None
+        else:
+            event_queue = queue.Queue()
+            Events.sinks = [QueueSink(event_queue)]
+            Events.reset()
+            try:
+                with Events.timer("pool.task"):
+                    rs = SharedPool._task(task, x, start, end, by_rows, n_cores)
+                Events.count("pool.rows" if by_rows else "pool.models", end - start)
+                Events.flush()
+            finally:
+                Events.sinks = []
+            events = list(event_queue.queue)
+        return rs, events, Timing.snapshot() if timed else None
+
+    def _put(self, x):
+        if self.shm is None or self.shm.size < x.nbytes:
+            self._release()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(x.nbytes, 1))
+        np.ndarray(x.shape, x.dtype, buffer=self.shm.buf)[...] = x
+        return self.shm.name, x.shape, x.dtype.str
+
+    def _release(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def map(self, task, x, slices, n_cores, by_rows):
+        observed, timed = Events.observed(), Timing.enabled
+        with self.lock:
+            info = self._put(x)
+            results = self.pool.map(SharedPool._run, [
+                (task, info, s, by_rows, n_cores, observed, timed) for s in slices])
+        if observed:
+            events = queue.Queue()
+            for _, worker_events, _ in results:
+                for event in worker_events or []:
+                    events.put(event)
+            Events.drain(events)
+        for _, _, timings in results:
+            if timings:
+                Timing.merge(timings)
+        return [rs for rs, _, _ in results]
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        self._release()
+
+atexit.register(SharedPool.close_all)
+
+
 class ClassifierBase(ModelBase):
     """
         Base for classifiers
@@ -250,7 +391,12 @@ class ClassifierBase(ModelBase):
 
     # Parallelization
 
-    # noinspection PyUnusedLocal
+    @staticmethod
+    def _get_slices(n, n_cores):
+        n_batch = max(1, min(n_cores, n))
+        bounds = [i * n // n_batch for i in range(n_batch + 1)]
+        return list(zip(bounds[:-1], bounds[1:]))
+
     @staticmethod
     def _multi_clf(x, clfs, task, kwargs, stack=np.vstack, target="single"):
         if target != "parallel":
@@ -258,51 +404,21 @@ class ClassifierBase(ModelBase):
         n_cores = kwargs.get("n_cores", 2)
         n_cores = multiprocessing.cpu_count() if n_cores <= 0 else n_cores
         if n_cores == 1:
-            matrix = np.array([clf.predict(x, n_cores=1) for clf in clfs], dtype=np.float32).T
-        else:
-            pool = Pool(processes=n_cores)
-            batch_size = int(len(clfs) / n_cores)
-            clfs = [clfs[i*batch_size:(i+1)*batch_size] for i in range(n_cores)]
-            x_size = np.prod(x.shape)  # type: int
-            shared_base = multiprocessing.Array(ctypes.c_float, int(x_size))
-            shared_matrix = np.ctypeslib.as_array(shared_base.get_obj()).reshape(x.shape)
-            shared_matrix[:] = x
-            matrix = stack(
-                pool.map(task, ((shared_matrix, clfs, n_cores) for clfs in clfs))
-            ).T.astype(np.float32)
-        return matrix
-
-    # noinspection PyUnusedLocal
+            return np.array([clf.predict(x, n_cores=1) for clf in clfs], dtype=np.float32).T
+        pool = SharedPool.get(n_cores, clfs)
+        slices = ClassifierBase._get_slices(len(clfs), n_cores)
+        return stack(pool.map(task, np.asarray(x), slices, n_cores, False)).T.astype(np.float32)
+
     def _multi_data(self, x, task, kwargs, stack=np.hstack, target="single"):
         if target != "parallel":
             return task((x, self, 1))
         n_cores = kwargs.get("n_cores", 2)
         n_cores = multiprocessing.cpu_count() if n_cores <= 0 else n_cores
         if n_cores == 1:
-            matrix = task((x, self, n_cores))
-        else:
-            pool = Pool(processes=n_cores)
-            batch_size = int(len(x) / n_cores)
-            batch_base, batch_data, cursor = [], [], 0
-            x_dim = x.shape[1]
-            for i in range(n_cores):
-                if i == n_cores - 1:
-                    batch_data.append(x[cursor:])
-                    batch_base.append(multiprocessing.Array(ctypes.c_float, (len(x) - cursor) * x_dim))
-                else:
-                    batch_data.append(x[cursor:cursor + batch_size])
-                    batch_base.append(multiprocessing.Array(ctypes.c_float, batch_size * x_dim))
-                cursor += batch_size
-            shared_arrays = [
-                np.ctypeslib.as_array(shared_base.get_obj()).reshape(-1, x_dim)
-                for shared_base in batch_base
-            ]
-            for i, data in enumerate(batch_data):
-                shared_arrays[i][:] = data
-            matrix = stack(
-                pool.map(task, ((x, self, n_cores) for x in shared_arrays))
-            )
-        return matrix.astype(np.float32)
+            return task((x, self, n_cores))
+        pool = SharedPool.get(n_cores, self)
+        slices = ClassifierBase._get_slices(len(x), n_cores)
+        return stack(pool.map(task, np.asarray(x), slices, n_cores, True))
 
     # Training
 
@@ -651,19 +767,19 @@ class GDBase(ClassifierBase):
                 param -= self._optimizer.run(i, grad)
 
     @GDBaseTiming.timeit(level=1, prefix="[Core] ")
-    def _batch_training(self, x, y, batch_size, train_repeat, *args, **kwargs):
+    def _batch_training(self, x, y, batch_size, train_repeat, *args, pipeline=None, **kwargs):
         sample_weight, *args = args
         epoch_loss = 0
-        for i in range(train_repeat):
-            if train_repeat != 1:
-                batch = np.random.permutation(len(x))[:batch_size]
-                x_batch, y_batch = x[batch], y[batch]
-                sample_weight_batch = sample_weight[batch]
-            else:
-                x_batch, y_batch, sample_weight_batch = x, y, sample_weight
-            y_pred = self.predict(x_batch, get_raw_results=True, **kwargs)
-            epoch_loss += self._get_grads(x_batch, y_batch, y_pred, sample_weight_batch, *args)
-            self._update_model_params()
+        if train_repeat != 1:
+            batches = pipeline.take(train_repeat)
+        else:
+            batches = [(x, y, sample_weight)]
+        for i, (x_batch, y_batch, sample_weight_batch) in enumerate(batches):
+            with Events.timer("train.step"):
+                y_pred = self.predict(x_batch, get_raw_results=True, **kwargs)
+                epoch_loss += self._get_grads(x_batch, y_batch, y_pred, sample_weight_batch, *args)
+                self._update_model_params()
+            Events.count("train.samples", len(x_batch))
             self._batch_work(i, *args)
         return epoch_loss / train_repeat
 
@@ -684,18 +800,19 @@ class TFClassifierBase(ClassifierBase):
 
 
     @clf_timing.timeit(level=2, prefix="[Core] ")
-    def _batch_training(self, x, y, batch_size, train_repeat, *args):
+    def _batch_training(self, x, y, batch_size, train_repeat, *args, pipeline=None):
         loss, train_step, *args = args
         epoch_cost = 0
-        for i in range(train_repeat):
-            if train_repeat != 1:
-                batch = np.random.choice(len(x), batch_size)
-                x_batch, y_batch = x[batch], y[batch]
-            else:
-                x_batch, y_batch = x, y
-            epoch_cost += self._sess.run([loss, train_step], {
-                self._tfx: x_batch, self._tfy: y_batch
-            })[0]
+        if train_repeat != 1:
+            batches = pipeline.take(train_repeat)
+        else:
+            batches = [(x, y)]
+        for i, (x_batch, y_batch) in enumerate(batches):
+            with Events.timer("train.step"):
+                epoch_cost += self._sess.run([loss, train_step], {
+                    self._tfx: x_batch, self._tfy: y_batch
+                })[0]
+            Events.count("train.samples", len(x_batch))
             self._batch_work(i, *args)
         return epoch_cost / train_repeat
 
@@ -777,6 +894,44 @@ else:
     TorchBasicClassifierBase = TorchAutoClassifierBase = None
 
 
+class KernelCache:
+    """
+        Gram matrix whose rows are computed on demand and kept in an LRU cache bounded by cache_size (MB)
+        Supports the access patterns of the SMO-like models: gram[i], gram[i][j], gram[indices, ...] & len(gram)
+    """
+
+    def __init__(self, x, kernel, cache_size=200, block_size=256):
+        self._x, self._kernel = x, kernel
+        self._rows = OrderedDict()
+        self.capacity = max(2, int(cache_size * 2 ** 20) // (8 * len(x)))
+        self.hits = self.misses = 0
+        self.diag = np.concatenate([
+            np.diag(kernel(x[i:i + block_size], x[i:i + block_size])) for i in range(0, len(x), block_size)])
+
+    def __len__(self):
+        return len(self._x)
+
+    def _get_rows(self, indices):
+        missing = [i for i in indices if i not in self._rows]
+        self.misses += len(missing)
+        self.hits += len(indices) - len(missing)
+        if missing:
+            for i, row in zip(missing, self._kernel(self._x[missing], self._x)):
+                self._rows[i] = row
+        rs = []
+        for i in indices:
+            self._rows.move_to_end(i)
+            rs.append(self._rows[i])
+        while len(self._rows) > max(self.capacity, len(indices)):
+            self._rows.popitem(last=False)
+        return rs
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            return np.array(self._get_rows([int(i) for i in item[0]]))
+        return self._get_rows([int(item)])[0]
+
+
 class KernelBase(ClassifierBase):
     """ Kernel classifier with SMO-like algorithm """
 
@@ -790,7 +945,10 @@ class KernelBase(ClassifierBase):
         self._x = self._y = self._gram = None
         self._w = self._b = self._alpha = None
         self._kernel = self._kernel_name = self._kernel_param = None
+        self._kernel_memory = None
         self._prediction_cache = self._dw_cache = self._db_cache = None
+        self._lazy_gram, self._active = False, None
+        self._pipeline = None
 
         self._params["kernel"] = kwargs.get("kernel", "rbf")
         self._params["epoch"] = kwargs.get("epoch", 10 ** 4)
@@ -800,6 +958,10 @@ class KernelBase(ClassifierBase):
         self._params["c"] = kwargs.get("c", 1)
         self._params["p"] = kwargs.get("p", 3)
         self._params["lr"] = kwargs.get("lr", 0.001)
+        self._params["cache_size"] = kwargs.get("cache_size", 200)
+        self._params["kernel_dtype"] = kwargs.get("kernel_dtype", np.float64)
+        self._params["kernel_memory"] = kwargs.get("kernel_memory", 64)
+        self._params["kernel_jobs"] = kwargs.get("kernel_jobs", 1)
 
     @property
     def title(self):
@@ -807,15 +969,52 @@ class KernelBase(ClassifierBase):
 
     # Kernel
 
+    @staticmethod
+    def _kernel_blocks(x, y, transform, dtype=np.float64, memory=64, n_jobs=1):
+        x, y = np.asarray(x, dtype), np.asarray(y, dtype)
+        rs = np.empty((len(x), len(y)), dtype)
+        step = max(1, int(memory * 2 ** 20) // (rs.itemsize * max(1, len(y))))
+
+        def task(start):
+            block = rs[start:start + step]
+            np.dot(x[start:start + step], y.T, out=block)
+            transform(block, start)
+
+        starts = range(0, len(x), step)
+        if n_jobs > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(n_jobs) as executor:
+                list(executor.map(task, starts))
+        else:
+            for start in starts:
+                task(start)
+        return rs
+
     @staticmethod
     @KernelBaseTiming.timeit(level=1, prefix="[Kernel] ")
-    def _poly(x, y, p):
-        return (x.dot(y.T) + 1) ** p
+    def _poly(x, y, p, **kwargs):
+        def transform(block, start):
+            block += 1
+            np.power(block, p, out=block)
+
+        return KernelBase._kernel_blocks(x, y, transform, **kwargs)
 
     @staticmethod
     @KernelBaseTiming.timeit(level=1, prefix="[Kernel] ")
-    def _rbf(x, y, gamma):
-        return np.exp(-gamma * np.sum((x[..., None, :] - y) ** 2, axis=2))
+    def _rbf(x, y, gamma, **kwargs):
+        dtype = kwargs.get("dtype", np.float64)
+        x, y = np.asarray(x, dtype), np.asarray(y, dtype)
+        x_norm, y_norm = np.einsum("ij,ij->i", x, x), np.einsum("ij,ij->i", y, y)
+
+        # ||x - y||^2 = ||x||^2 + ||y||^2 - 2xy, so no (n, m, d) difference tensor is needed
+        def transform(block, start):
+            block *= -2
+            block += x_norm[start:start + len(block), None]
+            block += y_norm
+            np.maximum(block, 0, out=block)
+            block *= -gamma
+            np.exp(block, out=block)
+
+        return KernelBase._kernel_blocks(x, y, transform, **kwargs)
 
     # Training
 
@@ -827,6 +1026,14 @@ class KernelBase(ClassifierBase):
 
     @KernelBaseTiming.timeit(level=1, prefix="[Core] ")
     def _update_pred_cache(self, *args):
+        if self._active is not None:
+            # Only the active set is kept up to date, the rest is rebuilt when shrinking is undone
+            if len(args) == 1:
+                delta = self._dw_cache * self._gram[args[0]][self._active]
+            else:
+                delta = self._dw_cache.dot(self._gram[args, ...][..., self._active])
+            self._prediction_cache[self._active] += delta + self._db_cache
+            return
         self._prediction_cache += self._db_cache
         if len(args) == 1:
             self._prediction_cache += self._dw_cache * self._gram[args[0]]
@@ -835,6 +1042,13 @@ class KernelBase(ClassifierBase):
         else:
             self._prediction_cache += self._dw_cache.dot(self._gram[args, ...])
 
+    @KernelBaseTiming.timeit(level=1, prefix="[Core] ")
+    def _refresh_pred_cache(self):
+        sv = np.flatnonzero(self._w)
+        self._prediction_cache = np.full(len(self._y), float(self._b))
+        for i in range(0, len(sv), 256):
+            self._prediction_cache += self._w[sv[i:i + 256]].dot(self._gram[sv[i:i + 256], ...])
+
     def _prepare(self, sample_weight, **kwargs):
         pass
 
@@ -861,16 +1075,22 @@ class KernelBase(ClassifierBase):
             metrics = self._params["metrics"]  # type: list
         *animation_properties, animation_params = self._get_animation_params(animation_params)
         self._x, self._y = np.atleast_2d(x), np.asarray(y)
+        kernel_kwargs = {
+            "dtype": kwargs.get("kernel_dtype", self._params["kernel_dtype"]),
+            "memory": kwargs.get("kernel_memory", self._params["kernel_memory"]),
+            "n_jobs": kwargs.get("kernel_jobs", self._params["kernel_jobs"])
+        }
+        self._kernel_memory = kernel_kwargs["memory"]
         if kernel == "poly":
             _p = kwargs.get("p", self._params["p"])
             self._kernel_name = "Polynomial"
             self._kernel_param = "degree = {}".format(_p)
-            self._kernel = lambda _x, _y: KernelBase._poly(_x, _y, _p)
+            self._kernel = lambda _x, _y: KernelBase._poly(_x, _y, _p, **kernel_kwargs)
         elif kernel == "rbf":
             _gamma = kwargs.get("gamma", 1 / self._x.shape[1])
             self._kernel_name = "RBF"
             self._kernel_param = r"$\gamma = {:8.6}$".format(_gamma)
-            self._kernel = lambda _x, _y: KernelBase._rbf(_x, _y, _gamma)
+            self._kernel = lambda _x, _y: KernelBase._rbf(_x, _y, _gamma, **kernel_kwargs)
         else:
             raise NotImplementedError("Kernel '{}' has not defined".format(kernel))
         if sample_weight is None:
@@ -880,8 +1100,13 @@ class KernelBase(ClassifierBase):
 
         self._alpha, self._w, self._prediction_cache = (
             np.zeros(len(x)), np.zeros(len(x)), np.zeros(len(x)))
-        self._gram = self._kernel(self._x, self._x)
+        cache_size = kwargs.get("cache_size", self._params["cache_size"])
+        if self._lazy_gram and 8 * len(x) ** 2 > cache_size * 2 ** 20:
+            self._gram = KernelCache(self._x, self._kernel, cache_size)
+        else:
+            self._gram = self._kernel(self._x, self._x)
         self._b = 0
+        self._active = self._pipeline = None
         self._prepare(sample_weight, **kwargs)
 
         fit_args, logs, ims = [], [], []
@@ -927,16 +1152,35 @@ class KernelBase(ClassifierBase):
                 logs.append(local_logs)
             self._handle_animation(i, self._x, self._y, ims, animation_params, *animation_properties)
             bar.update()
+        if self._pipeline is not None:
+            self._pipeline.close()
+            self._pipeline = None
+        Events.flush()
         self._handle_mp4(ims, animation_properties)
         return logs
 
     # Util
 
+    @KernelBaseTiming.timeit(level=1, prefix="[Util] ")
+    def _kernel_dot(self, weights, x):
+        # Only support vectors (nonzero weights) contribute, and x is processed in blocks within the memory budget
+        x = np.atleast_2d(x)
+        sv = np.flatnonzero(weights)
+        rs = np.zeros(len(x))
+        if not len(sv):
+            return rs
+        x_sv, w_sv = self._x[sv], weights[sv]
+        step = max(1, int(self._kernel_memory * 2 ** 20) // (8 * len(sv)))
+        for i in range(0, len(x), step):
+            rs[i:i + step] = w_sv.dot(self._kernel(x_sv, x[i:i + step]))
+        return rs
+
     @KernelBaseTiming.timeit(level=1, prefix="[API] ")
     def predict(self, x, get_raw_results=False, gram_provided=False):
         if not gram_provided:
-            x = self._kernel(self._x, np.atleast_2d(x))
-        y_pred = self._w.dot(x) + self._b
+            y_pred = self._kernel_dot(self._w, x) + self._b
+        else:
+            y_pred = self._w.dot(x) + self._b
         if not get_raw_results:
             return np.sign(y_pred)
         return y_pred
@@ -967,9 +1211,11 @@ class GDKernelBase(KernelBase, GDBase):
     def _fit(self, sample_weight, tol):
         if self._train_repeat == 0:
             self._train_repeat = self._get_train_repeat(self._x, self._batch_size)
+        if self._pipeline is None and self._train_repeat != 1:
+            self._pipeline = BatchPipeline((self._gram, self._y, sample_weight), self._batch_size)
         l = self._batch_training(
             self._gram, self._y, self._batch_size, self._train_repeat,
-            sample_weight, gram_provided=True
+            sample_weight, gram_provided=True, pipeline=self._pipeline
         )
         if l < tol:
             return True
@@ -977,10 +1223,11 @@ class GDKernelBase(KernelBase, GDBase):
     @GDKernelBaseTiming.timeit(level=1, prefix="[API] ")
     def predict(self, x, get_raw_results=False, gram_provided=False):
         if not gram_provided:
-            x = self._kernel(self._x, np.atleast_2d(x))
-        elif self._alpha.shape[0] != x.shape[0]:
-            x = x.T
-        y_pred = (self._alpha.dot(x) + self._b).ravel()
+            y_pred = (self._kernel_dot(self._alpha, x) + self._b).ravel()
+        else:
+            if self._alpha.shape[0] != x.shape[0]:
+                x = x.T
+            y_pred = (self._alpha.dot(x) + self._b).ravel()
         if not get_raw_results:
             return np.sign(y_pred)
         return y_pred
@@ -0,0 +1,186 @@
+import os
+import queue
+import threading
+import numpy as np
+
+
+class Gatherer:
+    """ Fills pipeline buffers; kept apart from BatchPipeline so the worker thread does not keep it alive """
+
+    _stop = object()
+
+    def __init__(self, sources, batch_size, shuffle, n_buffers, seed):
+        self.generator = len(sources) == 1 and not isinstance(sources[0], (np.ndarray, str))
+        if self.generator:
+            self.sources, self.n_rows = sources[0], None
+            self.buffers = [None] * n_buffers
+        else:
+            self.sources = [np.load(src, mmap_mode="r") if isinstance(src, str) else src for src in sources]
+            self.n_rows = len(next(src for src in self.sources if src is not None))
+            batch_size = min(batch_size, self.n_rows)
+            self.buffers = [[
+                None if src is None else np.empty((batch_size,) + src.shape[1:], src.dtype)
+                for src in self.sources
+            ] for _ in range(n_buffers)]
+        self._mapped = not self.generator and any(isinstance(src, np.memmap) for src in self.sources)
+        self.batch_size, self._shuffle = batch_size, shuffle
+        self._random = np.random.default_rng(np.random.randint(2 ** 31) if seed is None else seed)
+        self._order, self._cursor, self._iterator = None, 0, None
+
+    def _indices(self):
+        indices, size = [], self.batch_size
+        while size > 0:
+            if self._order is None or self._cursor >= self.n_rows:
+                if self._shuffle:
+                    self._order = self._random.permutation(self.n_rows)
+                else:
+                    self._order = np.arange(self.n_rows)
+                self._cursor = 0
+            chunk = self._order[self._cursor:self._cursor + size]
+            self._cursor += len(chunk)
+            size -= len(chunk)
+            indices.append(chunk)
+        return indices[0] if len(indices) == 1 else np.concatenate(indices)
+
+    def _next_item(self):
+        while True:
+            if self._iterator is None:
+                self._iterator = iter(self.sources() if callable(self.sources) else self.sources)
+            try:
+                return next(self._iterator)
+            except StopIteration:
+                if not callable(self.sources):
+                    return Gatherer._stop
+                self._iterator = None
+
+    def fill(self, i):
+        if self.generator:
+            item = self._next_item()
+            if item is Gatherer._stop:
+                return False
+            self.buffers[i] = item
+            return True
+        indices = self._indices()
+        if self._mapped:
+            # Memory-mapped rows are read in file order, & every source has to follow the same order
+            indices = np.sort(indices)
+        for src, buffer in zip(self.sources, self.buffers[i]):
+            if src is None:
+                continue
+            if isinstance(src, np.memmap):
+                buffer[...] = src[indices]
+            else:
+                # Indices are always in range, & 'clip' lets take write into the buffer without a temporary
+                np.take(src, indices, axis=0, out=buffer, mode="clip")
+        return True
+
+    def work(self, free, ready):
+        while True:
+            i = free.get()
+            if i is None:
+                return
+            try:
+                if not self.fill(i):
+                    ready.put((Gatherer._stop, None))
+                    return
+            except Exception as err:
+                ready.put((None, err))
+                return
+            ready.put((i, None))
+
+
+class BatchPipeline:
+    """
+        Mini-batch pipeline
+        1) Array sources (NumPy arrays or paths to '.npy' files, which are memory-mapped) are read as a
+           stream of shuffled passes without replacement and gathered into preallocated buffers
+        2) Generator sources (an iterator, or a callable returning one per pass) are consumed as they are
+        3) With prefetch=True a background thread fills the next buffer while the current one is used;
+           a batch is a view of its buffer, so it is only valid until the next batch is drawn
+        4) prefetch=None enables the thread only when more than one core is available, since on a
+           single core the hand-off costs more than the gather it hides
+    """
+
+    def __init__(self, sources, batch_size=128, shuffle=True, n_buffers=2, prefetch=None, seed=None):
+        self._single = not isinstance(sources, (tuple, list))
+        if self._single:
+            sources = (sources,)
+        self._gatherer = Gatherer(sources, batch_size, shuffle, max(1, n_buffers), seed)
+        self._current = self._thread = None
+        self._free, self._ready = queue.Queue(), queue.Queue()
+        for i in range(len(self._gatherer.buffers)):
+            self._free.put(i)
+        self._closed = False
+        if prefetch is None:
+            prefetch = (os.cpu_count() or 1) > 1
+        if prefetch:
+            self._thread = threading.Thread(
+                target=self._gatherer.work, args=(self._free, self._ready), daemon=True)
+            self._thread.start()
+
+    @property
+    def batch_size(self):
+        return self._gatherer.batch_size
+
+    @property
+    def n_rows(self):
+        return self._gatherer.n_rows
+
+    @property
+    def batches_per_pass(self):
+        if self.n_rows is None:
+            return None
+        return int(np.ceil(self.n_rows / self.batch_size))
+
+    def _batch(self, i):
+        if self._gatherer.generator:
+            return self._gatherer.buffers[i]
+        batch = tuple(self._gatherer.buffers[i])
+        return batch[0] if self._single else batch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        if self._thread is None:
+            if not self._gatherer.fill(0):
+                raise StopIteration
+            return self._batch(0)
+        if self._current is not None:
+            self._free.put(self._current)
+            self._current = None
+        i, err = self._ready.get()
+        if err is not None:
+            self.close()
+            raise err
+        if i is Gatherer._stop:
+            self.close()
+            raise StopIteration
+        self._current = i
+        return self._batch(i)
+
+    def take(self, n):
+        for _ in range(n):
+            try:
+                yield next(self)
+            except StopIteration:
+                return
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            self._free.put(None)
+            self._thread.join(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,175 @@
+import sys
+import json
+import time
+import queue
+import threading
+from contextlib import contextmanager
+
+
+class Events:
+    """
+        Training event bus
+        1) Events are plain dicts with a 'kind' key, sinks are callables which receive them
+        2) Nothing is recorded or formatted while no sink is attached, so counters & timers
+           sprinkled in hot loops cost a single check when unobserved
+        3) Worker processes attach a QueueSink & the parent re-emits their events with Events.drain
+           (SharedPool does so for every task while the parent is observed)
+        4) Trainers time each step as 'train.step', count 'train.samples' & flush the metrics after fit
+    """
+
+    sinks = []
+    counters = {}
+    timers = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def observed(cls):
+        return bool(cls.sinks)
+
+    @classmethod
+    def add_sink(cls, sink):
+        cls.sinks.append(sink)
+        return sink
+
+    @classmethod
+    def remove_sink(cls, sink):
+        if sink in cls.sinks:
+            cls.sinks.remove(sink)
+
+    @classmethod
+    def emit(cls, kind, **payload):
+        if not cls.sinks:
+            return
+        payload["kind"] = kind
+        for sink in cls.sinks:
+            sink(payload)
+
+    @classmethod
+    def count(cls, name, value=1):
+        if not cls.sinks:
+            return
+        with cls._lock:
+            cls.counters[name] = cls.counters.get(name, 0) + value
+
+    @classmethod
+    @contextmanager
+    def timer(cls, name):
+        if not cls.sinks:
+            yield
+            return
+        _t = time.perf_counter()
+        try:
+            yield
+        finally:
+            _t = time.perf_counter() - _t
+            with cls._lock:
+                count, total = cls.timers.get(name, (0, 0.))
+                cls.timers[name] = (count + 1, total + _t)
+
+    @classmethod
+    def flush(cls):
+        if not cls.sinks:
+            return
+        with cls._lock:
+            counters, timers = dict(cls.counters), dict(cls.timers)
+        cls.emit("metrics", counters=counters, timers={
+            key: {"count": count, "total": total} for key, (count, total) in timers.items()})
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls.counters, cls.timers = {}, {}
+
+    @classmethod
+    def drain(cls, event_queue, block=False, timeout=None):
+        n_events = 0
+        while True:
+            try:
+                event = event_queue.get(block, timeout)
+            except queue.Empty:
+                return n_events
+            n_events += 1
+            if event.get("kind") == "metrics":
+                with cls._lock:
+                    for key, value in event["counters"].items():
+                        cls.counters[key] = cls.counters.get(key, 0) + value
+                    for key, value in event["timers"].items():
+                        count, total = cls.timers.get(key, (0, 0.))
+                        cls.timers[key] = (count + value["count"], total + value["total"])
+            kind = event.pop("kind", "event")
+            cls.emit(kind, **event)
+            block = False
+
+
+class TerminalSink:
+    def __init__(self, stream=None):
+        self._stream = stream
+
+    @staticmethod
+    def _split(cost):
+        hour = int(cost / 3600)
+        return hour, int((cost - hour * 3600) / 60), cost % 60
+
+    def __call__(self, event):
+        if event["kind"] != "progress":
+            return
+        stream = sys.stdout if self._stream is None else self._stream
+        name = " " if not event["name"] else " # {:^12s} # ".format(event["name"])
+        counter, cost = event["counter"], event["cost"]
+        if event["finished"]:
+            avg = cost / max(1, counter)
+            stream.write(
+                "\r" +
+                "##{}({:d} : {:d} -> {:d}) Task Finished. "
+                "Time Cost: {:3d} h {:3d} min {:6.4} s; Average: {:3d} h {:3d} min {:6.4} s ".format(
+                    name, event["total"], event["min"], counter, *self._split(cost), *self._split(avg)
+                ) + " ##\n"
+            )
+        elif not counter:
+            stream.write("\n##{}Progress bar initialized  ##".format(name))
+        else:
+            passed = int((event["min"] + counter) * event["width"] / event["max"])
+            stream.write(
+                "\r" + "##{}[".format(name) + "-" * passed + " " * (event["width"] - passed) +
+                "] : {} / {}".format(event["min"] + counter, event["max"]) +
+                " ##  Time Cost: {:3d} h {:3d} min {:6.4} s; Average: {:3d} h {:3d} min {:6.4} s ".format(
+                    *self._split(cost), *self._split(cost / counter))
+            )
+        stream.flush()
+
+
+class JSONLinesSink:
+    def __init__(self, path, mode="a"):
+        self._file = open(path, mode)
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(dict(event, time=time.time()), default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class MemorySink:
+    def __init__(self, kinds=None):
+        self.kinds = kinds
+        self.events = []
+
+    def __call__(self, event):
+        if self.kinds is None or event["kind"] in self.kinds:
+            self.events.append(dict(event))
+
+    def progress(self, name=None):
+        return [event for event in self.events if event["kind"] == "progress" and (
+            name is None or event["name"] == name)]
+
+
+class QueueSink:
+    def __init__(self, event_queue):
+        self._queue = event_queue
+
+    def __call__(self, event):
+        self._queue.put(dict(event))
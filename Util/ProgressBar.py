@@ -1,7 +1,18 @@
 import time
 
+from Util.Events import Events, TerminalSink
+
 
 class ProgressBar:
+    """
+        Progress reporter which emits 'progress' events to ProgressBar.sinks & Events.sinks
+        1) The terminal bar is just the default sink, set ProgressBar.sinks = [] to silence every bar
+        2) update() only reads the clock every few calls (the stride doubles while updates come fast
+           & shrinks once a refresh is overdue), and does nothing but counting while no sink is attached
+    """
+
+    sinks = [TerminalSink()]
+
     def __init__(self, min_value=0, max_value=None, min_refresh_period=0.5, width=30, name="", start=True):
         self._min, self._max = min_value, max_value
         self._task_length = int(max_value - min_value) if (
@@ -10,16 +21,31 @@ class ProgressBar:
         self._counter = min_value
         self._min_period = min_refresh_period
         self._bar_width = int(width)
-        self._bar_name = " " if not name else " # {:^12s} # ".format(name)
+        self._name = name
         self._terminated = False
         self._started = False
         self._ended = False
         self._current = 0
         self._clock = 0
         self._cost = 0
+        self._stride, self._next_check = 1, 0
         if start:
             self.start()
 
+    @staticmethod
+    def _observed():
+        return bool(ProgressBar.sinks) or Events.observed()
+
+    def _emit(self, finished=False):
+        event = {
+            "kind": "progress", "name": self._name, "counter": self._counter - self._min,
+            "total": self._task_length, "min": self._min, "max": self._max,
+            "width": self._bar_width, "cost": self._cost, "finished": finished
+        }
+        for sink in ProgressBar.sinks:
+            sink(event)
+        Events.emit(**event)
+
     def _flush(self):
         if self._ended:
             return False
@@ -29,59 +55,35 @@ class ProgressBar:
         if self._terminated:
             if self._counter == self._min:
                 self._counter = self._min + 1
-            self._cost = time.time() - self._clock
-            tmp_hour = int(self._cost / 3600)
-            tmp_min = int((self._cost - tmp_hour * 3600) / 60)
-            tmp_sec = self._cost % 60
-            tmp_avg = self._cost / (self._counter - self._min)
-            tmp_avg_hour = int(tmp_avg / 3600)
-            tmp_avg_min = int((tmp_avg - tmp_avg_hour * 3600) / 60)
-            tmp_avg_sec = tmp_avg % 60
-            print(
-                "\r" +
-                "##{}({:d} : {:d} -> {:d}) Task Finished. "
-                "Time Cost: {:3d} h {:3d} min {:6.4} s; Average: {:3d} h {:3d} min {:6.4} s ".format(
-                    self._bar_name, self._task_length, self._min, self._counter - self._min,
-                    tmp_hour, tmp_min, tmp_sec, tmp_avg_hour, tmp_avg_min, tmp_avg_sec
-                ) + " ##\n", end=""
-            )
             self._ended = True
+            if not self._observed():
+                return False
+            self._cost = time.perf_counter() - self._clock
+            self._emit(True)
             return True
         if self._counter >= self._max:
             self._terminated = True
             return self._flush()
-        if self._counter != self._min and time.time() - self._current <= self._min_period:
+        # The clock is read at the same adaptive stride while nothing is attached,
+        # so a sink attached mid-loop is picked up within about one refresh period
+        now = time.perf_counter()
+        if self._counter != self._min and now - self._current <= self._min_period:
+            # Updates come faster than the refresh period, so look at the clock less often
+            if now - self._current < self._min_period / 4:
+                self._stride = min(self._stride * 2, 2 ** 16)
+            self._next_check = self._counter + self._stride
+            return False
+        if self._counter != self._min and now - self._current > 2 * self._min_period:
+            # Updates slowed down a lot, so go back to looking at the clock on every update
+            self._stride = 1
+        elif self._counter != self._min and now - self._current > self._min_period:
+            self._stride = max(self._stride // 2, 1)
+        self._current = now
+        self._cost = now - self._clock
+        self._next_check = self._counter + self._stride
+        if not self._observed():
             return False
-        self._current = time.time()
-        self._cost = time.time() - self._clock
-        if self._counter > self._min:
-            tmp_hour = int(self._cost / 3600)
-            tmp_min = int((self._cost - tmp_hour * 3600) / 60)
-            tmp_sec = self._cost % 60
-            tmp_avg = self._cost / (self._counter - self._min)
-            tmp_avg_hour = int(tmp_avg / 3600)
-            tmp_avg_min = int((tmp_avg - tmp_avg_hour * 3600) / 60)
-            tmp_avg_sec = tmp_avg % 60
-        else:
-            print()
-            tmp_hour = 0
-            tmp_min = 0
-            tmp_sec = 0
-            tmp_avg_hour = 0
-            tmp_avg_min = 0
-            tmp_avg_sec = 0
-        passed = int(self._counter * self._bar_width / self._max)
-        print(
-            "\r" + "##{}[".format(
-                self._bar_name
-            ) + "-" * passed + " " * (self._bar_width - passed) + "] : {} / {}".format(
-                self._counter, self._max
-            ) + " ##  Time Cost: {:3d} h {:3d} min {:6.4} s; Average: {:3d} h {:3d} min {:6.4} s ".format(
-                tmp_hour, tmp_min, tmp_sec, tmp_avg_hour, tmp_avg_min, tmp_avg_sec
-            ) if self._counter != self._min else "##{}Progress bar initialized  ##".format(
-                self._bar_name
-            ), end=""
-        )
+        self._emit()
         return True
 
     def set_min(self, min_val):
@@ -103,15 +105,20 @@ class ProgressBar:
     def update(self, new_value=None):
         if new_value is None:
             new_value = self._counter + 1
+            if new_value < self._next_check and new_value < self._max:
+                self._counter = new_value
+                return False
         if new_value != self._min:
             self._counter = self._max if new_value >= self._max else int(new_value)
+            if self._counter < self._next_check and self._counter < self._max:
+                return False
             return self._flush()
 
     def start(self):
         if self._task_length is None:
             print("Error: Progress bar not initialized properly.")
             return
-        self._current = self._clock = time.time()
+        self._current = self._clock = time.perf_counter()
         self._started = True
         self._flush()
 
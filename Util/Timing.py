@@ -1,10 +1,21 @@
+import csv
+import json
 import time
 import wrapt
+import threading
+from operator import add
 
 
 class Timing:
-    timings = {}
     enabled = False
+    sample_period = 1
+    sub_bits = 4
+    n_buckets = 1024
+
+    _lock = threading.Lock()
+    _local = threading.local()
+    _buffers = []
+    _merged = {}
 
     def __init__(self, enabled=True):
         Timing.enabled = enabled
@@ -14,51 +25,170 @@ class Timing:
 
     __repr__ = __str__
 
+    # Latency histogram
+
+    @classmethod
+    def _bucket(cls, t):
+        shift = t.bit_length() - cls.sub_bits - 1
+        if shift <= 0:
+            return t
+        return (shift << cls.sub_bits) + (t >> shift)
+
+    @classmethod
+    def _bucket_bound(cls, b):
+        if b < 2 << cls.sub_bits:
+            return b
+        q, m = divmod(b, 1 << cls.sub_bits)
+        return (m + (1 << cls.sub_bits)) << (q - 1)
+
+    @classmethod
+    def _new_record(cls, key):
+        try:
+            buffer = cls._local.buffer
+        except AttributeError:
+            buffer = cls._local.buffer = {}
+            with cls._lock:
+                cls._buffers.append(buffer)
+        # Inserts take the lock so that 'snapshot' never copies a buffer while it grows
+        with cls._lock:
+            record = buffer[key] = [0, 0, 0, [0] * cls.n_buckets]
+        return record
+
+    @staticmethod
+    def _get_func_name(func, func_name):
+        if func_name is not None:
+            return func_name
+        try:
+            return func.__name__
+        except AttributeError:
+            str_func = str(func)
+            _at_idx = str_func.rfind("at")
+            _dot_idx = str_func.rfind(".", None, _at_idx)
+            return str_func[_dot_idx+1:_at_idx-1]
+
     @classmethod
     def timeit(cls, level=0, func_name=None, cls_name=None, prefix="[Method] "):
+        keys = {}
+
+        def get_key(func, owner):
+            key = keys[owner] = (
+                owner.__name__ if owner is not None else ("" if cls_name is None else cls_name),
+                prefix, cls._get_func_name(func, func_name), level
+            )
+            return key
+
         @wrapt.decorator
         def wrapper(func, instance, args, kwargs):
             if not cls.enabled:
                 return func(*args, **kwargs)
-            if instance is not None:
-                instance_name = "{:>18s}".format(instance.__class__.__name__)
-            else:
-                instance_name = " " * 18 if cls_name is None else "{:>18s}".format(cls_name)
-            _prefix = "{:>26s}".format(prefix)
+            owner = None if instance is None else instance.__class__
+            key = keys.get(owner)
+            if key is None:
+                key = get_key(func, owner)
             try:
-                _func_name = "{:>28}".format(func.__name__ if func_name is None else func_name)
-            except AttributeError:
-                str_func = str(func)
-                _at_idx = str_func.rfind("at")
-                _dot_idx = str_func.rfind(".", None, _at_idx)
-                _func_name = "{:>28}".format(str_func[_dot_idx+1:_at_idx-1])
-            _name = instance_name + _prefix + _func_name
-            _t = time.time()
+                record = cls._local.buffer[key]
+            except (AttributeError, KeyError):
+                record = cls._new_record(key)
+            record[0] += 1
+            if cls.sample_period > 1 and record[0] % cls.sample_period:
+                return func(*args, **kwargs)
+            _t = time.perf_counter_ns()
             rs = func(*args, **kwargs)
-            _t = time.time() - _t
-            try:
-                cls.timings[_name]["timing"] += _t
-                cls.timings[_name]["call_time"] += 1
-            except KeyError:
-                cls.timings[_name] = {
-                    "level": level,
-                    "timing": _t,
-                    "call_time": 1
-                }
+            _t = time.perf_counter_ns() - _t
+            record[1] += 1
+            record[2] += _t
+            record[3][cls._bucket(_t)] += 1
             return rs
         return wrapper
 
+    @classmethod
+    def set_sample_rate(cls, rate=1.):
+        cls.sample_period = max(1, int(round(1 / rate)))
+
+    # Aggregation
+
+    @staticmethod
+    def _add_records(target, records):
+        for key, (call_time, sampled, total, hist) in records.items():
+            record = target.get(key)
+            if record is None:
+                target[key] = [call_time, sampled, total, list(hist)]
+            else:
+                record[0] += call_time
+                record[1] += sampled
+                record[2] += total
+                record[3] = list(map(add, record[3], hist))
+        return target
+
+    @classmethod
+    def snapshot(cls):
+        with cls._lock:
+            buffers = [dict(buffer) for buffer in cls._buffers]
+        records = cls._add_records({}, cls._merged)
+        for buffer in buffers:
+            cls._add_records(records, buffer)
+        return records
+
+    @classmethod
+    def merge(cls, records):
+        with cls._lock:
+            cls._add_records(cls._merged, records)
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            for buffer in cls._buffers:
+                buffer.clear()
+            cls._merged = {}
+
+    @classmethod
+    def _percentile(cls, hist, q):
+        tar, cum = q * sum(hist), 0
+        for b, count in enumerate(hist):
+            cum += count
+            if count and cum >= tar:
+                return 0.5 * (cls._bucket_bound(b) + cls._bucket_bound(b + 1)) * 1e-9
+        return 0.
+
+    @classmethod
+    def get_timings(cls, level=2):
+        timings = []
+        for key, (call_time, sampled, total, hist) in sorted(cls.snapshot().items()):
+            if level < key[3]:
+                continue
+            timing = total * 1e-9 * call_time / max(sampled, 1)
+            timings.append({
+                "class": key[0], "prefix": key[1], "method": key[2], "level": key[3],
+                "timing": timing, "call_time": call_time, "sampled": sampled,
+                "mean": timing / call_time,
+                "p50": cls._percentile(hist, 0.5),
+                "p95": cls._percentile(hist, 0.95),
+                "p99": cls._percentile(hist, 0.99)
+            })
+        return timings
+
     @classmethod
     def show_timing_log(cls, level=2):
         print()
-        print("=" * 110 + "\n" + "Timing log\n" + "-" * 110)
-        if cls.timings:
-            for key in sorted(cls.timings.keys()):
-                timing_info = cls.timings[key]
-                if level >= timing_info["level"]:
-                    print("{:<42s} :  {:12.7} s (Call Time: {:6d})".format(
-                        key, timing_info["timing"], timing_info["call_time"]))
-        print("-" * 110)
+        print("=" * 150 + "\n" + "Timing log\n" + "-" * 150)
+        for info in cls.get_timings(level):
+            name = "{:>18s}{:>26s}{:>28}".format(info["class"], info["prefix"], info["method"])
+            print("{:<42s} :  {:12.7} s (Call Time: {:6d}) p50: {:10.4g} s  p95: {:10.4g} s  p99: {:10.4g} s".format(
+                name, info["timing"], info["call_time"], info["p50"], info["p95"], info["p99"]))
+        print("-" * 150)
+
+    @classmethod
+    def export(cls, path, level=2):
+        timings = cls.get_timings(level)
+        with open(path, "w", newline="") as file:
+            if path.endswith(".csv"):
+                writer = csv.DictWriter(file, fieldnames=[
+                    "class", "prefix", "method", "level", "timing", "call_time", "sampled",
+                    "mean", "p50", "p95", "p99"])
+                writer.writeheader()
+                writer.writerows(timings)
+            else:
+                json.dump(timings, file, indent=2)
 
     @classmethod
     def disable(cls):
@@ -7,6 +7,7 @@ import numpy as np
 import tensorflow as tf
 import matplotlib.pyplot as plt
 from math import pi, sqrt, ceil
+from itertools import islice
 from tensorflow.python.platform import gfile
 from tensorflow.python.framework import graph_io
 from tensorflow.python.tools import freeze_graph
@@ -85,36 +86,50 @@ class DataUtil:
                 return True
         return False
 
+    @staticmethod
+    def _parse_lines(name, lines, quantized=False):
+        if DataUtil.is_naive(name):
+            lines = [line.strip() for line in lines if line.strip()]
+            if quantized:
+                return np.fromstring(",".join(lines), dtype=np.float32, sep=",").reshape(len(lines), -1)
+            return np.array([line.split(",") for line in lines])
+        if name == "bank1.0":
+            lines = [line.replace('"', "") for line in lines if line.strip()]
+            x = np.array([list(map(lambda c: c.strip(), line.split(";"))) for line in lines])
+            return x.astype(np.float32) if quantized else x
+        raise NotImplementedError("Dataset '{}' not defined".format(name))
+
     @staticmethod
     def get_dataset(name, path, train_num=None, tar_idx=None, shuffle=True,
-                    quantize=False, quantized=False, one_hot=False, **kwargs):
-        x = []
+                    quantize=False, quantized=False, one_hot=False, chunk_size=2 ** 14, **kwargs):
+        tar_idx = -1 if tar_idx is None else tar_idx
+        xs, ys = [], []
+        encoder = DataEncoder(kwargs.get("wc"), kwargs.get("continuous_rate", 0.1)) if quantize else None
         with open(path, "r", encoding="utf8") as file:
-            if DataUtil.is_naive(name):
-                for sample in file:
-                    x.append(sample.strip().split(","))
-            elif name == "bank1.0":
-                for sample in file:
-                    sample = sample.replace('"', "")
-                    x.append(list(map(lambda c: c.strip(), sample.split(";"))))
-            else:
-                raise NotImplementedError
+            for lines in iter(lambda: list(islice(file, chunk_size)), []):
+                chunk = DataUtil._parse_lines(name, lines, quantized)
+                if not len(chunk):
+                    continue
+                x, y = np.delete(chunk, tar_idx, axis=1), chunk[..., tar_idx]
+                if quantize and not quantized:
+                    encoder.partial_fit(x, y)
+                xs.append(x)
+                ys.append(y)
+        x, y = np.vstack(xs), np.concatenate(ys)
         if shuffle:
-            np.random.shuffle(x)
-        tar_idx = -1 if tar_idx is None else tar_idx
-        y = np.array([xx.pop(tar_idx) for xx in x])
+            indices = np.random.permutation(len(x))
+            x, y = x[indices], y[indices]
         if quantized:
-            x = np.asarray(x, dtype=np.float32)
             y = y.astype(np.int8)
             if one_hot:
                 y = (y[..., None] == np.arange(np.max(y) + 1))
-        else:
-            x = np.asarray(x)
         if quantized or not quantize:
             if train_num is None:
                 return x, y
             return (x[:train_num], y[:train_num]), (x[train_num:], y[train_num:])
-        x, y, wc, features, feat_dicts, label_dict = DataUtil.quantize_data(x, y, **kwargs)
+        x, y = encoder.transform(x, y, kwargs.get("separate", False))
+        wc, features, feat_dicts, label_dict = (
+            encoder.whether_continuous, encoder.feature_sets, encoder.feat_dicts, encoder.label_dict)
         if one_hot:
             y = (y[..., None] == np.arange(np.max(y)+1)).astype(np.int8)
         if train_num is None:
@@ -219,46 +234,136 @@ class DataUtil:
 
     @staticmethod
     def quantize_data(x, y, wc=None, continuous_rate=0.1, separate=False):
-        if isinstance(x, list):
-            xt = map(list, zip(*x))
-        else:
-            xt = x.T
-        features = [set(feat) for feat in xt]
-        if wc is None:
-            wc = np.array([len(feat) >= int(continuous_rate * len(y)) for feat in features])
-        else:
-            wc = np.asarray(wc)
-        feat_dicts = [
-            {_l: i for i, _l in enumerate(feats)} if not wc[i] else None
-            for i, feats in enumerate(features)
+        encoder = DataEncoder(wc, continuous_rate)
+        x, y = encoder.fit_transform(x, y, separate)
+        return x, y, encoder.whether_continuous, encoder.feature_sets, encoder.feat_dicts, encoder.label_dict
+
+    @staticmethod
+    def transform_data(x, y, wc, feat_dicts, label_dict):
+        return DataEncoder.from_dicts(wc, feat_dicts, label_dict).transform(x, y)
+
+
+class DataEncoder:
+    def __init__(self, wc=None, continuous_rate=0.1, unseen=-1):
+        self._wc = None if wc is None else np.asarray(wc)
+        self._continuous_rate, self._unseen = continuous_rate, unseen
+        self._features = self._feature_codes = self._labels = self._label_codes = None
+        self._n_samples = 0
+
+    @property
+    def whether_continuous(self):
+        if self._wc is not None:
+            return self._wc
+        return np.array([len(values) >= int(self._continuous_rate * self._n_samples) for values in self._features])
+
+    @property
+    def feature_sets(self):
+        return [set(values.tolist()) for values in self._features]
+
+    @property
+    def feat_dicts(self):
+        return [
+            None if continuous else DataEncoder._get_dict(values, codes)
+            for continuous, values, codes in zip(self.whether_continuous, self._features, self._feature_codes)
         ]
-        if not separate:
-            if np.all(~wc):
-                dtype = np.int
-            else:
-                dtype = np.float32
-            x = np.array([[feat_dicts[i][_l] if not wc[i] else _l for i, _l in enumerate(sample)]
-                          for sample in x], dtype=dtype)
+
+    @property
+    def label_dict(self):
+        return {i: label for label, i in DataEncoder._get_dict(self._labels, self._label_codes).items()}
+
+    @staticmethod
+    def _get_dict(values, codes):
+        return dict(zip(values.tolist(), range(len(values)) if codes is None else codes.tolist()))
+
+    @staticmethod
+    def _get_vocab(dic):
+        values = np.array(list(dic.keys()))
+        order = np.argsort(values, kind="mergesort")
+        return values[order], np.array(list(dic.values()))[order]
+
+    @staticmethod
+    def _get_columns(x):
+        if isinstance(x, np.ndarray):
+            return list(np.atleast_2d(x).T)
+        return [np.asarray(column) for column in zip(*x)]
+
+    @staticmethod
+    def _union(values, column):
+        if values is None:
+            return np.unique(column)
+        return np.union1d(values, column)
+
+    def partial_fit(self, x, y=None):
+        columns = DataEncoder._get_columns(x)
+        if self._features is None:
+            self._features, self._feature_codes = [None] * len(columns), [None] * len(columns)
+        self._features = [DataEncoder._union(values, column) for values, column in zip(self._features, columns)]
+        if y is not None:
+            self._labels = DataEncoder._union(self._labels, np.asarray(y))
+        self._n_samples += len(columns[0]) if columns else len(y)
+        return self
+
+    def fit(self, x, y=None):
+        self._features = self._feature_codes = self._labels = self._label_codes = None
+        self._n_samples = 0
+        return self.partial_fit(x, y)
+
+    def _encode(self, column, values, codes=None):
+        if column.dtype.kind != values.dtype.kind:
+            column = column.astype(str if values.dtype.kind == "U" else values.dtype)
+        idx = np.minimum(np.searchsorted(values, column), len(values) - 1)
+        if codes is not None:
+            return np.where(values[idx] == column, codes[idx], self._unseen)
+        return np.where(values[idx] == column, idx, self._unseen)
+
+    def transform(self, x, y=None, separate=False):
+        columns, wc = DataEncoder._get_columns(x), self.whether_continuous
+        if not separate and np.all(~wc):
+            x = np.empty((len(columns[0]), len(columns)), dtype=np.int)
         else:
-            x = np.array([[feat_dicts[i][_l] if not wc[i] else _l for i, _l in enumerate(sample)]
-                          for sample in x], dtype=np.float32)
+            x = np.empty((len(columns[0]), len(columns)), dtype=np.float32)
+        for i, (column, values, codes) in enumerate(zip(columns, self._features, self._feature_codes)):
+            if wc[i]:
+                x[..., i] = column.astype(np.float32)
+            else:
+                x[..., i] = self._encode(column, values, codes)
+        if separate:
             x = (x[:, ~wc].astype(np.int), x[:, wc])
-        label_dict = {l: i for i, l in enumerate(set(y))}
-        y = np.array([label_dict[yy] for yy in y], dtype=np.int8)
-        label_dict = {i: l for l, i in label_dict.items()}
-        return x, y, wc, features, feat_dicts, label_dict
+        if y is None:
+            return x
+        return x, self._encode(np.asarray(y), self._labels, self._label_codes).astype(np.int8)
+
+    def fit_transform(self, x, y=None, separate=False):
+        return self.fit(x, y).transform(x, y, separate)
 
     @staticmethod
-    def transform_data(x, y, wc, feat_dicts, label_dict):
-        if np.all(~wc):
-            dtype = np.int
-        else:
-            dtype = np.float32
-        label_dict = {l: i for i, l in label_dict.items()}
-        x = np.array([[feat_dicts[i][_l] if not wc[i] else _l for i, _l in enumerate(sample)]
-                      for sample in x], dtype=dtype)
-        y = np.array([label_dict[yy] for yy in y], dtype=np.int8)
-        return x, y
+    def from_dicts(wc, feat_dicts, label_dict=None):
+        encoder = DataEncoder(wc)
+        encoder._features, encoder._feature_codes = map(list, zip(*[
+            (np.array([]), None) if dic is None else DataEncoder._get_vocab(dic) for dic in feat_dicts]))
+        if label_dict is not None:
+            encoder._labels, encoder._label_codes = DataEncoder._get_vocab(
+                {label: i for i, label in label_dict.items()})
+        return encoder
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            pickle.dump({
+                "_wc": self.whether_continuous,
+                "_continuous_rate": self._continuous_rate,
+                "_unseen": self._unseen,
+                "_features": self._features,
+                "_feature_codes": self._feature_codes,
+                "_labels": self._labels,
+                "_label_codes": self._label_codes,
+                "_n_samples": self._n_samples
+            }, file)
+
+    def load(self, path):
+        with open(path, "rb") as file:
+            for key, value in pickle.load(file).items():
+                setattr(self, key, value)
+        return self
 
 
 class VisUtil:
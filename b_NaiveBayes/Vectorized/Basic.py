@@ -33,6 +33,48 @@ class NBFunctions:
 
         return [func(_c=c) for c in range(n_category)]
 
+    @staticmethod
+    def log_sum_exp(x):
+        x_max = np.max(x, axis=1, keepdims=True)
+        return x_max + np.log(np.sum(np.exp(x - x_max), axis=1, keepdims=True))
+
+    @staticmethod
+    def get_encoder(feat_dict):
+        values = np.array(list(feat_dict.keys()))
+        codes = np.array(list(feat_dict.values()))
+        order = np.argsort(values, kind="mergesort")
+        return values[order], codes[order]
+
+    @staticmethod
+    def encode(column, encoder, unseen):
+        values, codes = encoder
+        column = np.asarray(column)
+        if column.dtype != values.dtype:
+            column = column.astype(str if values.dtype.kind == "U" else values.dtype)
+        idx = np.minimum(np.searchsorted(values, column), len(values) - 1)
+        return np.where(values[idx] == column, codes[idx], unseen)
+
+    @staticmethod
+    def grow_dict(column, dic):
+        values, inverse = np.unique(np.asarray(column), return_inverse=True)
+        codes = np.array([dic.setdefault(value, len(dic)) for value in values.tolist()], dtype=np.intp)
+        return codes[inverse.ravel()]
+
+    @staticmethod
+    def pad(arr, shape, dtype=np.float64):
+        rs = np.zeros(shape, dtype=dtype)
+        if arr is not None:
+            arr = np.asarray(arr)
+            rs[tuple(slice(0, n) for n in arr.shape)] = arr
+        return rs
+
+    @staticmethod
+    def merge_moments(w_a, mu_a, m2_a, w_b, mu_b, m2_b):
+        w = w_a + w_b
+        ratio = np.divide(w_b, w, out=np.zeros_like(w), where=w > 0)[..., None]
+        delta = mu_b - mu_a
+        return w, mu_a + delta * ratio, m2_a + m2_b + delta ** 2 * (w_a[..., None] * ratio)
+
 
 class NaiveBayes(ClassifierBase):
     NaiveBayesTiming = Timing()
@@ -40,10 +82,10 @@ class NaiveBayes(ClassifierBase):
     def __init__(self, **kwargs):
         super(NaiveBayes, self).__init__(**kwargs)
         self._x = self._y = self._data = None
-        self._n_possibilities = self._p_category = None
+        self._n_possibilities = self._p_category = self._log_p_category = None
         self._labelled_x = self._label_zip = None
-        self._cat_counter = self._con_counter = None
-        self.label_dict = self._feat_dicts = None
+        self._cat_counter = self._con_counter = self._weight_counter = None
+        self.label_dict = self._feat_dicts = self._label_lookup = None
 
         self._params["lb"] = kwargs.get("lb", 1)
 
@@ -55,7 +97,8 @@ class NaiveBayes(ClassifierBase):
 
     @NaiveBayesTiming.timeit(level=2, prefix="[API] ")
     def get_prior_probability(self, lb=1):
-        return [(c_num + lb) / (len(self._y) + lb * len(self._cat_counter))
+        n_samples = np.sum(self._cat_counter)
+        return [(c_num + lb) / (n_samples + lb * len(self._cat_counter))
                 for c_num in self._cat_counter]
 
     @NaiveBayesTiming.timeit(level=2, prefix="[API] ")
@@ -67,28 +110,67 @@ class NaiveBayes(ClassifierBase):
         if x is not None and y is not None:
             self.feed_data(x, y, sample_weight)
         self._fit(lb)
+        self._refresh_predictor()
+
+    @NaiveBayesTiming.timeit(level=2, prefix="[API] ")
+    def partial_fit(self, x, y, sample_weight=None, lb=None):
+        if lb is None:
+            lb = self._params["lb"]
+        self._partial_fit(x, y, sample_weight)
+        self._fit(lb)
+        self._refresh_predictor()
+
+    @NaiveBayesTiming.timeit(level=2, prefix="[API] ")
+    def merge(self, other, lb=None):
+        if lb is None:
+            lb = self._params["lb"]
+        self._merge(other)
+        self._fit(lb)
+        self._refresh_predictor()
 
     def _fit(self, lb):
         pass
 
-    def _func(self, x, i):
+    def _partial_fit(self, x, y, sample_weight=None):
         pass
 
+    def _merge(self, other):
+        pass
+
+    def _grow_labels(self, y):
+        label_codes = {} if self.label_dict is None else {
+            label: i for i, label in self.label_dict.items()}
+        y = NBFunctions.grow_dict(y, label_codes)
+        self.label_dict = {i: label for label, i in label_codes.items()}
+        return y
+
+    def _refresh_predictor(self):
+        self._log_p_category = np.log(self._p_category)
+        self._label_lookup = np.array([self.label_dict[i] for i in range(len(self._cat_counter))])
+
+    def _log_func(self, x):
+        pass
+
+    def _func(self, x, i):
+        return np.exp(self._joint_log_likelihood(x)[..., i])
+
+    def _joint_log_likelihood(self, x):
+        return self._log_func(x) + self._log_p_category
+
     @NaiveBayesTiming.timeit(level=1, prefix="[API] ")
     def predict(self, x, get_raw_result=False, **kwargs):
-        if isinstance(x, np.ndarray):
-            x = x.tolist()
-        else:
-            x = [xx[:] for xx in x]
-        x = self._transfer_x(x)
-        m_arg, m_probability = np.zeros(len(x), dtype=np.int8), np.zeros(len(x))
-        for i in range(len(self._cat_counter)):
-            p = self._func(x, i)
-            mask = p > m_probability
-            m_arg[mask], m_probability[mask] = i, p[mask]
+        rs = self._joint_log_likelihood(self._transfer_x(x))
         if not get_raw_result:
-            return np.array([self.label_dict[arg] for arg in m_arg])
-        return m_probability
+            return self._label_lookup[np.argmax(rs, axis=1)]
+        return np.exp(np.max(rs, axis=1))
+
+    @NaiveBayesTiming.timeit(level=1, prefix="[API] ")
+    def predict_log_proba(self, x):
+        rs = self._joint_log_likelihood(self._transfer_x(x))
+        return rs - NBFunctions.log_sum_exp(rs)
+
+    def predict_proba(self, x):
+        return np.exp(self.predict_log_proba(x))
 
     def _transfer_x(self, x):
-        return x
+        return np.atleast_2d(np.asarray(x, dtype=np.float64))
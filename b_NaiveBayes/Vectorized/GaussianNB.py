@@ -14,6 +14,10 @@ from Util.Timing import Timing
 class GaussianNB(NaiveBayes):
     GaussianNBTiming = Timing()
 
+    def __init__(self, **kwargs):
+        super(GaussianNB, self).__init__(**kwargs)
+        self._mu = self._sigma = self._m2 = None
+
     @GaussianNBTiming.timeit(level=1, prefix="[API] ")
     def feed_data(self, x, y, sample_weight=None):
         if sample_weight is not None:
@@ -33,28 +37,63 @@ class GaussianNB(NaiveBayes):
 
     @GaussianNBTiming.timeit(level=1, prefix="[Core] ")
     def feed_sample_weight(self, sample_weight=None):
-        if sample_weight is not None:
-            local_weights = sample_weight * len(sample_weight)
-            for i, label in enumerate(self._label_zip):
-                self._labelled_x[i] *= local_weights[label]
+        self._weight_counter, self._mu, self._m2 = self._get_moments(
+            self._x.T, self._y, sample_weight, len(self._cat_counter))
+
+    @staticmethod
+    def _get_moments(x, y, sample_weight, n_category):
+        if sample_weight is None:
+            sample_weight = np.ones(len(y))
+        else:
+            sample_weight = np.asarray(sample_weight, dtype=np.float64)
+        weight_counter = np.bincount(y, sample_weight, minlength=n_category)
+        mu = np.array([
+            np.bincount(y, sample_weight * xx, minlength=n_category) for xx in x.T]).reshape(-1, n_category).T
+        mask = weight_counter[..., None] > 0
+        mu = np.divide(mu, weight_counter[..., None], out=np.zeros_like(mu), where=mask)
+        m2 = np.array([
+            np.bincount(y, sample_weight * (xx - mu_dim[y]) ** 2, minlength=n_category)
+            for xx, mu_dim in zip(x.T, mu.T)]).reshape(-1, n_category).T
+        return weight_counter, mu, m2
+
+    @GaussianNBTiming.timeit(level=1, prefix="[Core] ")
+    def _partial_fit(self, x, y, sample_weight=None):
+        x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+        y = self._grow_labels(y)
+        n_category = len(self.label_dict)
+        cat_counter = np.bincount(y, minlength=n_category)
+        self._add_moments(cat_counter, *self._get_moments(x, y, sample_weight, n_category))
+
+    @GaussianNBTiming.timeit(level=1, prefix="[Core] ")
+    def _merge(self, other):
+        label_map = self._grow_labels([other.label_dict[i] for i in range(len(other.label_dict))])
+        self._add_moments(other["cat_counter"], other["weight_counter"], other["mu"], other["m2"], label_map)
+
+    def _add_moments(self, cat_counter, weight_counter, mu, m2, label_map=None):
+        n_category, n_dim = len(self.label_dict), mu.shape[1]
+        if label_map is None:
+            label_map = np.arange(n_category)
+        self._cat_counter = NBFunctions.pad(self._cat_counter, n_category, np.int64)
+        self._weight_counter = NBFunctions.pad(self._weight_counter, n_category)
+        self._mu = NBFunctions.pad(self._mu, (n_category, n_dim))
+        self._m2 = NBFunctions.pad(self._m2, (n_category, n_dim))
+        self._cat_counter[label_map] += cat_counter
+        weight_counter, mu, m2 = NBFunctions.merge_moments(
+            self._weight_counter[label_map], self._mu[label_map], self._m2[label_map], weight_counter, mu, m2)
+        self._weight_counter[label_map], self._mu[label_map], self._m2[label_map] = weight_counter, mu, m2
 
     @GaussianNBTiming.timeit(level=1, prefix="[Core] ")
     def _fit(self, lb):
         lb = 0
-        n_category = len(self._cat_counter)
         self._p_category = self.get_prior_probability(lb)
-        data = [
-            NBFunctions.gaussian_maximum_likelihood(
-                self._labelled_x, n_category, dim) for dim in range(len(self._x))]
-        self._data = data
+        self._sigma = self._m2 / self._weight_counter[..., None]
+        self._data = [self._mu, self._sigma]
 
     @GaussianNBTiming.timeit(level=1, prefix="[Core] ")
-    def _func(self, x, i):
-        x = np.atleast_2d(x).T
-        rs = np.ones(x.shape[1])
-        for d, xx in enumerate(x):
-            rs *= self._data[d][i](xx)
-        return rs * self._p_category[i]
+    def _log_func(self, x):
+        inv = 0.5 / self._sigma ** 2
+        bias = np.sum(self._mu ** 2 * inv + np.log(sqrt_pi * self._sigma), axis=1)
+        return (2 * x).dot((self._mu * inv).T) - (x ** 2).dot(inv.T) - bias
 
     def visualize(self, save=False):
         colors = plt.cm.Paired([i / len(self.label_dict) for i in range(len(self.label_dict))])
@@ -68,7 +107,7 @@ class GaussianNB(NaiveBayes):
             plt.figure()
             plt.title(title)
             for c in range(len(self.label_dict)):
-                plt.plot(tmp_x, self._data[j][c](tmp_x),
+                plt.plot(tmp_x, NBFunctions.gaussian(tmp_x, self._mu[c, j], self._sigma[c, j]),
                          c=colors[self.label_dict[c]], label="class: {}".format(self.label_dict[c]))
             plt.xlim(x_min-0.2*gap, x_max+0.2*gap)
             plt.legend()
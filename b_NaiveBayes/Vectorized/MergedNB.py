@@ -73,25 +73,39 @@ class MergedNB(NaiveBayes):
         self._p_category = self._multinomial["p_category"]
 
     @MergedNBTiming.timeit(level=1, prefix="[Core] ")
-    def _func(self, x, i):
+    def _partial_fit(self, x, y, sample_weight=None):
+        if not isinstance(x, np.ndarray):
+            x = np.array(x, dtype=object)
         x = np.atleast_2d(x)
-        return self._multinomial["func"](
-            x[:, self._whether_discrete].astype(np.int), i) * self._gaussian["func"](
-            x[:, self._whether_continuous], i) / self._p_category[i]
+        if self._whether_continuous is None:
+            self._whether_continuous = DataUtil.quantize_data(x, y)[2]
+            self._whether_discrete = ~self._whether_continuous
+        self._multinomial["partial_fit"](x[..., self._whether_discrete], y, sample_weight)
+        self._gaussian["partial_fit"](x[..., self._whether_continuous].astype(np.float64), y, sample_weight)
+        self.label_dict, self._cat_counter = self._multinomial.label_dict, self._multinomial["cat_counter"]
+
+    @MergedNBTiming.timeit(level=1, prefix="[Core] ")
+    def _merge(self, other):
+        if self._whether_continuous is None:
+            self._whether_continuous, self._whether_discrete = other["whether_continuous"], other["whether_discrete"]
+        self._multinomial["merge"](other["multinomial"])
+        self._gaussian["merge"](other["gaussian"])
+        self.label_dict, self._cat_counter = self._multinomial.label_dict, self._multinomial["cat_counter"]
+
+    @MergedNBTiming.timeit(level=1, prefix="[Core] ")
+    def _log_func(self, x):
+        discrete_x, continuous_x = x
+        return self._multinomial["log_func"](discrete_x) + self._gaussian["log_func"](continuous_x)
 
     @MergedNBTiming.timeit(level=1, prefix="[Core] ")
     def _transfer_x(self, x):
-        feat_dicts = self._multinomial["feat_dicts"]
-        idx = 0
-        for d, discrete in enumerate(self._whether_discrete):
-            for i, sample in enumerate(x):
-                if not discrete:
-                    x[i][d] = float(x[i][d])
-                else:
-                    x[i][d] = feat_dicts[idx][sample[d]]
-            if discrete:
-                idx += 1
-        return x
+        if not isinstance(x, np.ndarray):
+            x = np.array(x, dtype=object)
+        x = np.atleast_2d(x)
+        return (
+            self._multinomial["transfer_x"](x[..., self._whether_discrete]),
+            x[..., self._whether_continuous].astype(np.float64)
+        )
 
 if __name__ == '__main__':
     import time
@@ -15,6 +15,10 @@ from Util.Timing import Timing
 class MultinomialNB(NaiveBayes):
     MultinomialNBTiming = Timing()
 
+    def __init__(self, **kwargs):
+        super(MultinomialNB, self).__init__(**kwargs)
+        self._log_data = self._offsets = self._encoders = None
+
     @MultinomialNBTiming.timeit(level=1, prefix="[API] ")
     def feed_data(self, x, y, sample_weight=None):
         if sample_weight is not None:
@@ -43,34 +47,80 @@ class MultinomialNB(NaiveBayes):
                 self._con_counter.append([
                     np.bincount(xx[dim], weights=sample_weight[label] / sample_weight[label].mean(), minlength=p)
                     for label, xx in self._label_zip])
+        self._weight_counter = np.asarray(self._cat_counter, dtype=np.float64)
+
+    @MultinomialNBTiming.timeit(level=1, prefix="[Core] ")
+    def _partial_fit(self, x, y, sample_weight=None):
+        x = np.atleast_2d(np.asarray(x))
+        if self._feat_dicts is None:
+            self._feat_dicts = [{} for _ in range(x.shape[1])]
+        y = self._grow_labels(y)
+        x = [NBFunctions.grow_dict(xx, dic) for xx, dic in zip(x.T, self._feat_dicts)]
+        self._n_possibilities = [len(dic) for dic in self._feat_dicts]
+        if sample_weight is not None:
+            sample_weight = np.asarray(sample_weight, dtype=np.float64)
+        n_category = len(self.label_dict)
+        cat_counter = np.bincount(y, minlength=n_category)
+        weight_counter = cat_counter if sample_weight is None else np.bincount(
+            y, sample_weight, minlength=n_category)
+        con_counter = [
+            np.bincount(y * p + xx, sample_weight, minlength=n_category * p).reshape(n_category, p)
+            for xx, p in zip(x, self._n_possibilities)]
+        self._add_counters(cat_counter, weight_counter, con_counter)
+
+    @MultinomialNBTiming.timeit(level=1, prefix="[Core] ")
+    def _merge(self, other):
+        label_map = self._grow_labels([other.label_dict[i] for i in range(len(other.label_dict))])
+        if self._feat_dicts is None:
+            self._feat_dicts = [{} for _ in other["feat_dicts"]]
+        feat_maps = [
+            NBFunctions.grow_dict(sorted(other_dic, key=other_dic.get), dic)
+            for dic, other_dic in zip(self._feat_dicts, other["feat_dicts"])]
+        self._n_possibilities = [len(dic) for dic in self._feat_dicts]
+        self._add_counters(
+            other["cat_counter"], other["weight_counter"], other["con_counter"], label_map, feat_maps)
+
+    def _add_counters(self, cat_counter, weight_counter, con_counter, label_map=None, feat_maps=None):
+        n_category = len(self.label_dict)
+        if label_map is None:
+            label_map = np.arange(n_category)
+        if feat_maps is None:
+            feat_maps = [np.arange(p) for p in self._n_possibilities]
+        if self._con_counter is None:
+            self._con_counter = [None] * len(self._n_possibilities)
+        self._cat_counter = NBFunctions.pad(self._cat_counter, n_category, np.int64)
+        self._weight_counter = NBFunctions.pad(self._weight_counter, n_category)
+        self._cat_counter[label_map] += cat_counter
+        self._weight_counter[label_map] += weight_counter
+        for dim, (counter, feat_map) in enumerate(zip(con_counter, feat_maps)):
+            self._con_counter[dim] = NBFunctions.pad(
+                self._con_counter[dim], (n_category, self._n_possibilities[dim]))
+            self._con_counter[dim][np.ix_(label_map, feat_map)] += counter
 
     @MultinomialNBTiming.timeit(level=1, prefix="[Core] ")
     def _fit(self, lb):
-        n_dim = len(self._n_possibilities)
-        n_category = len(self._cat_counter)
         self._p_category = self.get_prior_probability(lb)
-
-        data = [[] for _ in range(n_dim)]
-        for dim, n_possibilities in enumerate(self._n_possibilities):
-            data[dim] = [
-                [(self._con_counter[dim][c][p] + lb) / (self._cat_counter[c] + lb * n_possibilities)
-                 for p in range(n_possibilities)] for c in range(n_category)]
-        self._data = [np.asarray(dim_info) for dim_info in data]
+        cat_counter = np.asarray(self._cat_counter)[..., None]
+        scale = cat_counter / self._weight_counter[..., None]
+        self._data = [
+            (np.asarray(counter) * scale + lb) / (cat_counter + lb * n_possibilities)
+            for counter, n_possibilities in zip(self._con_counter, self._n_possibilities)]
+        self._log_data = np.vstack([np.zeros((0, len(self._cat_counter)))] + [
+            np.vstack([np.log(dim_info.T), np.zeros((1, len(dim_info)))]) for dim_info in self._data])
+        self._offsets = np.cumsum([0] + [p + 1 for p in self._n_possibilities], dtype=np.intp)[:-1]
+        self._encoders = [NBFunctions.get_encoder(feat_dict) for feat_dict in self._feat_dicts]
 
     @MultinomialNBTiming.timeit(level=1, prefix="[Core] ")
-    def _func(self, x, i):
-        x = np.atleast_2d(x).T
-        rs = np.ones(x.shape[1])
-        for d, xx in enumerate(x):
-            rs *= self._data[d][i][xx]
-        return rs * self._p_category[i]
+    def _log_func(self, x):
+        return np.sum(self._log_data[x + self._offsets], axis=1)
 
     @MultinomialNBTiming.timeit(level=1, prefix="[Core] ")
     def _transfer_x(self, x):
-        for i, sample in enumerate(x):
-            for j, char in enumerate(sample):
-                x[i][j] = self._feat_dicts[j][char]
-        return x
+        x = np.atleast_2d(np.asarray(x))
+        rs = np.empty(x.shape, dtype=np.intp)
+        for j, (encoder, p) in enumerate(zip(self._encoders, self._n_possibilities)):
+            rs[..., j] = NBFunctions.encode(x[..., j], encoder, p)
+        return rs
 
     def visualize(self, save=False):
         colors = plt.cm.Paired([i / len(self.label_dict) for i in range(len(self.label_dict))])
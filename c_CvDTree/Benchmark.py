@@ -0,0 +1,56 @@
+import os
+import sys
+root_path = os.path.abspath("../")
+if root_path not in sys.path:
+    sys.path.append(root_path)
+
+import time
+import numpy as np
+
+from c_CvDTree.Cluster import Cluster
+
+
+def scan_split(cluster, xt, criterion):
+    max_gain, max_feature, max_tar = 0, None, None
+    for feat, samples in enumerate(xt):
+        samples = np.sort(samples)
+        for tar in (samples[:-1] + samples[1:]) * 0.5:
+            gain = cluster.bin_info_gain(feat, tar, criterion=criterion, continuous=True)
+            if gain > max_gain:
+                max_gain, max_feature, max_tar = gain, feat, tar
+    return max_gain, max_feature, max_tar
+
+
+def sorted_split(cluster, xt, criterion):
+    max_gain, max_feature, max_tar = 0, None, None
+    for feat in range(len(xt)):
+        tars, gains, _ = cluster.sorted_bin_info_gain(feat, criterion=criterion)
+        arg = np.argmax(gains)  # type: int
+        if gains[arg] > max_gain:
+            max_gain, max_feature, max_tar = gains[arg], feat, tars[arg]
+    return max_gain, max_feature, max_tar
+
+
+def main(n_dim=4, criterion="gini", scan_bound=2000):
+    print("Node split time ({} features, criterion: {})".format(n_dim, criterion))
+    print("{:>10s} {:>14s} {:>14s} {:>8s}".format("rows", "scan (s)", "sorted (s)", "same"))
+    for n in (250, 500, 1000, 2000, 10 ** 4, 10 ** 5):
+        x = np.random.randn(n, n_dim).astype(np.float32)
+        y = (x[..., 0] + np.random.randn(n) * 0.5 > 0).astype(np.int8)
+        cluster = Cluster(x, y)
+        sorted_time = time.time()
+        sorted_rs = sorted_split(cluster, x.T, criterion)
+        sorted_time = time.time() - sorted_time
+        if n <= scan_bound:
+            scan_time = time.time()
+            scan_rs = scan_split(cluster, x.T, criterion)
+            scan_time = time.time() - scan_time
+            same = str(scan_rs[1:] == sorted_rs[1:])
+            scan_time = "{:14.6f}".format(scan_time)
+        else:
+            same, scan_time = "-", "{:>14s}".format("-")
+        print("{:>10d} {} {:14.6f} {:>8s}".format(n, scan_time, sorted_time, same))
+
+if __name__ == '__main__':
+    main()
+    main(criterion="ent")
@@ -11,8 +11,15 @@ from Util.Metas import TimingMeta
 
 
 class Cluster(metaclass=TimingMeta):
-    def __init__(self, x, y, sample_weight=None, base=2):
-        self._x, self._y = x.T, y
+    """
+        With 'indices', 'x' is the whole training matrix shared by a tree & the cluster holds the rows at 'indices';
+        only the columns which are actually scored are then gathered, so no sub-matrix is copied per node;
+        'x' may be None when every feature is scored from histograms ('hist_bin_info_gain')
+    """
+
+    def __init__(self, x, y, sample_weight=None, base=2, indices=None):
+        self._x = x if x is None or indices is not None else x.T
+        self._y, self._indices = y, indices
         if sample_weight is None:
             self._counters = np.bincount(self._y)
         else:
@@ -20,6 +27,7 @@ class Cluster(metaclass=TimingMeta):
             self._counters = np.bincount(self._y, weights=sample_weight * len(sample_weight))
         self._sample_weight = sample_weight
         self._con_chaos_cache = self._ent_cache = self._gini_cache = None
+        self._value_counts_cache = {}
         self._base = base
 
     def __str__(self):
@@ -30,11 +38,8 @@ class Cluster(metaclass=TimingMeta):
     def ent(self, ent=None, eps=1e-12):
         if self._ent_cache is not None and ent is None:
             return self._ent_cache
-        y_len = len(self._y)
-        if ent is None:
-            ent = self._counters
-        ent_cache = max(eps, -sum(
-            [c / y_len * math.log(c / y_len, self._base) if c != 0 else 0 for c in ent]))
+        p = np.asarray(self._counters if ent is None else ent) / len(self._y)
+        ent_cache = max(eps, -np.sum(p * (np.log(np.where(p > 0, p, 1)) / math.log(self._base))))
         if ent is None:
             self._ent_cache = ent_cache
         return ent_cache
@@ -42,39 +47,53 @@ class Cluster(metaclass=TimingMeta):
     def gini(self, p=None):
         if self._gini_cache is not None and p is None:
             return self._gini_cache
-        if p is None:
-            p = self._counters
-        gini_cache = 1 - np.sum((p / len(self._y)) ** 2)
+        gini_cache = 1 - np.sum((np.asarray(self._counters if p is None else p) / len(self._y)) ** 2)
         if p is None:
             self._gini_cache = gini_cache
         return gini_cache
 
-    def con_chaos(self, idx, criterion="ent", features=None):
-        if criterion == "ent":
-            method = lambda cluster: cluster.ent()
-        elif criterion == "gini":
-            method = lambda cluster: cluster.gini()
-        else:
-            raise NotImplementedError("Conditional info criterion '{}' not defined".format(criterion))
-        data = self._x[idx]
+    def _get_feature(self, idx):
+        if self._x is None:
+            raise ValueError("Cluster was built without samples, only histograms could be scored")
+        if self._indices is None:
+            return self._x[idx]
+        return self._x[self._indices, idx]
+
+    def _get_value_counts(self, idx):
+        # Class counts of every distinct value of a feature, from one bincount over (value, class) codes
+        if idx not in self._value_counts_cache:
+            values, codes = np.unique(self._get_feature(idx), return_inverse=True)
+            n_value, n_class = len(values), len(self._counters)
+            counts = np.bincount(
+                codes * n_class + self._y, self._sample_weight, minlength=n_value * n_class
+            ).reshape(n_value, n_class)
+            self._value_counts_cache[idx] = values, counts, np.bincount(codes, minlength=n_value)
+        return self._value_counts_cache[idx]
+
+    def _get_feature_counts(self, idx, features=None):
+        values, counts, lengths = self._get_value_counts(idx)
         if features is None:
-            features = np.unique(data)
-        tmp_labels = [data == feature for feature in features]
-        # noinspection PyTypeChecker
-        self._con_chaos_cache = [np.sum(label) for label in tmp_labels]
-        label_lst = [self._y[label] for label in tmp_labels]
-        rs, chaos_lst, xt = 0, [], self._x.T
-        append = chaos_lst.append
-        for data_label, tar_label in zip(tmp_labels, label_lst):
-            tmp_data = xt[data_label]
-            if self._sample_weight is None:
-                chaos = method(Cluster(tmp_data, tar_label, base=self._base))
-            else:
-                new_weights = self._sample_weight[data_label]
-                chaos = method(Cluster(tmp_data, tar_label, new_weights / np.sum(new_weights), base=self._base))
-            rs += len(tmp_data) / len(data) * chaos
-            append(chaos)
-        return rs, chaos_lst
+            return counts, lengths
+        features = np.array(list(features))
+        positions = np.minimum(np.searchsorted(values, features), len(values) - 1)
+        found = values[positions] == features
+        return counts[positions] * found[..., None], lengths[positions] * found
+
+    def _get_chaos(self, counts, criterion, eps=1e-12):
+        totals = np.sum(counts, axis=-1, keepdims=True)
+        p = counts / np.where(totals > 0, totals, 1)
+        if criterion == "gini":
+            return 1 - np.sum(p ** 2, axis=-1)
+        if criterion == "ent":
+            log_p = np.log(np.where(p > 0, p, 1)) / math.log(self._base)
+            return np.maximum(eps, -np.sum(p * log_p, axis=-1))
+        raise NotImplementedError("Conditional info criterion '{}' not defined".format(criterion))
+
+    def con_chaos(self, idx, criterion="ent", features=None):
+        counts, lengths = self._get_feature_counts(idx, features)
+        chaos_lst = self._get_chaos(counts, criterion)
+        self._con_chaos_cache = lengths
+        return np.sum(lengths / len(self._y) * chaos_lst), chaos_lst
 
     def info_gain(self, idx, criterion="ent", get_chaos_lst=False, features=None):
         if criterion in ("ent", "ratio"):
@@ -90,30 +109,21 @@ class Cluster(metaclass=TimingMeta):
         return (gain, chaos_lst) if get_chaos_lst else gain
 
     def bin_con_chaos(self, idx, tar, criterion="gini", continuous=False):
-        if criterion == "ent":
-            method = lambda cluster: cluster.ent()
-        elif criterion == "gini":
-            method = lambda cluster: cluster.gini()
+        if not continuous:
+            counts, lengths = self._get_feature_counts(idx)
+            left_counts, left_len = self._get_feature_counts(idx, [tar])
+            left_counts, left_len = left_counts[0], left_len[0]
+            total_counts, n_samples = np.sum(counts, axis=0), np.sum(lengths)
         else:
-            raise NotImplementedError("Conditional info criterion '{}' not defined".format(criterion))
-        data = self._x[idx]
-        tar = data == tar if not continuous else data < tar
-        tmp_labels = [tar, ~tar]
-        # noinspection PyTypeChecker
-        self._con_chaos_cache = [np.sum(label) for label in tmp_labels]
-        label_lst = [self._y[label] for label in tmp_labels]
-        rs, chaos_lst, xt = 0, [], self._x.T
-        append = chaos_lst.append
-        for data_label, tar_label in zip(tmp_labels, label_lst):
-            tmp_data = xt[data_label]
-            if self._sample_weight is None:
-                chaos = method(Cluster(tmp_data, tar_label, base=self._base))
-            else:
-                new_weights = self._sample_weight[data_label]
-                chaos = method(Cluster(tmp_data, tar_label, new_weights / np.sum(new_weights), base=self._base))
-            rs += len(tmp_data) / len(data) * chaos
-            append(chaos)
-        return rs, chaos_lst
+            mask = self._get_feature(idx) < tar
+            n_class = len(self._counters)
+            weights = None if self._sample_weight is None else self._sample_weight[mask]
+            left_counts = np.bincount(self._y[mask], weights, minlength=n_class)
+            left_len, n_samples = np.sum(mask), len(self._y)
+            total_counts = np.bincount(self._y, self._sample_weight, minlength=n_class)
+        self._con_chaos_cache = [left_len, n_samples - left_len]
+        chaos_lst = self._get_chaos(np.array([left_counts, total_counts - left_counts]), criterion)
+        return np.sum(np.array(self._con_chaos_cache) / len(self._y) * chaos_lst), list(chaos_lst)
 
     def bin_info_gain(self, idx, tar, criterion="gini", get_chaos_lst=False, continuous=False):
         if criterion in ("ent", "ratio"):
@@ -128,3 +138,62 @@ class Cluster(metaclass=TimingMeta):
         else:
             raise NotImplementedError("Info_gain criterion '{}' not defined".format(criterion))
         return (gain, chaos_lst) if get_chaos_lst else gain
+
+    def _get_parent_chaos(self, criterion):
+        if criterion in ("ent", "ratio"):
+            return self.ent()
+        if criterion == "gini":
+            return self.gini()
+        raise NotImplementedError("Info_gain criterion '{}' not defined".format(criterion))
+
+    def cat_bin_info_gain(self, idx, features, criterion="gini", eps=1e-12):
+        chaos = self._get_parent_chaos(criterion)
+        tars = list(features)
+        counts, lengths = self._get_feature_counts(idx)
+        left_counts, left_len = self._get_feature_counts(idx, tars)
+        right_counts = np.sum(counts, axis=0) - left_counts
+        gains, chaos_lst = self._bin_chaos_gains(chaos, left_counts, right_counts, left_len, criterion, eps)
+        return tars, gains, chaos_lst
+
+    def sorted_bin_info_gain(self, idx, criterion="gini", eps=1e-12):
+        chaos = self._get_parent_chaos(criterion)
+        data = self._get_feature(idx)
+        order = np.argsort(data, kind="mergesort")
+        samples, labels = data[order], self._y[order]
+        tars = (samples[:-1] + samples[1:]) * 0.5
+        n_samples, n_class = len(samples), len(self._counters)
+        if self._sample_weight is None:
+            weights = np.ones(n_samples)
+        else:
+            weights = self._sample_weight[order]
+        # Sweep cumulative class counts once instead of re-splitting the data for every threshold
+        cum_counts = np.zeros((n_samples + 1, n_class))
+        cum_counts[np.arange(1, n_samples + 1), labels] = weights
+        np.cumsum(cum_counts, axis=0, out=cum_counts)
+        left_len = np.searchsorted(samples, tars, side="left")
+        left_counts = cum_counts[left_len]
+        right_counts = cum_counts[-1] - left_counts
+        gains, chaos_lst = self._bin_chaos_gains(chaos, left_counts, right_counts, left_len, criterion, eps)
+        return tars, gains, chaos_lst
+
+    def hist_bin_info_gain(self, hist, bin_counts, criterion="gini", eps=1e-12):
+        chaos = self._get_parent_chaos(criterion)
+        tars = np.arange(1, len(hist))
+        left_counts = np.cumsum(hist, axis=0)[:-1]
+        right_counts = np.sum(hist, axis=0) - left_counts
+        left_len = np.cumsum(bin_counts)[:-1]
+        gains, chaos_lst = self._bin_chaos_gains(chaos, left_counts, right_counts, left_len, criterion, eps)
+        return tars, gains, chaos_lst
+
+    def _bin_chaos_gains(self, chaos, left_counts, right_counts, left_len, criterion, eps):
+        n_samples = len(self._y)
+        chaos_lst = self._get_chaos(
+            np.stack([left_counts, right_counts], axis=1), "gini" if criterion == "gini" else "ent", eps)
+        lengths = np.stack([left_len, n_samples - left_len], axis=1) / n_samples
+        gains = chaos - np.sum(lengths * chaos_lst, axis=1)
+        if criterion == "ratio":
+            log_lengths = np.log(np.where(lengths > 0, lengths, 1)) / math.log(self._base)
+            gains /= np.maximum(eps, -np.sum(lengths * log_lengths, axis=1))
+        # Thresholds leaving one side empty are not real splits
+        gains[(left_len == 0) | (left_len == n_samples)] = 0
+        return gains, chaos_lst
@@ -15,12 +15,11 @@ from Util.Metas import TimingMeta
 class CvDNode(metaclass=TimingMeta):
     def __init__(self, tree=None, base=2, chaos=None,
                  depth=0, parent=None, is_root=True, prev_feat="Root", **kwargs):
-        self._x = self._y = None
+        self._start = self._end = self._counts = None
         self.base, self.chaos = base, chaos
         self.criterion = self.category = None
         self.left_child = self.right_child = None
         self._children, self.leafs = {}, {}
-        self.sample_weight = None
         self.wc = None
 
         self.tree = tree
@@ -64,18 +63,22 @@ class CvDNode(metaclass=TimingMeta):
             return 1
         return 1 + max([child.height if child is not None else 0 for child in self.children.values()])
 
+    @property
+    def n_samples(self):
+        return self._end - self._start
+
     @property
     def info_dict(self):
         return {
             "chaos": self.chaos,
-            "y": self._y
+            "n_samples": self.n_samples
         }
 
     # Grow
 
     def stop1(self, eps):
         if (
-            self._x.shape[1] == 0 or (self.chaos is not None and self.chaos <= eps)
+            not self.feats or (self.chaos is not None and self.chaos <= eps)
             or (self.tree.max_depth is not None and self._depth >= self.tree.max_depth)
         ):
             self._handle_terminate()
@@ -89,7 +92,7 @@ class CvDNode(metaclass=TimingMeta):
         return False
 
     def get_category(self):
-        return np.argmax(np.bincount(self._y))
+        return np.argmax(self._counts)
 
     def _handle_terminate(self):
         self.category = self.get_category()
@@ -121,12 +124,42 @@ class CvDNode(metaclass=TimingMeta):
             if child is not None:
                 child.mark_pruned()
 
-    def fit(self, x, y, sample_weight, feature_bound=None, eps=1e-8):
-        self._x, self._y = np.atleast_2d(x), np.asarray(y)
-        self.sample_weight = sample_weight
+    def fit(self, start, end, feature_bound=None, eps=1e-8, hists=None):
+        tree = self.tree
+        self._start, self._end = start, end
+        indices = tree.indices[start:end]
+        self._counts = np.bincount(tree.y_train[indices], minlength=len(tree.y_transformer))
         if self.stop1(eps):
             return
-        cluster = Cluster(self._x, self._y, sample_weight, self.base)
+        if hists is None and tree.bin_edges is not None:
+            hists = self._get_hists(indices)
+        max_gain, chaos_lst, max_feature, max_tar = self._get_split(indices, feature_bound, hists)
+        if self.stop2(max_gain, eps):
+            return
+        self.feature_dim = max_feature
+        if self.is_cart or self.wc[max_feature]:
+            self.tar = max_tar
+            self._gen_children(chaos_lst, feature_bound, hists)
+            if (self.left_child.category is not None and
+                    self.left_child.category == self.right_child.category):
+                self.prune()
+                self.tree.reduce_nodes()
+        else:
+            self._gen_children(chaos_lst, feature_bound)
+
+    def _get_split(self, indices, feature_bound, hists):
+        tree = self.tree
+        if tree.w_train is None:
+            sample_weight = None
+        else:
+            sample_weight = tree.w_train[indices]
+            sample_weight /= np.sum(sample_weight)
+        # Histograms cover every continuous feature, so samples are only needed for categorical ones
+        if hists is not None and all(feat in hists for feat in self.feats):
+            x = None
+        else:
+            x = tree.x_train
+        cluster = Cluster(x, tree.y_train[indices], sample_weight, self.base, indices)
         if self.is_root:
             if self.criterion == "gini":
                 self.chaos = cluster.gini()
@@ -142,56 +175,76 @@ class CvDNode(metaclass=TimingMeta):
         else:
             indices = np.random.permutation(feat_len)[:feature_bound]
         tmp_feats = [self.feats[i] for i in indices]
-        xt, feat_sets = self._x.T, self.tree.feature_sets
-        bin_ig, ig = cluster.bin_info_gain, cluster.info_gain
+        feat_sets = tree.feature_sets
+        ig, cat_bin_ig = cluster.info_gain, cluster.cat_bin_info_gain
+        sorted_bin_ig, hist_bin_ig = cluster.sorted_bin_info_gain, cluster.hist_bin_info_gain
         for feat in tmp_feats:
-            if self.wc[feat]:
-                samples = np.sort(xt[feat])
-                feat_set = (samples[:-1] + samples[1:]) * 0.5
-            else:
-                if self.is_cart:
-                    feat_set = feat_sets[feat]
+            if self.wc[feat] or self.is_cart:
+                if not self.wc[feat]:
+                    tars, gains, tmp_chaos_lst = cat_bin_ig(feat, feat_sets[feat], criterion=self.criterion)
+                elif hists is None:
+                    tars, gains, tmp_chaos_lst = sorted_bin_ig(feat, criterion=self.criterion)
                 else:
-                    feat_set = None
-            if self.is_cart or self.wc[feat]:
-                for tar in feat_set:
-                    tmp_gain, tmp_chaos_lst = bin_ig(
-                        feat, tar, criterion=self.criterion, get_chaos_lst=True, continuous=self.wc[feat])
-                    if tmp_gain > max_gain:
-                        (max_gain, chaos_lst), max_feature, max_tar = (tmp_gain, tmp_chaos_lst), feat, tar
+                    tars, gains, tmp_chaos_lst = hist_bin_ig(*hists[feat], criterion=self.criterion)
+                if len(gains) == 0:
+                    continue
+                arg = np.argmax(gains)  # type: int
+                if gains[arg] > max_gain:
+                    max_gain, chaos_lst = gains[arg], list(tmp_chaos_lst[arg])
+                    max_feature, max_tar = feat, tars[arg]
             else:
                 tmp_gain, tmp_chaos_lst = ig(
-                    feat, self.criterion, True, self.tree.feature_sets[feat])
+                    feat, self.criterion, True, feat_sets[feat])
                 if tmp_gain > max_gain:
                     (max_gain, chaos_lst), max_feature = (tmp_gain, tmp_chaos_lst), feat
-        if self.stop2(max_gain, eps):
-            return
-        self.feature_dim = max_feature
-        if self.is_cart or self.wc[max_feature]:
-            self.tar = max_tar
-            self._gen_children(chaos_lst, feature_bound)
-            if (self.left_child.category is not None and
-                    self.left_child.category == self.right_child.category):
-                self.prune()
-                self.tree.reduce_nodes()
-        else:
-            self._gen_children(chaos_lst, feature_bound)
-
-    def _gen_children(self, chaos_lst, feature_bound):
+        return max_gain, chaos_lst, max_feature, max_tar
+
+    def _get_hists(self, indices):
+        tree = self.tree
+        n_class, hists = len(tree.y_transformer), {}
+        y = tree.y_train[indices]
+        sample_weight = None if tree.w_train is None else tree.w_train[indices]
+        for feat, edges in enumerate(tree.bin_edges):
+            if edges is None:
+                continue
+            n_bins = len(edges) + 1
+            codes = tree.x_train[indices, feat].astype(np.intp)
+            hist = np.bincount(codes * n_class + y, sample_weight, minlength=n_bins * n_class)
+            hists[feat] = hist.reshape(n_bins, n_class), np.bincount(codes, minlength=n_bins)
+        return hists
+
+    def _get_child_hists(self, hists, bounds):
+        if hists is None:
+            return [None] * len(bounds)
+        # Only the smaller child is scanned, the other one is parent - sibling
+        lengths = [end - start for start, end in bounds]
+        small = int(lengths[0] > lengths[1])
+        small_hists = self._get_hists(self.tree.indices[slice(*bounds[small])])
+        large_hists = {}
+        for feat, (hist, bin_counts) in hists.items():
+            small_hist, small_bin_counts = small_hists[feat]
+            large_hist = hist - small_hist
+            if self.tree.w_train is not None:
+                np.maximum(large_hist, 0, out=large_hist)
+            large_hists[feat] = large_hist, bin_counts - small_bin_counts
+        return [small_hists, large_hists] if small == 0 else [large_hists, small_hists]
+
+    def _gen_children(self, chaos_lst, feature_bound, hists=None):
         feat, tar = self.feature_dim, self.tar
         self.is_continuous = continuous = self.wc[feat]
-        features = self._x[..., feat]
+        # A view into the tree's shared permutation, children are partitioned in place
+        indices = self.tree.indices[self._start:self._end]
+        features = self.tree.x_train[indices, feat]
         new_feats = self.feats.copy()
         if continuous:
             mask = features < tar
-            masks = [mask, ~mask]
+            if self.tree.bin_edges is not None:
+                self.tar = tar = self.tree.bin_edges[feat][tar - 1]
+        elif self.is_cart:
+            mask = features == tar
+            self.tree.feature_sets[feat].discard(tar)
         else:
-            if self.is_cart:
-                mask = features == tar
-                masks = [mask, ~mask]
-                self.tree.feature_sets[feat].discard(tar)
-            else:
-                masks = None
+            mask = None
         if self.is_cart or continuous:
             feats = [tar, "+"] if not continuous else ["{:6.4}-".format(tar), "{:6.4}+".format(tar)]
             for feat, side, chaos in zip(feats, ["left_child", "right_child"], chaos_lst):
@@ -200,35 +253,36 @@ class CvDNode(metaclass=TimingMeta):
                     depth=self._depth + 1, parent=self, is_root=False, prev_feat=feat)
                 new_node.criterion = self.criterion
                 setattr(self, side, new_node)
-            for node, feat_mask in zip([self.left_child, self.right_child], masks):
-                if self.sample_weight is None:
-                    local_weights = None
-                else:
-                    local_weights = self.sample_weight[feat_mask]
-                    local_weights /= np.sum(local_weights)
-                tmp_data, tmp_labels = self._x[feat_mask, ...], self._y[feat_mask]
-                if len(tmp_labels) == 0:
+            n_left = int(np.sum(mask))
+            indices[:] = np.concatenate([indices[mask], indices[~mask]])
+            del features, mask
+            bounds = [(self._start, self._start + n_left), (self._start + n_left, self._end)]
+            child_hists = self._get_child_hists(hists, bounds)
+            for node, (start, end), tmp_hists in zip([self.left_child, self.right_child], bounds, child_hists):
+                if start == end:
                     continue
                 node.feats = new_feats
-                node.fit(tmp_data, tmp_labels, local_weights, feature_bound)
+                node.fit(start, end, feature_bound, hists=tmp_hists)
         else:
             new_feats.remove(self.feature_dim)
-            for feat, chaos in zip(self.tree.feature_sets[self.feature_dim], chaos_lst):
-                feat_mask = features == feat
-                tmp_x = self._x[feat_mask, ...]
-                if len(tmp_x) == 0:
+            feat_set = list(self.tree.feature_sets[self.feature_dim])
+            codes = np.zeros(len(features), dtype=np.intp)
+            for i, feat in enumerate(feat_set):
+                codes[features == feat] = i
+            indices[:] = indices[np.argsort(codes, kind="mergesort")]
+            ends = self._start + np.cumsum(np.bincount(codes, minlength=len(feat_set)))
+            del features, codes
+            start = self._start
+            for feat, chaos, end in zip(feat_set, chaos_lst, ends):
+                if start == end:
                     continue
                 new_node = self.__class__(
                     tree=self.tree, base=self.base, chaos=chaos,
                     depth=self._depth + 1, parent=self, is_root=False, prev_feat=feat)
                 new_node.feats = new_feats
                 self.children[feat] = new_node
-                if self.sample_weight is None:
-                    local_weights = None
-                else:
-                    local_weights = self.sample_weight[feat_mask]
-                    local_weights /= np.sum(local_weights)
-                new_node.fit(tmp_x, self._y[feat_mask], local_weights, feature_bound)
+                new_node.fit(start, end, feature_bound)
+                start = end
 
     # Util
 
@@ -241,8 +295,8 @@ class CvDNode(metaclass=TimingMeta):
 
     def cost(self, pruned=False):
         if not pruned:
-            return sum([leaf["chaos"] * len(leaf["y"]) for leaf in self.leafs.values()])
-        return self.chaos * len(self._y)
+            return sum([leaf["chaos"] * leaf["n_samples"] for leaf in self.leafs.values()])
+        return self.chaos * self.n_samples
 
     def get_threshold(self):
         return (self.cost(pruned=True) - self.cost()) / (len(self.leafs) - 1)
@@ -279,7 +333,7 @@ class CvDNode(metaclass=TimingMeta):
                 return self.get_category()
 
     def predict(self, x):
-        return np.array([self.predict_one(xx) for xx in x])
+        return FlatTree(self).predict(x)
 
     def view(self, indent=4):
         print(" " * indent * self._depth, self.info)
@@ -306,3 +360,217 @@ class CartNode(CvDNode):
         CvDNode.__init__(self, *args, **kwargs)
         self.criterion = "gini"
         self.is_cart = True
+
+
+class FlatTree(metaclass=TimingMeta):
+    leaf, continuous, cart, multi = range(4)
+
+    def __init__(self, root):
+        nodes, parents = [root], [None]
+        for node in nodes:
+            if node.category is None:
+                for key in sorted(node.children, key=str):
+                    child = node.children[key]
+                    if child is not None:
+                        nodes.append(child)
+                        parents.append(node)
+        ids = {id(node): i for i, node in enumerate(nodes)}
+        n_nodes = len(nodes)
+        self.kinds = np.zeros(n_nodes, dtype=np.int8)
+        self.feats = np.zeros(n_nodes, dtype=np.intp)
+        self.tars = np.zeros(n_nodes)
+        self.codes = np.zeros(n_nodes, dtype=np.intp)
+        self.lefts = np.zeros(n_nodes, dtype=np.intp)
+        self.rights = np.zeros(n_nodes, dtype=np.intp)
+        self.categories = np.zeros(n_nodes, dtype=np.intp)
+        values = [node.tar for node in nodes if node.category is None and node.is_cart and not node.is_continuous]
+        values += [key for node in nodes if node.category is None and not (node.is_cart or node.is_continuous)
+                   for key in node.children]
+        self.values = np.unique(np.array(values)) if values else np.array([])
+        keys, key_children = [], []
+        for i, (node, parent) in enumerate(zip(nodes, parents)):
+            if node.category is not None:
+                self.categories[i] = node.category
+                continue
+            if node.feature_dim is None:
+                # Children left without samples fall back to the majority class of their parent
+                self.categories[i] = self.categories[ids[id(parent)]]
+                continue
+            self.feats[i], self.categories[i] = node.feature_dim, node.get_category()
+            if node.is_continuous or node.is_cart:
+                self.lefts[i], self.rights[i] = ids[id(node.left_child)], ids[id(node.right_child)]
+                if node.is_continuous:
+                    self.kinds[i], self.tars[i] = FlatTree.continuous, node.tar
+                else:
+                    self.kinds[i], self.codes[i] = FlatTree.cart, np.searchsorted(self.values, node.tar)
+            else:
+                self.kinds[i] = FlatTree.multi
+                for key, child in node.children.items():
+                    keys.append(i * len(self.values) + np.searchsorted(self.values, key))
+                    key_children.append(ids[id(child)])
+        order = np.argsort(keys)
+        self.keys = np.array(keys, dtype=np.intp)[order]
+        self.key_children = np.array(key_children, dtype=np.intp)[order]
+
+    def __str__(self):
+        return "FlatTree"
+
+    __repr__ = __str__
+
+    def _encode(self, data):
+        codes = np.searchsorted(self.values, data)
+        np.minimum(codes, len(self.values) - 1, out=codes)
+        found = self.values[codes] == data
+        return codes, found
+
+    def _route(self, x, rows, nodes, emit):
+        # Route all rows one level down at a time until every row lands on a leaf
+        while len(rows):
+            kinds = self.kinds[nodes]
+            mask = kinds == FlatTree.leaf
+            emit(rows[mask], nodes[mask])
+            mask = ~mask
+            rows, nodes, kinds = rows[mask], nodes[mask], kinds[mask]
+            if not len(rows):
+                break
+            data = x[rows, self.feats[nodes]]
+            mask = kinds == FlatTree.continuous
+            if np.any(mask):
+                local_nodes = nodes[mask]
+                nodes[mask] = np.where(
+                    data[mask] < self.tars[local_nodes], self.lefts[local_nodes], self.rights[local_nodes])
+            mask = kinds == FlatTree.cart
+            if np.any(mask):
+                local_nodes = nodes[mask]
+                codes, found = self._encode(data[mask])
+                nodes[mask] = np.where(
+                    found & (codes == self.codes[local_nodes]), self.lefts[local_nodes], self.rights[local_nodes])
+            mask = kinds == FlatTree.multi
+            if np.any(mask):
+                local_nodes = nodes[mask]
+                codes, found = self._encode(data[mask])
+                keys = local_nodes * len(self.values) + codes
+                positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+                found &= self.keys[positions] == keys
+                # Unseen categories stop at the current node, just like CvDNode.predict_one
+                nodes[mask] = np.where(found, self.key_children[positions], local_nodes)
+                emit(rows[mask][~found], local_nodes[~found])
+                mask[mask] = ~found
+                rows, nodes = rows[~mask], nodes[~mask]
+
+    def predict(self, x, **kwargs):
+        x = np.atleast_2d(x)
+        rs = np.empty(len(x), dtype=np.intp)
+
+        def emit(rows, nodes):
+            rs[rows] = self.categories[nodes]
+
+        self._route(x, np.arange(len(x)), np.zeros(len(x), dtype=np.intp), emit)
+        return rs
+
+
+class FlatForest(FlatTree):
+    """
+        Several FlatTrees stacked into one set of node arrays
+        Every (row, tree) pair of a batch is routed at once and leaves are accumulated in place,
+        so neither a per-tree loop nor an (n_samples x n_trees) prediction matrix is needed
+    """
+
+    def __init__(self, flat_trees, transformers=None, batch_size=2 ** 14):
+        if transformers is None:
+            transformers = [None] * len(flat_trees)
+        self.batch_size = batch_size
+        self.values = np.unique(np.concatenate([tree.values for tree in flat_trees])) if flat_trees else np.array([])
+        n_values = len(self.values)
+        offsets = np.cumsum([0] + [len(tree.kinds) for tree in flat_trees])
+        self.roots = offsets[:-1].astype(np.intp)
+        self.tree_ids = np.repeat(np.arange(len(flat_trees)), np.diff(offsets))
+        self.kinds = np.concatenate([tree.kinds for tree in flat_trees])
+        self.feats = np.concatenate([tree.feats for tree in flat_trees])
+        self.tars = np.concatenate([tree.tars for tree in flat_trees])
+        self.lefts = np.concatenate([tree.lefts + offset for tree, offset in zip(flat_trees, offsets)])
+        self.rights = np.concatenate([tree.rights + offset for tree, offset in zip(flat_trees, offsets)])
+        self.categories = np.concatenate([
+            tree.categories if transformer is None else transformer[tree.categories]
+            for tree, transformer in zip(flat_trees, transformers)
+        ])
+        codes, keys, key_children = [], [], []
+        for tree, offset in zip(flat_trees, offsets):
+            tree_codes = np.zeros(len(tree.kinds), dtype=np.intp)
+            mask = tree.kinds == FlatTree.cart
+            tree_codes[mask] = np.searchsorted(self.values, tree.values[tree.codes[mask]])
+            codes.append(tree_codes)
+            if len(tree.keys):
+                local_nodes, local_codes = np.divmod(tree.keys, len(tree.values))
+                keys.append((local_nodes + offset) * n_values + np.searchsorted(self.values, tree.values[local_codes]))
+                key_children.append(tree.key_children + offset)
+        self.codes = np.concatenate(codes)
+        keys = np.concatenate(keys) if keys else np.array([], dtype=np.intp)
+        order = np.argsort(keys)
+        self.keys = keys[order]
+        self.key_children = np.concatenate(key_children)[order] if key_children else keys
+        self.n_levels = None
+        if np.all((self.kinds == FlatTree.leaf) | (self.kinds == FlatTree.continuous)):
+            # Continuous only forests are routed level by level with leaves pointing at themselves,
+            # which trades the masking of FlatTree._route for a fixed number of plain gathers
+            levels = np.zeros(len(self.kinds), dtype=np.intp)
+            for i in np.flatnonzero(self.kinds == FlatTree.continuous):
+                levels[self.lefts[i]] = levels[self.rights[i]] = levels[i] + 1
+            self.n_levels = int(levels.max()) if len(levels) else 0
+            leaves = np.flatnonzero(self.kinds == FlatTree.leaf)
+            self.lefts[leaves] = self.rights[leaves] = leaves
+
+    def __str__(self):
+        return "FlatForest"
+
+    __repr__ = __str__
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def _node_weights(self, weights):
+        if weights is None:
+            return np.ones(len(self.kinds))
+        return np.asarray(weights, dtype=np.float64)[self.tree_ids]
+
+    def _accumulate(self, x, start, bound, node_weights, n_classes=None, per_tree=False):
+        x = np.atleast_2d(x)
+        roots = self.roots[start:bound]
+        if per_tree:
+            n_outputs = len(roots)
+        else:
+            n_outputs = 1 if n_classes is None else n_classes
+        rs = np.zeros((len(x), n_outputs))
+        step = max(1, self.batch_size // max(1, len(roots)))
+        for i in range(0, len(x), step):
+            local_x = x[i:i + step]
+            local_rs = rs[i:i + len(local_x)].ravel()
+
+            def emit(rows, nodes):
+                if per_tree:
+                    rows = rows * n_outputs + self.tree_ids[nodes] - start
+                elif n_classes is not None:
+                    rows = rows * n_classes + self.categories[nodes]
+                local_rs[...] += np.bincount(rows, node_weights[nodes], minlength=len(local_rs))
+
+            rows, nodes = np.repeat(np.arange(len(local_x)), len(roots)), np.tile(roots, len(local_x))
+            if self.n_levels is None:
+                self._route(local_x, rows, nodes, emit)
+                continue
+            nodes = nodes.reshape(len(local_x), len(roots))
+            for _ in range(self.n_levels):
+                data = np.take_along_axis(local_x, self.feats[nodes], axis=1)
+                nodes = np.where(data < self.tars[nodes], self.lefts[nodes], self.rights[nodes])
+            emit(rows, nodes.ravel())
+        return rs if n_classes is not None or per_tree else rs[..., 0]
+
+    def decision_function(self, x, weights=None, bound=None, start=0):
+        return self._accumulate(x, start, bound, self._node_weights(weights) * self.categories)
+
+    def tree_decision_function(self, x, weights=None, bound=None, start=0):
+        """ (n_samples, n_trees) matrix of the weighted leaf values of trees[start:bound] """
+        return self._accumulate(x, start, bound, self._node_weights(weights) * self.categories, per_tree=True)
+
+    def vote(self, x, n_classes, weights=None, bound=None, start=0):
+        return self._accumulate(x, start, bound, self._node_weights(weights), n_classes)
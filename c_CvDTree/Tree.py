@@ -15,7 +15,7 @@ from Util.Bases import ClassifierBase
 
 def cvd_task(args):
     x, clf, n_cores = args
-    return np.array([clf.root.predict_one(xx) for xx in x])
+    return clf.flat_tree.predict(x)
 
 
 class CvDBase(ClassifierBase):
@@ -27,6 +27,9 @@ class CvDBase(ClassifierBase):
         self.max_depth = max_depth
         self.root = node
         self.feature_sets = []
+        self.bin_edges = None
+        self.x_train = self.y_train = self.w_train = self.indices = None
+        self._flat_tree = None
         self.prune_alpha = 1
         self.y_transformer = None
         self.whether_continuous = whether_continuous
@@ -36,8 +39,9 @@ class CvDBase(ClassifierBase):
         self._params["cv_rate"] = kwargs.get("cv_rate", 0.2)
         self._params["train_only"] = kwargs.get("train_only", False)
         self._params["feature_bound"] = kwargs.get("feature_bound", None)
+        self._params["max_bins"] = kwargs.get("max_bins", None)
 
-    def feed_data(self, x, continuous_rate=0.2):
+    def feed_data(self, x, continuous_rate=0.2, max_bins=None):
         xt = x.T
         self.feature_sets = [set(dimension) for dimension in xt]
         data_len, data_dim = x.shape
@@ -48,12 +52,37 @@ class CvDBase(ClassifierBase):
             self.whether_continuous = np.asarray(self.whether_continuous)
         self.root.feats = [i for i in range(x.shape[1])]
         self.root.feed_tree(self)
+        if max_bins is None:
+            self.bin_edges = None
+            return x
+        return self._bin_data(x, max_bins)
+
+    @staticmethod
+    def _get_bin_edges(feat, max_bins):
+        values = np.unique(feat)
+        if len(values) <= max_bins:
+            return (values[:-1] + values[1:]) * 0.5
+        return np.unique(np.percentile(feat, np.linspace(0, 100, max_bins + 1)[1:-1]))
+
+    def _bin_data(self, x, max_bins):
+        self.bin_edges = [
+            CvDBase._get_bin_edges(feat, max_bins) if continuous else None
+            for feat, continuous in zip(x.T, self.whether_continuous)
+        ]
+        if np.all(self.whether_continuous):
+            binned_x = np.empty(x.shape, dtype=np.uint8 if max_bins <= 256 else np.uint16)
+        else:
+            binned_x = x.copy()
+        for i, edges in enumerate(self.bin_edges):
+            if edges is not None:
+                binned_x[..., i] = np.searchsorted(edges, x[..., i], side="right")
+        return binned_x
 
     # Grow
 
     @CvDBaseTiming.timeit(level=1, prefix="[API] ")
     def fit(self, x, y, sample_weight=None, alpha=None, eps=None,
-            cv_rate=None, train_only=None, feature_bound=None):
+            cv_rate=None, train_only=None, feature_bound=None, max_bins=None):
         if sample_weight is None:
             sample_weight = self._params["sample_weight"]
         if alpha is None:
@@ -66,6 +95,8 @@ class CvDBase(ClassifierBase):
             train_only = self._params["train_only"]
         if feature_bound is None:
             feature_bound = self._params["feature_bound"]
+        if max_bins is None:
+            max_bins = self._params["max_bins"]
         self.y_transformer, y = np.unique(y, return_inverse=True)
         x = np.atleast_2d(x)
         self.prune_alpha = alpha if alpha is not None else x.shape[1] / 2
@@ -86,9 +117,13 @@ class CvDBase(ClassifierBase):
         else:
             x_train, y_train, train_weights = x, y, sample_weight
             x_cv = y_cv = test_weights = None
-        self.feed_data(x_train)
-        self.root.fit(x_train, y_train, train_weights, feature_bound, eps)
+        self.x_train = self.feed_data(x_train, max_bins=max_bins)
+        self.y_train, self.w_train = y_train, train_weights
+        self.indices = np.arange(len(x_train))
+        self.root.fit(0, len(x_train), feature_bound, eps)
+        self.x_train = self.y_train = self.w_train = self.indices = None
         self.prune(x_cv, y_cv, test_weights)
+        self._flat_tree = FlatTree(self.root)
 
     @CvDBaseTiming.timeit(level=3, prefix="[Util] ")
     def reduce_nodes(self):
@@ -175,6 +210,12 @@ class CvDBase(ClassifierBase):
 
     # Util
 
+    @property
+    def flat_tree(self):
+        if self._flat_tree is None:
+            self._flat_tree = FlatTree(self.root)
+        return self._flat_tree
+
     @CvDBaseTiming.timeit(level=1, prefix="[API] ")
     def predict_one(self, x):
         return self.y_transformer[self.root.predict_one(x)]
@@ -247,7 +288,7 @@ class CvDMeta(type):
 
         def __init__(self, whether_continuous=None, max_depth=None, node=None, **_kwargs):
             tmp_node = node if isinstance(node, CvDNode) else _node
-            CvDBase.__init__(self, whether_continuous, max_depth, tmp_node(**_kwargs))
+            CvDBase.__init__(self, whether_continuous, max_depth, tmp_node(**_kwargs), **_kwargs)
             self._name = name
 
         attr["__init__"] = __init__
@@ -49,6 +49,7 @@ class AdaBoost(ClassifierBase):
         super(AdaBoost, self).__init__(**kwargs)
         self._clf, self._clfs, self._clfs_weights = "", [], []
         self._kwarg_cache = {}
+        self._forest = None
 
         self._params["clf"] = kwargs.get("clf", None)
         self._params["epoch"] = kwargs.get("epoch", 10)
@@ -86,6 +87,7 @@ class AdaBoost(ClassifierBase):
             kwargs = {"max_depth": 1}
         self._kwarg_cache = kwargs
         self._clf = clf
+        self._forest = None
         if sample_weight is None:
             sample_weight = np.ones(len(y)) / len(y)
         else:
@@ -104,17 +106,72 @@ class AdaBoost(ClassifierBase):
             bar.update()
         self._clfs_weights = np.array(self._clfs_weights, dtype=np.float32)
 
+    @property
+    def forest(self):
+        if self._forest is None and self._clfs and all(isinstance(clf, CvDBase) for clf in self._clfs):
+            self._forest = FlatForest(
+                [clf.flat_tree for clf in self._clfs], [clf.y_transformer for clf in self._clfs])
+        return self._forest
+
+    def _get_clfs(self, bound):
+        if bound is None:
+            return self._clfs, self._clfs_weights
+        return self._clfs[:bound], self._clfs_weights[:bound]
+
+    @AdaBoostTiming.timeit(level=1, prefix="[Core] ")
+    def _cascade(self, x, bound=None, block=1):
+        clfs, clfs_weights = self._get_clfs(bound)
+        rs = np.zeros(len(x))
+        rows = np.arange(len(x))
+        # Weak predictions are +-1, so the learners left can move a score by at most the sum of their |weights|
+        remains = np.append(np.cumsum(np.abs(clfs_weights)[::-1])[::-1], 0)
+        for start in range(0, len(clfs), block):
+            end = min(start + block, len(clfs))
+            local_x = x[rows]
+            if self.forest is not None:
+                rs[rows] += self._forest.decision_function(local_x, self._clfs_weights, end, start)
+            else:
+                for clf, weight in zip(clfs[start:end], clfs_weights[start:end]):
+                    rs[rows] += weight * clf.predict(local_x)
+            rows = rows[np.abs(rs[rows]) <= remains[end]]
+            if not len(rows):
+                break
+        return rs
+
+    def staged_decision_function(self, x, bound=None, block=64):
+        x = np.atleast_2d(x)
+        clfs, clfs_weights = self._get_clfs(bound)
+        rs = np.zeros(len(x))
+        if self.forest is not None:
+            # Per-tree outputs are routed 'block' trees at a time, which bounds the (n_samples x block) matrix
+            for start in range(0, len(clfs), block):
+                end = min(start + block, len(clfs))
+                for column in self._forest.tree_decision_function(x, self._clfs_weights, end, start).T:
+                    rs += column
+                    yield rs.copy()
+            return
+        for clf, weight in zip(clfs, clfs_weights):
+            rs += weight * clf.predict(x)
+            yield rs.copy()
+
+    def staged_predict(self, x, bound=None):
+        for rs in self.staged_decision_function(x, bound):
+            yield np.sign(rs)
+
     @AdaBoostTiming.timeit(level=1, prefix="[API] ")
-    def predict(self, x, get_raw_results=False, bound=None, **kwargs):
+    def predict(self, x, get_raw_results=False, bound=None, cascade=False, **kwargs):
         x = np.atleast_2d(x)
-        if bound is None:
-            clfs, clfs_weights = self._clfs, self._clfs_weights
+        if cascade:
+            # Raw results of rows that exit early are partial scores with the final sign
+            rs = self._cascade(x, bound, int(cascade))
+        elif self.forest is not None:
+            rs = self._forest.decision_function(x, self._clfs_weights, bound)
         else:
-            clfs, clfs_weights = self._clfs[:bound], self._clfs_weights[:bound]
-        matrix = self._multi_clf(x, clfs, boost_task, kwargs)
-        matrix *= clfs_weights
-        rs = np.sum(matrix, axis=1)
-        del matrix
+            clfs, clfs_weights = self._get_clfs(bound)
+            matrix = self._multi_clf(x, clfs, boost_task, kwargs)
+            matrix *= clfs_weights
+            rs = np.sum(matrix, axis=1)
+            del matrix
         if not get_raw_results:
             return np.sign(rs)
         return rs
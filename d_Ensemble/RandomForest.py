@@ -4,15 +4,75 @@ root_path = os.path.abspath("../")
 if root_path not in sys.path:
     sys.path.append(root_path)
 
+import multiprocessing
+from functools import partial
+from multiprocessing import Pool, shared_memory
+
 from c_CvDTree.Tree import *
 
 from Util.Util import DataUtil
 from Util.ProgressBar import ProgressBar
 
+rf_shared = {}
+
+
+def rf_task(args, bound=None):
+    x, rf, n_cores = args
+    return rf.forest.vote(x, len(rf.classes), bound=bound)
+
+
+def rf_share(arr):
+    if arr.dtype.hasobject:
+        return None, arr
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def rf_attach(info):
+    if isinstance(info, np.ndarray):
+        return None, info
+    name, shape, dtype = info
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype, buffer=shm.buf)
+
 
-def rf_task(args):
-    x, trees, n_cores = args
-    return [tree.predict(x, n_cores=n_cores) for tree in trees]
+def rf_init(x_info, y_info, w_info, timed=False):
+    rf_shared.clear()
+    rf_shared["timed"] = timed
+    if timed:
+        Timing.enabled = True
+    for key, info in zip(("x", "y", "w"), (x_info, y_info, w_info)):
+        if info is None:
+            rf_shared[key] = None
+        else:
+            rf_shared[key + "_shm"], rf_shared[key] = rf_attach(info)
+
+
+def rf_fit_task(args):
+    seed, tree, feature_bound, kwargs = args
+    x, y, sample_weight = rf_shared["x"], rf_shared["y"], rf_shared["w"]
+    np.random.seed(seed)
+    n_sample = len(y)
+    indices = np.random.randint(n_sample, size=n_sample)
+    if sample_weight is None:
+        local_weight = None
+    else:
+        local_weight = sample_weight[indices]
+        local_weight /= local_weight.sum()
+    tmp_tree = RandomForest.cvd_trees[tree](**kwargs)
+    tmp_tree.fit(x[indices], y[indices], sample_weight=local_weight, feature_bound=feature_bound)
+    flat_tree = tmp_tree.flat_tree
+    flat_tree.categories = tmp_tree.y_transformer[flat_tree.categories]
+    return flat_tree
+
+
+def rf_fit_worker(args):
+    # Pool workers send back the timings of their task, which are merged by the parent
+    timed = rf_shared["timed"]
+    if timed:
+        Timing.reset()
+    return rf_fit_task(args), Timing.snapshot() if timed else None
 
 
 class RandomForest(ClassifierBase):
@@ -26,23 +86,29 @@ class RandomForest(ClassifierBase):
     def __init__(self, **kwargs):
         super(RandomForest, self).__init__(**kwargs)
         self._tree, self._trees = "", []
+        self._classes = self._forest = None
 
         self._params["tree"] = kwargs.get("tree", "Cart")
         self._params["epoch"] = kwargs.get("epoch", 10)
         self._params["feature_bound"] = kwargs.get("feature_bound", "log")
+        self._params["n_cores"] = kwargs.get("n_cores", 1)
 
     @property
     def title(self):
         return "Tree: {}; Num: {}".format(self._tree, len(self._trees))
 
-    @staticmethod
-    @RandomForestTiming.timeit(level=2, prefix="[Core] ")
-    def most_appearance(arr):
-        u, c = np.unique(arr, return_counts=True)
-        return u[np.argmax(c)]
+    @property
+    def classes(self):
+        return self._classes
+
+    @property
+    def forest(self):
+        if self._forest is None:
+            self._forest = FlatForest(self._trees)
+        return self._forest
 
     @RandomForestTiming.timeit(level=1, prefix="[API] ")
-    def fit(self, x, y, sample_weight=None, tree=None, epoch=None, feature_bound=None, **kwargs):
+    def fit(self, x, y, sample_weight=None, tree=None, epoch=None, feature_bound=None, n_cores=None, **kwargs):
         if sample_weight is None:
             sample_weight = self._params["sample_weight"]
         if tree is None:
@@ -51,27 +117,52 @@ class RandomForest(ClassifierBase):
             epoch = self._params["epoch"]
         if feature_bound is None:
             feature_bound = self._params["feature_bound"]
-        x, y = np.atleast_2d(x), np.asarray(y)
-        n_sample = len(y)
-        self._tree = tree
+        if n_cores is None:
+            n_cores = self._params["n_cores"]
+        n_cores = multiprocessing.cpu_count() if n_cores <= 0 else min(n_cores, epoch)
+        x = np.atleast_2d(x)
+        self._classes, y = np.unique(y, return_inverse=True)
+        if sample_weight is not None:
+            sample_weight = np.asarray(sample_weight, dtype=np.float64)
+        self._tree, self._forest = tree, None
+        tasks = [(seed, tree, feature_bound, kwargs) for seed in np.random.randint(2 ** 31 - 1, size=epoch)]
         bar = ProgressBar(max_value=epoch, name="RF")
-        for _ in range(epoch):
-            tmp_tree = RandomForest.cvd_trees[tree](**kwargs)
-            indices = np.random.randint(n_sample, size=n_sample)
-            if sample_weight is None:
-                local_weight = None
-            else:
-                local_weight = sample_weight[indices]
-                local_weight /= local_weight.sum()
-            tmp_tree.fit(x[indices], y[indices], sample_weight=local_weight, feature_bound=feature_bound)
-            self._trees.append(deepcopy(tmp_tree))
-            bar.update()
+        if n_cores == 1:
+            state = np.random.get_state()
+            rf_init(x, y, sample_weight)
+            self._trees = []
+            for task in tasks:
+                self._trees.append(rf_fit_task(task))
+                bar.update()
+            rf_shared.clear()
+            np.random.set_state(state)
+            self._forest = FlatForest(self._trees)
+            return
+        shared = [rf_share(arr) if arr is not None else (None, None) for arr in (x, y, sample_weight)]
+        try:
+            initargs = tuple(info for _, info in shared) + (Timing.enabled,)
+            with Pool(n_cores, initializer=rf_init, initargs=initargs) as pool:
+                self._trees = []
+                for flat_tree, timings in pool.imap(rf_fit_worker, tasks, chunksize=max(1, epoch // (4 * n_cores))):
+                    if timings:
+                        Timing.merge(timings)
+                    self._trees.append(flat_tree)
+                    bar.update()
+        finally:
+            for shm, _ in shared:
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+        self._forest = FlatForest(self._trees)
 
     @RandomForestTiming.timeit(level=1, prefix="[API] ")
     def predict(self, x, get_raw_results=False, bound=None, **kwargs):
-        trees = self._trees if bound is None else self._trees[:bound]
-        matrix = self._multi_clf(x, trees, rf_task, kwargs, target=kwargs.get("target", "parallel"))
-        return np.array([RandomForest.most_appearance(rs) for rs in matrix])
+        x = np.atleast_2d(x)
+        votes = self._multi_data(
+            x, partial(rf_task, bound=bound), kwargs, stack=np.vstack, target=kwargs.get("target", "parallel"))
+        if get_raw_results:
+            return votes
+        return self._classes[np.argmax(votes, axis=1)]
 
     @RandomForestTiming.timeit(level=1, prefix="[API] ")
     def evaluate(self, x, y, metrics=None, tar=0, prefix="Acc", **kwargs):
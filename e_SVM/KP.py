@@ -17,7 +17,8 @@ class KP(KernelBase):
 
     def __init__(self, **kwargs):
         super(KP, self).__init__(**kwargs)
-        self._fit_args, self._fit_args_names = [0.01], ["lr"]
+        self._fit_args, self._fit_args_names = [0.01, None], ["lr", "batch_size"]
+        self._lazy_gram = True
 
     @KernelPerceptronTiming.timeit(level=1, prefix="[Core] ")
     def _update_dw_cache(self, idx, lr, sample_weight):
@@ -30,7 +31,26 @@ class KP(KernelBase):
         self._b += self._db_cache
 
     @KernelPerceptronTiming.timeit(level=1, prefix="[Core] ")
-    def _fit(self, sample_weight, lr):
+    def _fit_batches(self, sample_weight, lr, batch_size):
+        # One sequential pass over shuffled data, the prediction cache (margins) is updated after every batch
+        order = np.random.permutation(len(self._y))
+        mistakes = 0
+        for i in range(0, len(order), batch_size):
+            batch = order[i:i + batch_size]
+            batch = batch[self._y[batch] * self._prediction_cache[batch] <= 0]
+            if not len(batch):
+                continue
+            dw = lr * self._y[batch] * sample_weight[batch]
+            self._w[batch] += dw
+            self._b += dw.sum()
+            self._prediction_cache += dw.dot(self._gram[batch, ...]) + dw.sum()
+            mistakes += len(batch)
+        return not mistakes
+
+    @KernelPerceptronTiming.timeit(level=1, prefix="[Core] ")
+    def _fit(self, sample_weight, lr, batch_size):
+        if batch_size is not None:
+            return self._fit_batches(sample_weight, lr, batch_size)
         err = (np.sign(self._prediction_cache) != self._y) * sample_weight
         indices = np.random.permutation(len(self._y))
         idx = indices[np.argmax(err[indices])]
@@ -13,6 +13,8 @@ from NN.TF.Optimizers import OptFactory as TFOptFac
 from Util.Timing import Timing
 from Util.ProgressBar import ProgressBar
 from Util.Bases import GDBase, TFClassifierBase, TorchAutoClassifierBase
+from Util.Batches import BatchPipeline
+from Util.Events import Events
 
 try:
     import torch
@@ -85,16 +87,20 @@ class LinearSVM(GDBase):
         bar = ProgressBar(max_value=epoch, name="LinearSVM")
         ims = []
         train_repeat = self._get_train_repeat(x, batch_size)
+        pipeline = BatchPipeline((x, y, sample_weight), batch_size) if train_repeat != 1 else None
         for i in range(epoch):
             self._optimizer.update()
             l = self._batch_training(
-                x, y, batch_size, train_repeat, sample_weight, c
+                x, y, batch_size, train_repeat, sample_weight, c, pipeline=pipeline
             )
             if l < tol:
                 bar.terminate()
                 break
             self._handle_animation(i, x, y, ims, animation_params, *animation_properties)
             bar.update()
+        if pipeline is not None:
+            pipeline.close()
+        Events.flush()
         self._handle_mp4(ims, animation_properties)
 
     @LinearSVMTiming.timeit(level=1, prefix="[API] ")
@@ -152,13 +158,17 @@ class TFLinearSVM(TFClassifierBase):
         bar = ProgressBar(max_value=epoch, name="TFLinearSVM")
         ims = []
         train_repeat = self._get_train_repeat(x, batch_size)
+        pipeline = BatchPipeline((x, y_2d), batch_size) if train_repeat != 1 else None
         for i in range(epoch):
-            l = self._batch_training(x, y_2d, batch_size, train_repeat, loss, train_step)
+            l = self._batch_training(x, y_2d, batch_size, train_repeat, loss, train_step, pipeline=pipeline)
             if l < tol:
                 bar.terminate()
                 break
             self._handle_animation(i, x, y, ims, animation_params, *animation_properties)
             bar.update()
+        if pipeline is not None:
+            pipeline.close()
+        Events.flush()
         self._handle_mp4(ims, animation_properties)
 
     @TFLinearSVMTiming.timeit(level=1, prefix="[API] ")
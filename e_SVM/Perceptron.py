@@ -20,18 +20,92 @@ class Perceptron(ClassifierBase):
 
         self._params["lr"] = kwargs.get("lr", 0.01)
         self._params["epoch"] = kwargs.get("epoch", 10 ** 4)
+        self._params["batch_size"] = kwargs.get("batch_size", None)
+        self._params["average"] = kwargs.get("average", False)
+        self._params["patience"] = kwargs.get("patience", 5)
+
+    @staticmethod
+    def _is_sparse(x):
+        return hasattr(x, "tocsr")
+
+    @PerceptronTiming.timeit(level=1, prefix="[Core] ")
+    def _fit_worst(self, x, y, sample_weight, lr, epoch, animation_params, animation_properties):
+        # Update the worst sample each time, the margin vector is updated incrementally instead of re-predicted
+        margin = y * self.predict(x, True) * sample_weight
+        ims = []
+        bar = ProgressBar(max_value=epoch, name="Perceptron")
+        for i in range(epoch):
+            idx = np.argmin(margin)
+            if margin[idx] > 0:
+                bar.terminate()
+                break
+            delta = lr * y[idx] * sample_weight[idx]
+            x_idx = x[idx].toarray().ravel() if Perceptron._is_sparse(x) else x[idx]
+            self._w += delta * x_idx
+            self._b += delta
+            margin += delta * y * sample_weight * (x.dot(x_idx) + 1)
+            self._handle_animation(i, x, y, ims, animation_params, *animation_properties)
+            bar.update()
+        self._handle_mp4(ims, animation_properties)
+
+    @PerceptronTiming.timeit(level=1, prefix="[Core] ")
+    def _fit_batches(self, x, y, sample_weight, lr, epoch, batch_size, average, patience):
+        # Sequential passes over shuffled data; batch_size=1 is the classic perceptron,
+        # larger batches apply the updates of all the mistakes in a batch at once
+        n_batches = (len(y) + batch_size - 1) // batch_size
+        w_sum, b_sum, n_steps = np.zeros_like(self._w), 0., 0
+        best, stall = None, 0
+        bar = ProgressBar(max_value=epoch, name="Perceptron")
+        for _ in range(epoch):
+            order = np.random.permutation(len(y))
+            mistakes = 0
+            for i in range(n_batches):
+                batch = order[i * batch_size:(i + 1) * batch_size]
+                x_batch, y_batch = x[batch], y[batch]
+                margin = y_batch * (x_batch.dot(self._w) + self._b)
+                coef = lr * y_batch * sample_weight[batch] * (margin <= 0)
+                n_mistakes = np.count_nonzero(coef)
+                if n_mistakes:
+                    self._w += x_batch.T.dot(coef)
+                    self._b += coef.sum()
+                    mistakes += n_mistakes
+                if average:
+                    w_sum += self._w
+                    b_sum += self._b
+                    n_steps += 1
+            bar.update()
+            if not mistakes:
+                break
+            if best is None or mistakes < best:
+                best, stall = mistakes, 0
+            else:
+                stall += 1
+                if stall >= patience:
+                    break
+        bar.terminate()
+        if average and n_steps:
+            self._w, self._b = w_sum / n_steps, b_sum / n_steps
 
     @PerceptronTiming.timeit(level=1, prefix="[API] ")
-    def fit(self, x, y, sample_weight=None, lr=None, epoch=None, animation_params=None):
+    def fit(self, x, y, sample_weight=None, lr=None, epoch=None, batch_size=None, average=None, patience=None,
+            animation_params=None):
         if sample_weight is None:
             sample_weight = self._params["sample_weight"]
         if lr is None:
             lr = self._params["lr"]
         if epoch is None:
             epoch = self._params["epoch"]
+        if batch_size is None:
+            batch_size = self._params["batch_size"]
+        if average is None:
+            average = self._params["average"]
+        if patience is None:
+            patience = self._params["patience"]
         *animation_properties, animation_params = self._get_animation_params(animation_params)
 
-        x, y = np.atleast_2d(x), np.asarray(y)
+        if not Perceptron._is_sparse(x):
+            x = np.atleast_2d(x)
+        y = np.asarray(y)
         if sample_weight is None:
             sample_weight = np.ones(len(y))
         else:
@@ -39,24 +113,16 @@ class Perceptron(ClassifierBase):
 
         self._w = np.zeros(x.shape[1])
         self._b = 0.
-        ims = []
-        bar = ProgressBar(max_value=epoch, name="Perceptron")
-        for i in range(epoch):
-            err = -y * self.predict(x, True) * sample_weight
-            idx = np.argmax(err)
-            if err[idx] < 0:
-                bar.terminate()
-                break
-            delta = lr * y[idx] * sample_weight[idx]
-            self._w += delta * x[idx]
-            self._b += delta
-            self._handle_animation(i, x, y, ims, animation_params, *animation_properties)
-            bar.update()
-        self._handle_mp4(ims, animation_properties)
+        if batch_size is None:
+            self._fit_worst(x, y, sample_weight, lr, epoch, animation_params, animation_properties)
+        else:
+            self._fit_batches(x, y, sample_weight, lr, epoch, batch_size, average, patience)
 
     @PerceptronTiming.timeit(level=1, prefix="[API] ")
     def predict(self, x, get_raw_results=False, **kwargs):
-        rs = np.asarray(x, dtype=np.float32).dot(self._w) + self._b
+        if not Perceptron._is_sparse(x):
+            x = np.asarray(x, dtype=np.float32)
+        rs = x.dot(self._w) + self._b
         if get_raw_results:
             return rs
         return np.sign(rs).astype(np.float32)
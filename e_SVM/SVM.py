@@ -10,7 +10,8 @@ import tensorflow as tf
 from NN.TF.Optimizers import OptFactory as TFOptFac
 
 from Util.Timing import Timing
-from Util.Bases import KernelBase, GDKernelBase, TFKernelBase, TorchKernelBase
+from Util.Bases import KernelBase, KernelCache, GDKernelBase, TFKernelBase, TorchKernelBase
+from Util.Batches import BatchPipeline
 
 try:
     import torch
@@ -27,29 +28,101 @@ class SVM(KernelBase):
         super(SVM, self).__init__(**kwargs)
         self._fit_args, self._fit_args_names = [1e-3], ["tol"]
         self._c = None
+        self._lazy_gram = True
+        self._shrinking = self._shrink_period = None
+        self._iteration = 0
+        # self._grad holds -y * G, where G is the gradient of the dual objective
+        self._grad = self._diag = self._up = self._low = self._g_max = None
+        self._buffers = self._mask = None
+        self._log_gap, self._gaps = None, {}
+
+        self._params["shrinking"] = kwargs.get("shrinking", True)
+        self._params["log_gap"] = kwargs.get("log_gap", False)
+
+    @property
+    def gaps(self):
+        return {key: np.array(value) for key, value in self._gaps.items()}
+
+    def _local(self, arr):
+        return arr if self._active is None else arr[self._active]
+
+    def _update_sets(self, *indices):
+        for idx in indices:
+            alpha, positive = self._alpha[idx], self._y[idx] > 0
+            self._up[idx] = alpha < self._c if positive else alpha > 0
+            self._low[idx] = alpha > 0 if positive else alpha < self._c
 
     @SVMTiming.timeit(level=1, prefix="[SMO] ")
     def _pick_first(self, tol):
-        con1 = self._alpha > 0
-        con2 = self._alpha < self._c
-        err1 = self._y * self._prediction_cache - 1
-        err2 = err1.copy()
-        err3 = err1.copy()
-        err1[(con1 & (err1 <= 0)) | (~con1 & (err1 > 0))] = 0
-        err2[((~con1 | ~con2) & (err2 != 0)) | ((con1 & con2) & (err2 == 0))] = 0
-        err3[(con2 & (err3 >= 0)) | (~con2 & (err3 < 0))] = 0
-        err = err1 ** 2 + err2 ** 2 + err3 ** 2
-        idx = np.argmax(err)
-        if err[idx] < tol:
+        grad, up, low = self._local(self._grad), self._local(self._up), self._local(self._low)
+        buffer = self._buffers[0][:len(grad)]
+        buffer.fill(-np.inf)
+        np.copyto(buffer, grad, where=up)
+        idx = np.argmax(buffer)
+        self._g_max = buffer[idx]
+        buffer.fill(np.inf)
+        np.copyto(buffer, grad, where=low)
+        g_min = buffer.min()
+        self._gaps["violation"].append(self._g_max - g_min)
+        if self._log_gap:
+            self._gaps["duality"].append(self._get_duality_gap())
+        if self._g_max - g_min < tol:
             return
-        return idx
+        return idx if self._active is None else self._active[idx]
 
     @SVMTiming.timeit(level=1, prefix="[SMO] ")
     def _pick_second(self, idx1):
-        idx = np.random.randint(len(self._y))
-        while idx == idx1:
-            idx = np.random.randint(len(self._y))
-        return idx
+        # Second order selection (WSS2): maximize the decrease of the dual objective among violating pairs
+        grad, low, diag = self._local(self._grad), self._local(self._low), self._local(self._diag)
+        curvature, gain = self._buffers[1][:len(grad)], self._buffers[2][:len(grad)]
+        mask = self._mask[:len(grad)]
+        np.multiply(self._local(self._gram[idx1]), -2, out=curvature)
+        curvature += diag
+        curvature += self._diag[idx1]
+        np.maximum(curvature, 1e-12, out=curvature)
+        np.subtract(self._g_max, grad, out=gain)
+        np.greater(gain, 0, out=mask)
+        mask &= low
+        np.square(gain, out=gain)
+        gain /= curvature
+        np.logical_not(mask, out=mask)
+        np.copyto(gain, -np.inf, where=mask)
+        idx = np.argmax(gain)
+        return idx if self._active is None else self._active[idx]
+
+    @SVMTiming.timeit(level=2, prefix="[SMO] ")
+    def _get_duality_gap(self):
+        quad = self._w.dot(self._prediction_cache - self._b)
+        hinge = np.maximum(1 - self._y * self._prediction_cache, 0).sum()
+        return quad + self._c * hinge - self._alpha.sum()
+
+    @SVMTiming.timeit(level=1, prefix="[SMO] ")
+    def _shrink(self):
+        active = np.arange(len(self._y)) if self._active is None else self._active
+        alpha, err = self._alpha[active], self._y[active] * self._prediction_cache[active] - 1
+        # Alphas stuck at a bound which satisfy their KKT conditions are unlikely to move again
+        bounded = ((alpha <= 0) & (err > 0)) | ((alpha >= self._c) & (err < 0))
+        if np.all(bounded):
+            return
+        self._active = active[~bounded]
+
+    @SVMTiming.timeit(level=1, prefix="[SMO] ")
+    def _unshrink(self):
+        self._active = None
+        self._refresh_pred_cache()
+        np.subtract(self._y, self._prediction_cache, out=self._grad)
+        self._grad += self._b
+
+    @SVMTiming.timeit(level=1, prefix="[SMO] ")
+    def _update_b(self):
+        free = (self._alpha > 0) & (self._alpha < self._c)
+        if np.any(free):
+            b = np.mean(self._grad[free])
+        else:
+            up, low = self._grad[self._up], self._grad[self._low]
+            b = 0.5 * ((up.max() if len(up) else 0) + (low.min() if len(low) else 0))
+        self._prediction_cache += b - self._b
+        self._b = b
 
     @SVMTiming.timeit(level=2, prefix="[SMO] ")
     def _get_lower_bound(self, idx1, idx2):
@@ -63,27 +136,59 @@ class SVM(KernelBase):
             return min(self._c, self._c + self._alpha[idx2] - self._alpha[idx1])
         return min(self._c, self._alpha[idx2] + self._alpha[idx1])
 
+    def _snap(self, alpha):
+        # Alphas which only miss a bound by rounding errors would be picked again & again without moving
+        if alpha < 1e-12 * self._c:
+            return 0.
+        if alpha > (1 - 1e-12) * self._c:
+            return self._c
+        return alpha
+
     @SVMTiming.timeit(level=1, prefix="[SMO] ")
     def _update_alpha(self, idx1, idx2):
         l, h = self._get_lower_bound(idx1, idx2), self._get_upper_bound(idx1, idx2)
         y1, y2 = self._y[idx1], self._y[idx2]
         e1 = self._prediction_cache[idx1] - self._y[idx1]
         e2 = self._prediction_cache[idx2] - self._y[idx2]
-        eta = self._gram[idx1][idx1] + self._gram[idx2][idx2] - 2 * self._gram[idx1][idx2]
+        eta = max(self._diag[idx1] + self._diag[idx2] - 2 * self._gram[idx1][idx2], 1e-12)
         a2_new = self._alpha[idx2] + (y2 * (e1 - e2)) / eta
         if a2_new > h:
             a2_new = h
         elif a2_new < l:
             a2_new = l
         a1_old, a2_old = self._alpha[idx1], self._alpha[idx2]
+        a2_new = self._snap(a2_new)
         da2 = a2_new - a2_old
-        da1 = -y1 * y2 * da2
-        self._alpha[idx1] += da1
+        a1_new = self._snap(a1_old - y1 * y2 * da2)
+        da1 = a1_new - a1_old
+        self._alpha[idx1] = a1_new
         self._alpha[idx2] = a2_new
+        self._update_sets(idx1, idx2)
         self._update_dw_cache(idx1, idx2, da1, da2, y1, y2)
         self._update_db_cache(idx1, idx2, da1, da2, y1, y2, e1, e2)
         self._update_pred_cache(idx1, idx2)
 
+    @SVMTiming.timeit(level=1, prefix="[Core] ")
+    def _update_pred_cache(self, idx1, idx2):
+        if self._active is not None and self._log_gap:
+            # The duality gap is taken over every sample, so the whole cache is kept current while shrunk
+            delta = self._dw_cache.dot(self._gram[(idx1, idx2), ...])
+            self._grad[self._active] -= delta[self._active]
+            self._prediction_cache += delta + self._db_cache
+            return
+        if self._active is not None:
+            delta = self._dw_cache.dot(self._gram[(idx1, idx2), ...][..., self._active])
+            self._grad[self._active] -= delta
+            self._prediction_cache[self._active] += delta + self._db_cache
+            return
+        delta, tmp = self._buffers[1], self._buffers[2]
+        np.multiply(self._gram[idx1], self._dw_cache[0], out=delta)
+        np.multiply(self._gram[idx2], self._dw_cache[1], out=tmp)
+        delta += tmp
+        self._grad -= delta
+        delta += self._db_cache
+        self._prediction_cache += delta
+
     @SVMTiming.timeit(level=1, prefix="[Core] ")
     def _update_dw_cache(self, idx1, idx2, da1, da2, y1, y2):
         self._dw_cache = np.array([da1 * y1, da2 * y2])
@@ -101,12 +206,30 @@ class SVM(KernelBase):
     @SVMTiming.timeit(level=4, prefix="[Util] ")
     def _prepare(self, sample_weight, **kwargs):
         self._c = kwargs.get("c", self._params["c"])
+        self._shrinking = kwargs.get("shrinking", self._params["shrinking"])
+        self._shrink_period = min(len(self._y), 1000)
+        self._iteration = 0
+        self._log_gap = kwargs.get("log_gap", self._params["log_gap"])
+        self._gaps = {"violation": [], "duality": []}
+        self._grad = self._y.astype(np.float64)
+        self._diag = self._gram.diag if isinstance(self._gram, KernelCache) else np.diag(self._gram).copy()
+        self._up, self._low = self._y > 0, self._y < 0
+        self._buffers = np.empty((3, len(self._y)))
+        self._mask = np.empty(len(self._y), dtype=bool)
 
     @SVMTiming.timeit(level=1, prefix="[Core] ")
     def _fit(self, sample_weight, tol):
+        self._iteration += 1
+        if self._shrinking and self._iteration % self._shrink_period == 0:
+            self._shrink()
         idx1 = self._pick_first(tol)
         if idx1 is None:
-            return True
+            if self._active is not None:
+                self._unshrink()
+                idx1 = self._pick_first(tol)
+            if idx1 is None:
+                self._update_b()
+                return True
         idx2 = self._pick_second(idx1)
         self._update_alpha(idx1, idx2)
 
@@ -165,9 +288,11 @@ class TFSVM(TFKernelBase):
     def _fit(self, sample_weight, tol):
         if self._train_repeat is None:
             self._train_repeat = self._get_train_repeat(self._x, self._batch_size)
+        if self._pipeline is None and self._train_repeat != 1:
+            self._pipeline = BatchPipeline((self._gram, self._y), self._batch_size)
         l = self._batch_training(
             self._gram, self._y, self._batch_size, self._train_repeat,
-            self._loss, self._train_step
+            self._loss, self._train_step, pipeline=self._pipeline
         )
         if l < tol:
             return True
@@ -11,6 +11,7 @@ from g_CNN.Optimizers import *
 
 from Util.Timing import Timing
 from Util.Bases import TFClassifierBase
+from Util.Batches import BatchPipeline
 from Util.ProgressBar import ProgressBar
 
 
@@ -320,17 +321,20 @@ class NN(TFClassifierBase):
             self._loss = self._layers[-1].calculate(self._tfy, self._inner_y)
             self._train_step = self._optimizer.minimize(self._loss)
             sess.run(tf.global_variables_initializer())
+            pipeline = BatchPipeline((x_train, y_train), batch_size) if train_repeat != 1 else None
             for counter in range(epoch):
                 if self.verbose >= NNVerbose.ITER and counter % record_period == 0:
                     sub_bar = ProgressBar(max_value=train_repeat * record_period - 1, name="Iteration")
                 else:
                     sub_bar = None
                 self._batch_training(x_train, y_train, batch_size, train_repeat,
-                                     self._loss, self._train_step, sub_bar, *args[0])
+                                     self._loss, self._train_step, sub_bar, *args[0], pipeline=pipeline)
                 if (counter + 1) % record_period == 0:
                     self._batch_work(*args[1])
                     if self.verbose >= NNVerbose.EPOCH:
                         bar.update(counter // record_period + 1)
+            if pipeline is not None:
+                pipeline.close()
 
     @NNTiming.timeit(level=1, prefix="[API] ")
     def predict(self, x, get_raw_results=False, **kwargs):
@@ -14,28 +14,148 @@ from Util.ProgressBar import ProgressBar
 class KMeans(ClassifierBase):
     def __init__(self, **kwargs):
         super(KMeans, self).__init__(**kwargs)
-        self._centers = self._counter = None
+        self._centers = self._counter = self._cluster_counts = None
 
         self._params["n_clusters"] = kwargs.get("n_clusters", 2)
         self._params["epoch"] = kwargs.get("epoch", 1000)
         self._params["norm"] = kwargs.get("norm", "l2")
+        self._params["algorithm"] = kwargs.get("algorithm", "lloyd")
+        self._params["block_size"] = kwargs.get("block_size", 2 ** 12)
 
-    def fit(self, x, n_clusters=None, epoch=None, norm=None, animation_params=None):
+    def _distances(self, x, centers=None):
+        if centers is None:
+            centers = self._centers
+        if self._params["norm"] == "l1":
+            return np.sum(np.abs(x[:, None, ...] - centers), axis=2)
+        # ||x - c||^2 = ||x||^2 - 2xc + ||c||^2, so no (n, k, d) difference tensor is needed
+        dis = x.dot(centers.T)
+        dis *= -2
+        dis += np.einsum("ij,ij->i", x, x)[..., None]
+        dis += np.einsum("ij,ij->i", centers, centers)
+        np.maximum(dis, 0, out=dis)
+        return np.sqrt(dis, out=dis)
+
+    def _paired_distances(self, x, y):
+        diff = x - y
+        if self._params["norm"] == "l1":
+            return np.sum(np.abs(diff), axis=1)
+        return np.sqrt(np.einsum("ij,ij->i", diff, diff))
+
+    def _init_centers(self, x, n_clusters):
+        # k-means++: every new center is sampled with probability proportional to its squared distance
+        centers = np.empty((n_clusters, x.shape[1]))
+        centers[0] = x[np.random.randint(len(x))]
+        min_dis = self._distances(x, centers[:1])[..., 0] ** 2
+        for i in range(1, n_clusters):
+            total = min_dis.sum()
+            if total > 0:
+                idx = np.searchsorted(np.cumsum(min_dis), np.random.random() * total)
+                idx = min(idx, len(x) - 1)
+            else:
+                idx = np.random.randint(len(x))
+            centers[i] = x[idx]
+            np.minimum(min_dis, self._distances(x, centers[i:i + 1])[..., 0] ** 2, out=min_dis)
+        return centers
+
+    @staticmethod
+    def _cluster_sums(x, labels, n_clusters):
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.empty((n_clusters, x.shape[1]))
+        for j in range(x.shape[1]):
+            sums[..., j] = np.bincount(labels, x[..., j], minlength=n_clusters)
+        return sums, counts
+
+    def _set_centers(self, sums, counts):
+        mask = counts > 0
+        # Empty clusters keep their previous centers
+        self._centers[mask] = sums[mask] / counts[mask][..., None]
+
+    def _update_centers(self, x, labels, n_clusters):
+        self._set_centers(*KMeans._cluster_sums(x, labels, n_clusters))
+
+    def _assign(self, x):
+        labels = np.empty(len(x), dtype=np.intp)
+        first, second = np.empty(len(x)), np.empty(len(x))
+        block_size = self._params["block_size"]
+        for i in range(0, len(x), block_size):
+            dis = self._distances(x[i:i + block_size])
+            arange = np.arange(len(dis))
+            local_labels = labels[i:i + block_size] = np.argmin(dis, axis=1)
+            first[i:i + block_size] = dis[arange, local_labels]
+            dis[arange, local_labels] = np.inf
+            second[i:i + block_size] = dis.min(axis=1)
+        return labels, first, second
+
+    def _hamerly(self, x, n_clusters, epoch, bar):
+        # Exact Lloyd iterations which skip distance computations with triangle inequality bounds (Hamerly, 2010)
+        labels, upper, lower = self._assign(x)
+        # Cluster sums are maintained incrementally, only the samples which change their labels are touched
+        sums, counts = KMeans._cluster_sums(x, labels, n_clusters)
+        counter = 0
+        # Centers are only moved right before an assignment, so the labels returned on any exit
+        # (convergence or epoch limit) are the assignment against the final centers
+        for _ in range(epoch):
+            old_centers = self._centers.copy()
+            self._set_centers(sums, counts)
+            shifts = self._paired_distances(self._centers, old_centers)
+            counter += 1
+            if len(shifts) > 1:
+                order = np.argsort(shifts)
+                max_shift = np.where(labels == order[-1], shifts[order[-2]], shifts[order[-1]])
+            else:
+                max_shift = shifts[labels]
+            upper += shifts[labels]
+            lower -= max_shift
+            center_dis = self._distances(self._centers)
+            np.fill_diagonal(center_dis, np.inf)
+            half_gap = 0.5 * center_dis.min(axis=1)
+            bound = np.maximum(half_gap[labels], lower)
+            candidates = np.flatnonzero(upper > bound)
+            if len(candidates):
+                upper[candidates] = self._paired_distances(x[candidates], self._centers[labels[candidates]])
+                candidates = candidates[upper[candidates] > bound[candidates]]
+            changed = 0
+            if len(candidates):
+                new_labels, upper[candidates], lower[candidates] = self._assign(x[candidates])
+                mask = new_labels != labels[candidates]
+                if np.any(mask):
+                    moved, old_labels, moved_labels = x[candidates[mask]], labels[candidates[mask]], new_labels[mask]
+                    np.subtract.at(sums, old_labels, moved)
+                    np.add.at(sums, moved_labels, moved)
+                    counts += np.bincount(moved_labels, minlength=n_clusters)
+                    counts -= np.bincount(old_labels, minlength=n_clusters)
+                    labels[candidates] = new_labels
+                    changed = len(moved)
+            bar.update()
+            if not changed:
+                bar.update(epoch)
+                break
+        self._counter = counter
+        return labels
+
+    def fit(self, x, n_clusters=None, epoch=None, norm=None, algorithm=None, animation_params=None):
         if n_clusters is None:
             n_clusters = self._params["n_clusters"]
         if epoch is None:
             epoch = self._params["epoch"]
         if norm is not None:
             self._params["norm"] = norm
+        if algorithm is None:
+            algorithm = self._params["algorithm"]
         *animation_properties, animation_params = self._get_animation_params(animation_params)
         x = np.atleast_2d(x)
-        arange = np.arange(n_clusters)[..., None]
-        x_high_dim, labels_cache, counter = x[:, None, ...], None, 0
-        self._centers = x[np.random.permutation(len(x))[:n_clusters]]
+        self._centers = self._init_centers(x, n_clusters)
         bar = ProgressBar(max_value=epoch, name="KMeans")
+        if algorithm == "hamerly":
+            labels = self._hamerly(x, n_clusters, epoch, bar)
+            self._cluster_counts = np.bincount(labels, minlength=n_clusters)
+            return
+        if algorithm != "lloyd":
+            raise NotImplementedError("Algorithm '{}' not defined".format(algorithm))
+        labels_cache, counter = None, 0
         ims = []
         for i in range(epoch):
-            labels = self.predict(x_high_dim, high_dim=True)
+            labels = self.predict(x)
             if labels_cache is None:
                 labels_cache = labels
             else:
@@ -44,20 +164,48 @@ class KMeans(ClassifierBase):
                     break
                 else:
                     labels_cache = labels
-            for j, indices in enumerate(labels == arange):
-                self._centers[j] = np.average(x[indices], axis=0)
+            self._update_centers(x, labels, n_clusters)
             counter += 1
             animation_params["extra"] = self._centers
             self._handle_animation(i, x, labels, ims, animation_params, *animation_properties)
             bar.update()
+        else:
+            # The epoch limit was hit right after the centers moved, so assign once more against them
+            labels_cache = self.predict(x)
         self._counter = counter
+        self._cluster_counts = np.bincount(labels_cache, minlength=n_clusters)
         self._handle_mp4(ims, animation_properties)
 
+    def partial_fit(self, x, n_clusters=None):
+        # Mini-batch step: every center moves to the running mean of all the samples ever assigned to it
+        if n_clusters is None:
+            n_clusters = self._params["n_clusters"]
+        x = np.atleast_2d(x)
+        if self._centers is None:
+            self._centers = self._init_centers(x, n_clusters)
+            self._cluster_counts = np.zeros(n_clusters, dtype=np.int64)
+            self._counter = 0
+        labels = self.predict(x)
+        sums, counts = KMeans._cluster_sums(x, labels, len(self._centers))
+        mask = counts > 0
+        self._cluster_counts += counts
+        self._centers[mask] += (
+            sums[mask] - counts[mask][..., None] * self._centers[mask]) / self._cluster_counts[mask][..., None]
+        self._counter += 1
+        return self
+
+    def fit_batches(self, batches, n_clusters=None, epoch=1):
+        for _ in range(epoch):
+            for batch in batches() if callable(batches) else batches:
+                self.partial_fit(batch, n_clusters)
+        return self
+
     def predict(self, x, get_raw_results=False, high_dim=False):
-        if not high_dim:
-            x = x[:, None, ...]
-        dis = np.abs(x - self._centers) if self._params["norm"] == "l1" else (x - self._centers) ** 2
-        return np.argmin(np.sum(dis, axis=2), axis=1)
+        x = np.atleast_2d(x[:, 0] if high_dim else x)
+        block_size = self._params["block_size"]
+        return np.concatenate([
+            np.argmin(self._distances(x[i:i + block_size]), axis=1) for i in range(0, len(x), block_size)
+        ]) if len(x) else np.zeros(0, dtype=np.intp)
 
 if __name__ == '__main__':
     _x, _y = DataUtil.gen_random(size=2000, scale=6)